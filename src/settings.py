@@ -23,6 +23,14 @@ DATABASES = {
     }
 }
 
+# Options of the pooled client used for raw MongoDB access
+DATABASE_CLIENT_OPTIONS = {
+    'maxPoolSize': int(environ.get('DB_POOL_SIZE', '100')),
+    'waitQueueTimeoutMS': int(environ.get('DB_WAIT_QUEUE_TIMEOUT', '5000')),
+    'connectTimeoutMS': int(environ.get('DB_CONNECT_TIMEOUT', '5000')),
+    'serverSelectionTimeoutMS': int(environ.get('DB_SERVER_SELECTION_TIMEOUT', '10000'))
+}
+
 BASEDIR =  environ.get('BASEDIR', path.dirname(path.abspath(__file__)))
 
 STORE_NAME = 'WStore'
@@ -40,6 +48,12 @@ BILL_ROOT = path.join(MEDIA_ROOT, 'bills')
 # URL that handles the media served from MEDIA_ROOT.
 MEDIA_URL = '/charging/media/'
 
+# Delivery of the media files: stream (read from disk in chunks of MEDIA_CHUNK_SIZE bytes),
+# serve (Django static serve), xsendfile, or xaccel (nginx internal location MEDIA_ACCEL_REDIRECT_PREFIX)
+MEDIA_DELIVERY = 'stream'
+MEDIA_CHUNK_SIZE = 65536
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected/'
+
 INSTALLED_APPS = (
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -96,6 +110,7 @@ URL_MIDDLEWARE_CLASSES = {
         'django.contrib.sessions.middleware.SessionMiddleware',
         'wstore.store_commons.middleware.ConditionalGetMiddleware',
         'wstore.store_commons.middleware.AuthenticationMiddleware',
+        'wstore.store_commons.middleware.BundleResolverMiddleware',
     ),
     'media': (
         'django.middleware.common.CommonMiddleware',
@@ -124,7 +139,12 @@ TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 CRONJOBS = [
     ('0 5 * * *', 'django.core.management.call_command', ['pending_charges_daemon']),
     ('0 6 * * *', 'django.core.management.call_command', ['resend_cdrs']),
-    ('0 4 * * *', 'django.core.management.call_command', ['resend_upgrade'])
+    ('*/10 * * * *', 'django.core.management.call_command', ['dispatch_cdrs']),
+    ('*/10 * * * *', 'django.core.management.call_command', ['rate_pending_usage']),
+    ('*/10 * * * *', 'django.core.management.call_command', ['dispatch_mails']),
+    ('0 4 * * *', 'django.core.management.call_command', ['resend_upgrade']),
+    ('0 3 * * *', 'django.core.management.call_command', ['collect_asset_blobs']),
+    ('* * * * *', 'django.core.management.call_command', ['payment_timeouts'])
 ]
 
 CLIENTS = {
@@ -135,6 +155,101 @@ CLIENTS = {
 
 PAYMENT_CLIENT = CLIENTS[PAYMENT_METHOD]
 
+# Seconds the customer has to confirm a payment before it is rolled back
+PAYMENT_TIMEOUT = 300
+# Max seconds the payment timeout worker sleeps between checks of expired payments
+PAYMENT_TIMEOUT_POLL = 60
+
+# Number of usage documents retrieved per request to the usage API
+USAGE_PAGE_SIZE = 100
+# Whether the usage API supports filtering usage documents by product characteristic
+USAGE_PRODUCT_FILTER = False
+
+# Max number of SDRs accepted by the batch accounting API, and concurrent usage state updates of a batch
+SDR_BATCH_SIZE = 1000
+SDR_BATCH_WORKERS = 8
+
+# Rating of the usage documents charged to the customer
+USAGE_RATING_ASYNC = False
+USAGE_RATING_WORKERS = 8
+USAGE_RATING_POLL = 300
+USAGE_RATING_CLAIM_TIMEOUT = 600
+USAGE_RATING_MAX_ATTEMPTS = 10
+USAGE_RATING_RETRY_DELAY = 60
+USAGE_RATING_RETRY_MAX_DELAY = 3600
+
+# CDR outbox dispatcher, sends the generated CDRs to the RSS in batches
+CDR_BATCH_SIZE = 100
+CDR_DISPATCHER_WORKERS = 4
+CDR_DISPATCHER_POLL = 60
+CDR_CLAIM_TIMEOUT = 300
+CDR_MAX_ATTEMPTS = 10
+CDR_RETRY_DELAY = 30
+CDR_RETRY_MAX_DELAY = 3600
+
+# Shared HTTP client used to access the external APIs, connections are pooled per host
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 30
+HTTP_POOL_SIZE = 10
+# Retries of idempotent requests on connection errors or 502, 503 and 504 responses
+HTTP_RETRIES = 2
+HTTP_RETRY_BACKOFF = 0.5
+# Consecutive failures which open the circuit of a host, and seconds until a new request is tried
+HTTP_CIRCUIT_THRESHOLD = 5
+HTTP_CIRCUIT_RESET = 30
+
+# Cache of the catalog entities and customer accounts downloaded when processing orders,
+# expired entries are revalidated using their ETag
+CATALOG_CACHE_TTL = 300
+CATALOG_CACHE_SIZE = 1000
+ACCOUNT_CACHE_TTL = 60
+ACCOUNT_CACHE_SIZE = 1000
+
+# Seconds a process trusts its copy of the invalidation stamp of the download caches, and seconds
+# downloaded documents are not cached after an invalidation, while the catalog change is committed
+DOWNLOAD_CACHE_GENERATION_TTL = 5
+DOWNLOAD_CACHE_INVALIDATION_HOLD = 30
+
+# Seconds the identity headers of an API user are trusted to be already stored, and max number of cached identities
+API_USER_CACHE_TTL = 30
+API_USER_CACHE_SIZE = 10000
+
+# Max number of order items whose contract is built concurrently
+ORDERING_WORKERS = 8
+
+# Number of processes the pending charges daemon splits the due orders into
+PENDING_CHARGES_WORKERS = 1
+# Threads executing the notifications and suspensions of each process, and attempts of every action
+PENDING_CHARGES_THREADS = 8
+PENDING_CHARGES_ATTEMPTS = 3
+PENDING_CHARGES_RETRY_DELAY = 1
+
+# PDF invoices, conversions run in a bounded pool and optionally in the background,
+# so charges do not wait for the invoice to be generated. The notifications including
+# the invoices are sent once the conversions finish
+INVOICE_WORKERS = 4
+INVOICE_ASYNC = False
+# Backend storing the generated invoices, the local storage shards them by month and order
+INVOICE_STORAGE = 'wstore.charging_engine.invoice_storage.LocalInvoiceStorage'
+
+# Seconds the plugins loaded by a process are used before checking if they have been reinstalled
+PLUGIN_REGISTRY_CHECK_INTERVAL = 10
+# Concurrent submissions of the usage records pulled by the plugins when refreshing the accounting
+USAGE_REFRESH_WORKERS = 8
+
+# Mail spool, notification emails are sent in the background reusing the SMTP connection
+MAIL_BATCH_SIZE = 50
+MAIL_DISPATCHER_POLL = 60
+MAIL_CLAIM_TIMEOUT = 300
+MAIL_MAX_ATTEMPTS = 10
+MAIL_RETRY_DELAY = 60
+MAIL_RETRY_MAX_DELAY = 3600
+
+# Asset files are written to disk in chunks of ASSET_UPLOAD_CHUNK_SIZE bytes, resumable uploads
+# not completed after ASSET_UPLOAD_EXPIRY seconds are removed when a new upload is started
+ASSET_UPLOAD_CHUNK_SIZE = 1048576
+ASSET_UPLOAD_EXPIRY = 86400
+
 NOTIF_CERT_FILE = None
 NOTIF_CERT_KEY_FILE = None
 
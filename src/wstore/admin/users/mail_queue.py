@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import os
+import smtplib
+import threading
+from datetime import datetime
+
+from django.conf import settings
+
+from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.spool import Spool
+from wstore.store_commons.worker import ProcessWorker
+
+
+class SMTPConnection(object):
+    """
+    SMTP connection reused for sending all the emails of the process. The connection
+    is checked before being used, so it is opened again if the server has closed it
+    """
+
+    def __init__(self):
+        self._server = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _is_alive(self):
+        try:
+            return self._server.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+        except IOError:
+            return False
+
+    def _connect(self):
+        self._server = smtplib.SMTP(settings.SMTPSERVER, settings.SMTPPORT)
+        self._server.starttls()
+        self._server.login(settings.WSTOREMAILUSER, settings.WSTOREMAILPASS)
+        self._pid = os.getpid()
+
+    def close(self):
+        with self._lock:
+            if self._server is not None:
+                try:
+                    self._server.quit()
+                except (smtplib.SMTPException, IOError):
+                    pass
+
+            self._server = None
+
+    def sendmail(self, fromaddr, recipients, message):
+        with self._lock:
+            # Connections are not shared with forked processes
+            if self._server is None or self._pid != os.getpid() or not self._is_alive():
+                self._connect()
+
+            self._server.sendmail(fromaddr, recipients, message)
+
+
+_connection = SMTPConnection()
+_spool = Spool('wstore_mail_spool', 'MAIL')
+
+
+def enqueue_mail(fromaddr, recipients, message):
+    """
+    Stores an email in the spool, so it is sent by the mail dispatcher
+    :param fromaddr: Sender address
+    :param recipients: List of recipient addresses
+    :param message: Serialized MIME message
+    """
+    db = get_database_connection()
+    db.wstore_mail_spool.insert_one(_spool.build_entry({
+        'from': fromaddr,
+        'recipients': recipients,
+        'message': message,
+        'error': None
+    }))
+
+    _dispatcher.notify()
+
+
+def _send_mail(db, doc):
+    try:
+        _connection.sendmail(doc['from'], doc['recipients'], doc['message'])
+    except Exception as e:
+        _spool.schedule_retry(db, doc, error=unicode(e))
+        return False
+
+    db.wstore_mail_spool.delete_one({'_id': doc['_id']})
+    return True
+
+
+def dispatch_mails():
+    """
+    Sends all the emails of the spool ready to be sent using a single SMTP connection
+    :return: The date of the next scheduled retry or None if there is not any
+    """
+    db = get_database_connection()
+
+    docs = _spool.claim_batch(db, datetime.utcnow(), settings.MAIL_BATCH_SIZE)
+    while len(docs):
+        for doc in docs:
+            _send_mail(db, doc)
+
+        docs = _spool.claim_batch(db, datetime.utcnow(), settings.MAIL_BATCH_SIZE)
+
+    return _spool.get_next_attempt(db)
+
+
+def retry_failed_mails():
+    """
+    Schedules again the emails which have reached the max number of attempts
+    :return: Number of emails scheduled
+    """
+    return _spool.retry_failed(get_database_connection())
+
+
+def ensure_spool_index():
+    _spool.ensure_index(get_database_connection())
+
+
+_dispatcher = ProcessWorker(dispatch_mails, 'MAIL_DISPATCHER_POLL', setup=ensure_spool_index)
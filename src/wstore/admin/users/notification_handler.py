@@ -22,7 +22,6 @@
 from __future__ import unicode_literals
 
 import os
-import smtplib
 from email import encoders
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
@@ -32,6 +31,7 @@ from urlparse import urljoin
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
+from wstore.admin.users.mail_queue import enqueue_mail
 from wstore.models import User
 
 
@@ -49,11 +49,8 @@ class NotificationsHandler:
             raise ImproperlyConfigured('Missing email configuration')
 
     def _send_email(self, recipient, msg):
-        server = smtplib.SMTP(self._server, self._port)
-        server.starttls()
-        server.login(self._mailuser, self._password)
-
-        server.sendmail(self._fromaddr, recipient, msg.as_string())
+        # Emails are sent by the mail dispatcher, so callers are not blocked by the SMTP server
+        enqueue_mail(self._fromaddr, recipient, msg.as_string())
 
     def _send_text_email(self, text, recipients, subject):
         msg = MIMEText(text)
@@ -73,6 +70,10 @@ class NotificationsHandler:
         msg.attach(message)
 
         for bill in bills:
+            # Charges whose invoice could not be generated do not include a bill
+            if not bill:
+                continue
+
             path = os.path.join(settings.BASEDIR, bill)
 
             with open(path, 'rb') as fp:
@@ -20,14 +20,18 @@
 
 from __future__ import unicode_literals
 
+import smtplib
+
 from django.core.exceptions import ImproperlyConfigured
 
 from mock import MagicMock, mock_open, call
 from nose_parameterized import parameterized
 
 from django.test import TestCase
+from django.test.utils import override_settings
 
-from wstore.admin.users import notification_handler
+from wstore.admin.users import mail_queue, notification_handler
+from wstore.store_commons import spool
 
 __test__ = False
 
@@ -86,7 +90,7 @@ class NotificationsTestCase(TestCase):
         notification_handler.MIMEText = MagicMock()
         notification_handler.MIMEBase = MagicMock()
         notification_handler.encoders = MagicMock()
-        notification_handler.smtplib = MagicMock()
+        notification_handler.enqueue_mail = MagicMock()
 
         # Mock open method
         self._mock_open = mock_open()
@@ -149,10 +153,7 @@ class NotificationsTestCase(TestCase):
     def _validate_email_call(self, mime, emails=None):
         if emails is None:
             emails = ['user1@email.com', 'user2@email.com']
-        notification_handler.smtplib.SMTP.assert_called_once_with('smtp.gmail.com', 587)
-        notification_handler.smtplib.SMTP().starttls.assert_called_once_with()
-        notification_handler.smtplib.SMTP().login.assert_called_once_with('wstore', 'passwd')
-        notification_handler.smtplib.SMTP().sendmail.assert_called_once_with(
+        notification_handler.enqueue_mail.assert_called_once_with(
             'wstore@email.com',
             emails,
             mime().as_string()
@@ -204,6 +205,18 @@ class NotificationsTestCase(TestCase):
         self._validate_multipart_call()
         self._validate_email_call(notification_handler.MIMEMultipart)
 
+    def test_acquisition_notification_missing_invoice(self):
+        # Charges whose invoice could not be generated are not attached
+        failed_charge = MagicMock()
+        failed_charge.invoice = ''
+        self._order.contracts[1].charges = [failed_charge]
+
+        handler = notification_handler.NotificationsHandler()
+        handler.send_acquired_notification(self._order)
+
+        self._validate_multipart_call()
+        self._validate_email_call(notification_handler.MIMEMultipart)
+
     def test_renovation_notification(self):
         handler = notification_handler.NotificationsHandler()
         transactions = [{
@@ -295,3 +308,94 @@ class NotificationsTestCase(TestCase):
         notification_handler.MIMEText.assert_called_once_with(text)
 
         self._validate_mime_text_info('Product upgraded')
+
+
+@override_settings(SMTPSERVER='smtp.gmail.com', SMTPPORT=587, WSTOREMAILUSER='wstore', WSTOREMAILPASS='passwd',
+                   MAIL_BATCH_SIZE=10, MAIL_CLAIM_TIMEOUT=300, MAIL_MAX_ATTEMPTS=2, MAIL_RETRY_DELAY=30,
+                   MAIL_RETRY_MAX_DELAY=3600)
+class MailQueueTestCase(TestCase):
+    tags = ('notifications', 'mail-queue')
+
+    def setUp(self):
+        mail_queue.get_database_connection = MagicMock()
+        self._db = mail_queue.get_database_connection.return_value
+
+        mail_queue.smtplib = MagicMock()
+        mail_queue.smtplib.SMTPException = smtplib.SMTPException
+        self._server = mail_queue.smtplib.SMTP.return_value
+        self._server.noop.return_value = (250, 'OK')
+
+        mail_queue._dispatcher = MagicMock()
+        mail_queue._connection = mail_queue.SMTPConnection()
+
+    def tearDown(self):
+        reload(mail_queue)
+
+    def _mail(self, mail_id, attempts=0):
+        return {
+            '_id': mail_id,
+            'from': 'wstore@email.com',
+            'recipients': ['user1@email.com'],
+            'message': 'message ' + mail_id,
+            'attempts': attempts
+        }
+
+    def test_enqueue_mail(self):
+        mail_queue.enqueue_mail('wstore@email.com', ['user1@email.com'], 'message')
+
+        doc = self._db.wstore_mail_spool.insert_one.call_args[0][0]
+        self.assertEquals('wstore@email.com', doc['from'])
+        self.assertEquals(['user1@email.com'], doc['recipients'])
+        self.assertEquals('message', doc['message'])
+        self.assertEquals(spool.PENDING, doc['state'])
+
+        mail_queue._dispatcher.notify.assert_called_once_with()
+
+    def test_dispatch_reuses_connection(self):
+        mail_queue._spool.claim_batch = MagicMock(side_effect=[[self._mail('1'), self._mail('2')], [self._mail('3')], []])
+        self._db.wstore_mail_spool.find_one.return_value = None
+
+        next_date = mail_queue.dispatch_mails()
+
+        self.assertEquals(None, next_date)
+
+        # A single connection is opened and checked before every email
+        mail_queue.smtplib.SMTP.assert_called_once_with('smtp.gmail.com', 587)
+        self._server.starttls.assert_called_once_with()
+        self._server.login.assert_called_once_with('wstore', 'passwd')
+        self.assertEquals(2, self._server.noop.call_count)
+
+        self.assertEquals([
+            call('wstore@email.com', ['user1@email.com'], 'message 1'),
+            call('wstore@email.com', ['user1@email.com'], 'message 2'),
+            call('wstore@email.com', ['user1@email.com'], 'message 3')
+        ], self._server.sendmail.call_args_list)
+
+        self.assertEquals([
+            call({'_id': '1'}), call({'_id': '2'}), call({'_id': '3'})
+        ], self._db.wstore_mail_spool.delete_one.call_args_list)
+
+    def test_reconnect_closed_connection(self):
+        mail_queue._spool.claim_batch = MagicMock(side_effect=[[self._mail('1'), self._mail('2')], []])
+        self._server.noop.side_effect = smtplib.SMTPServerDisconnected()
+
+        mail_queue.dispatch_mails()
+
+        self.assertEquals(2, mail_queue.smtplib.SMTP.call_count)
+        self.assertEquals(2, self._server.sendmail.call_count)
+
+    def test_failed_mail(self):
+        mail_queue._spool.claim_batch = MagicMock(side_effect=[[self._mail('1'), self._mail('2', attempts=1)], []])
+        self._server.sendmail.side_effect = smtplib.SMTPRecipientsRefused({})
+
+        mail_queue.dispatch_mails()
+
+        self.assertEquals(0, self._db.wstore_mail_spool.delete_one.call_count)
+
+        updates = self._db.wstore_mail_spool.update_one.call_args_list
+        self.assertEquals({'_id': '1'}, updates[0][0][0])
+        self.assertEquals(spool.PENDING, updates[0][0][1]['$set']['state'])
+        self.assertEquals(1, updates[0][0][1]['$set']['attempts'])
+
+        self.assertEquals({'_id': '2'}, updates[1][0][0])
+        self.assertEquals(spool.FAILED, updates[1][0][1]['$set']['state'])
@@ -20,7 +20,6 @@
 
 from __future__ import unicode_literals
 
-import base64
 import os
 import threading
 from urlparse import urljoin
@@ -29,6 +28,8 @@ from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 
 from wstore.models import Resource, ResourceVersion, ResourcePlugin
+from wstore.asset_manager.blob_store import store_asset_file
+from wstore.asset_manager.file_upload import save_upload, complete_upload, iter_base64_content, iter_file_content
 from wstore.store_commons.database import DocumentLock
 from wstore.store_commons.errors import ConflictError
 from wstore.store_commons.rollback import rollback, downgrade_asset_pa, downgrade_asset
@@ -41,15 +42,13 @@ class AssetManager:
     def __init__(self):
         pass
 
-    def _save_resource_file(self, provider, file_):
-        # Load file contents
+    def _save_resource_file(self, provider, file_, checksum=None):
+        # Load file info
         if isinstance(file_, dict):
             file_name = file_['name']
-            content = base64.b64decode(file_['data'])
+            checksum = file_.get('checksum', checksum)
         else:
             file_name = file_.name
-            file_.seek(0)
-            content = file_.read()
 
         # Check file name
         if not is_valid_file(file_name):
@@ -76,14 +75,22 @@ class AssetManager:
                 raise ConflictError('The provided digital asset file (' + file_name + ') already exists')
             res.delete()
 
-        # Create file
-        with open(file_path, "wb") as f:
-            f.write(content)
+        # Create file, the content is written in chunks so large files are not loaded into memory
+        if not isinstance(file_, dict):
+            digest = save_upload(iter_file_content(file_), file_path, checksum=checksum)
+        elif 'uploadId' in file_:
+            # The content has been sent using a resumable upload
+            digest = complete_upload(provider, file_['uploadId'], file_path, checksum=checksum)
+        else:
+            digest = save_upload(iter_base64_content(file_['data']), file_path, checksum=checksum)
 
         self.rollback_logger['files'].append(file_path)
 
+        # Files with the same content share the stored blob
+        store_asset_file(digest, file_path)
+
         site = settings.SITE
-        return resource_path, url_fix(urljoin(site, '/charging/' + resource_path))
+        return resource_path, url_fix(urljoin(site, '/charging/' + resource_path)), digest
 
     def _create_resource_model(self, provider, resource_data):
         # Create the resource
@@ -92,6 +99,7 @@ class AssetManager:
             version=resource_data['version'],
             download_link=resource_data['link'],
             resource_path=resource_data['content_path'],
+            content_hash=resource_data['content_hash'],
             content_type=resource_data['content_type'].lower(),
             resource_type=resource_data['resource_type'],
             state=resource_data['state'],
@@ -176,7 +184,8 @@ class AssetManager:
             'resource_type': data.get('resourceType', ''),
             'state': '',
             'is_public': data.get('isPublic', False),
-            'content_path': ''
+            'content_path': '',
+            'content_hash': None
         }
 
         current_organization = provider.userprofile.current_organization
@@ -192,14 +201,15 @@ class AssetManager:
                 provided_as = 'URL'
 
             elif isinstance(data['content'], dict):
-                resource_data['content_path'], download_link = \
+                resource_data['content_path'], download_link, resource_data['content_hash'] = \
                     self._save_resource_file(current_organization.name, data['content'])
 
             else:
                 raise TypeError('content field has an unsupported type, expected string or object')
 
         elif file_ is not None:
-            resource_data['content_path'], download_link = self._save_resource_file(current_organization.name, file_)
+            resource_data['content_path'], download_link, resource_data['content_hash'] = self._save_resource_file(
+                current_organization.name, file_, checksum=data.get('checksum'))
 
         else:
             raise ValueError('The digital asset has not been provided')
@@ -235,6 +245,7 @@ class AssetManager:
         curr_version = ResourceVersion(
             version=asset.version,
             resource_path=asset.resource_path,
+            content_hash=asset.content_hash,
             download_link=asset.download_link,
             content_type=asset.content_type,
             meta_info=asset.meta_info
@@ -293,6 +304,7 @@ class AssetManager:
 
         asset.download_link = resource_data['link']
         asset.resource_path = resource_data['content_path']
+        asset.content_hash = resource_data['content_hash']
         asset.meta_info = resource_data['metadata']
         asset.content_type = resource_data['content_type']
         asset.state = 'upgrading'
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+import errno
+import os
+import uuid
+
+from pymongo import ASCENDING, ReturnDocument
+
+from django.conf import settings
+
+from wstore.store_commons.database import get_database_connection
+
+
+def _get_blob_path(digest):
+    return os.path.join(settings.MEDIA_ROOT, 'blobs', digest[:2], digest)
+
+
+def _get_reference(file_path):
+    # Files are referenced by their path in the media dir, which does not depend on the deployment dir
+    return os.path.relpath(file_path, settings.MEDIA_ROOT)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _link_blob(blob_path, file_path):
+    """
+    Replaces file_path with a hard link to the blob, the link is created with
+    a temporary name and renamed so file_path is replaced atomically
+    """
+    if os.path.samefile(blob_path, file_path):
+        return
+
+    tmp_path = os.path.join(os.path.dirname(file_path), '.link-' + uuid.uuid4().hex)
+    os.link(blob_path, tmp_path)
+
+    try:
+        os.rename(tmp_path, file_path)
+    except OSError:
+        _remove_file(tmp_path)
+        raise
+
+
+def _share_content(digest, file_path):
+    blob_path = _get_blob_path(digest)
+
+    try:
+        os.makedirs(os.path.dirname(blob_path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    while True:
+        try:
+            # If the content has not been stored before, the file becomes the blob
+            os.link(file_path, blob_path)
+            return
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                # The file system does not support hard links, so the file is kept as a copy
+                return
+
+        try:
+            _link_blob(blob_path, file_path)
+            return
+        except OSError as e:
+            # The blob has been collected meanwhile, so it is created again
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def store_asset_file(digest, file_path):
+    """
+    Stores the content of an asset file in the blob identified by its digest. Files with
+    the same content are hard links to the same blob, so the content is stored only once
+    :param digest: SHA-256 hex digest of the file content
+    :param file_path: Path of the asset file, which is replaced by a link to the blob
+    """
+    db = get_database_connection()
+    reference = _get_reference(file_path)
+
+    # The reference is registered before linking the file so the blob is not collected meanwhile
+    db.wstore_asset_blobs.update_one({'_id': digest}, {
+        '$addToSet': {'refs': reference},
+        '$setOnInsert': {'size': os.path.getsize(file_path)}
+    }, upsert=True)
+
+    # A file references a single blob, so the references of a replaced file are removed
+    for blob in db.wstore_asset_blobs.find({'refs': reference, '_id': {'$ne': digest}}, {'_id': True}):
+        _release_blob(db, blob['_id'], reference)
+
+    _share_content(digest, file_path)
+
+
+def _release_blob(db, digest, reference):
+    blob = db.wstore_asset_blobs.find_one_and_update(
+        {'_id': digest}, {'$pull': {'refs': reference}}, return_document=ReturnDocument.AFTER)
+
+    if blob is not None and not len(blob['refs']):
+        _collect_blob(db, digest)
+
+
+def release_asset_file(file_path):
+    """
+    Removes the reference of a deleted asset file, the blob is removed
+    when it is not referenced by any other file
+    :param file_path: Path of the asset file
+    """
+    db = get_database_connection()
+    reference = _get_reference(file_path)
+
+    blob = db.wstore_asset_blobs.find_one({'refs': reference}, {'_id': True})
+    if blob is not None:
+        _release_blob(db, blob['_id'], reference)
+
+
+def _collect_blob(db, digest):
+    # The blob is only removed if no reference has been added meanwhile
+    if db.wstore_asset_blobs.delete_one({'_id': digest, 'refs': {'$size': 0}}).deleted_count:
+        _remove_file(_get_blob_path(digest))
+        return True
+
+    return False
+
+
+def collect_garbage():
+    """
+    Removes the references of asset files which no longer exist and
+    the blobs which are not referenced by any file
+    :return: Number of removed blobs
+    """
+    db = get_database_connection()
+
+    for blob in db.wstore_asset_blobs.find({}, {'refs': True}):
+        missing = [ref for ref in blob['refs'] if not os.path.exists(os.path.join(settings.MEDIA_ROOT, ref))]
+
+        if len(missing):
+            db.wstore_asset_blobs.update_one({'_id': blob['_id']}, {'$pull': {'refs': {'$in': missing}}})
+
+    collected = 0
+    for blob in db.wstore_asset_blobs.find({'refs': {'$size': 0}}, {'_id': True}):
+        if _collect_blob(db, blob['_id']):
+            collected += 1
+
+    return collected
+
+
+def ensure_blob_index():
+    db = get_database_connection()
+    db.wstore_asset_blobs.create_index([('refs', ASCENDING)])
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+import threading
+
+from wstore.ordering.models import Offering
+from wstore.asset_manager.models import Resource
+
+
+_local = threading.local()
+
+
+class BundleResolver(object):
+    """
+    Resolves the offerings and assets included in bundles using a single query
+    per type of entity. Resolved entities are memoized by the resolver
+    """
+
+    def __init__(self):
+        self._offerings = {}
+        self._resources = {}
+
+    def _resolve(self, model, cache, pks):
+        missing = list(set([pk for pk in pks if pk not in cache]))
+
+        if len(missing):
+            for entity in model.objects.filter(pk__in=missing):
+                cache[entity.pk] = entity
+
+        for pk in pks:
+            if pk not in cache:
+                raise model.DoesNotExist('The entity ' + unicode(pk) + ' does not exist')
+
+        return [cache[pk] for pk in pks]
+
+    def get_offerings(self, pks):
+        return self._resolve(Offering, self._offerings, pks)
+
+    def get_resources(self, pks):
+        return self._resolve(Resource, self._resources, pks)
+
+    def get_offering_assets(self, offering):
+        """
+        Returns the digital assets of an offering, including the ones of its bundled offerings
+        """
+        if len(offering.bundled_offerings) > 0:
+            offerings = [off for off in self.get_offerings(offering.bundled_offerings) if off.is_digital]
+        elif offering.is_digital:
+            offerings = [offering]
+        else:
+            offerings = []
+
+        return self.get_resources([off.asset_id for off in offerings])
+
+    def expand_assets(self, assets):
+        """
+        Replaces the bundle assets of the given list with the assets they include
+        """
+        # All the bundled assets are retrieved with a single query
+        self.get_resources([pk for asset in assets for pk in asset.bundled_assets])
+
+        expanded_assets = []
+        for asset in assets:
+            if len(asset.bundled_assets) > 0:
+                expanded_assets.extend(self.get_resources(asset.bundled_assets))
+            else:
+                expanded_assets.append(asset)
+
+        return expanded_assets
+
+
+def start_request_scope():
+    """
+    Makes the entities resolved while processing a request to be shared by all the
+    resolvers used by the request thread
+    """
+    _local.resolver = BundleResolver()
+
+
+def end_request_scope():
+    _local.resolver = None
+
+
+def get_bundle_resolver():
+    """
+    Returns the resolver of the request being processed by the thread, or a new
+    resolver if the thread is not processing a request
+    """
+    resolver = getattr(_local, 'resolver', None)
+    return resolver if resolver is not None else BundleResolver()
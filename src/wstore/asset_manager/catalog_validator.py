@@ -22,6 +22,10 @@
 from __future__ import unicode_literals
 
 from wstore.asset_manager.errors import ProductError
+from wstore.store_commons.download_cache import invalidate_downloads
+
+# Actions which modify existing catalog entities, cached copies must be discarded
+MODIFYING_ACTIONS = ('update', 'upgrade', 'rollback_upgrade', 'attach_upgrade', 'delete')
 
 
 class CatalogValidator:
@@ -121,3 +125,8 @@ class CatalogValidator:
             raise ValueError(msg)
 
         validators[action](provider, catalog_element)
+
+        # The catalog change may be committed after the validation, so the invalidation
+        # holds the caching of downloaded documents for a while
+        if action in MODIFYING_ACTIONS:
+            invalidate_downloads()
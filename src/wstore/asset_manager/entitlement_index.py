@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+from datetime import datetime
+from pymongo import ASCENDING, UpdateOne
+
+from django.core.exceptions import ObjectDoesNotExist
+
+from wstore.asset_manager.bundle_resolver import BundleResolver, get_bundle_resolver
+from wstore.store_commons.database import get_database_connection
+
+
+def _get_contract_assets(resolver, contract):
+    assets = resolver.get_offering_assets(contract.offering)
+    return set([unicode(asset.pk) for asset in resolver.expand_assets(assets)])
+
+
+def _get_grant_operations(resolver, organization, order, contracts, time_stamp):
+    operations = []
+
+    for contract in contracts:
+        try:
+            assets = _get_contract_assets(resolver, contract)
+        except ObjectDoesNotExist:
+            # The offering or its assets have been removed
+            continue
+
+        for asset in assets:
+            entitlement = {
+                'organization': unicode(organization.pk),
+                'asset': asset,
+                'order': unicode(order.pk),
+                'contract': contract.item_id
+            }
+            operations.append(UpdateOne(entitlement, {'$set': {'updated': time_stamp}}, upsert=True))
+
+    return operations
+
+
+def grant_entitlements(order, contracts):
+    """
+    Allows the owner organization of an order to download the assets of the given contracts
+    :param order: Order including the contracts
+    :param contracts: List of acquired contracts
+    """
+    operations = _get_grant_operations(
+        get_bundle_resolver(), order.owner_organization, order, contracts, datetime.utcnow())
+
+    if len(operations):
+        db = get_database_connection()
+        db.wstore_entitlements.bulk_write(operations, ordered=False)
+
+
+def revoke_entitlements(order, contract):
+    """
+    Removes the download permissions given by a contract, the organization keeps
+    the access to the assets included in other contracts
+    :param order: Order including the contract
+    :param contract: Terminated contract
+    """
+    db = get_database_connection()
+    db.wstore_entitlements.delete_many({
+        'order': unicode(order.pk),
+        'contract': contract.item_id
+    })
+
+
+def has_entitlement(organization, asset):
+    """
+    Checks whether an organization has acquired a digital asset
+    """
+    db = get_database_connection()
+    return db.wstore_entitlements.find_one({
+        'organization': unicode(organization.pk),
+        'asset': unicode(asset.pk)
+    }, {'_id': True}) is not None
+
+
+def rebuild_entitlements(orders):
+    """
+    Builds the entitlements of the given orders, removing any other existing entitlement.
+    Only the contracts whose offering has been acquired by the organization are included
+    :param orders: Iterable with all the orders
+    :return: Number of entitlements
+    """
+    db = get_database_connection()
+    time_stamp = datetime.utcnow()
+
+    # Offerings and assets are shared by many orders, so they are resolved once
+    resolver = BundleResolver()
+
+    count = 0
+    for order in orders:
+        organization = order.owner_organization
+        if organization is None:
+            continue
+
+        acquired = set(organization.acquired_offerings)
+        contracts = [contract for contract in order.contracts
+                     if not contract.terminated and contract.offering_id in acquired]
+
+        operations = _get_grant_operations(resolver, organization, order, contracts, time_stamp)
+        if len(operations):
+            db.wstore_entitlements.bulk_write(operations, ordered=False)
+            count += len(operations)
+
+    # Entitlements granted while rebuilding the index are newer than the time stamp
+    db.wstore_entitlements.delete_many({'updated': {'$lt': time_stamp}})
+
+    return count
+
+
+def ensure_entitlement_index():
+    db = get_database_connection()
+    db.wstore_entitlements.create_index([
+        ('organization', ASCENDING), ('asset', ASCENDING), ('order', ASCENDING), ('contract', ASCENDING)
+    ], unique=True)
+    db.wstore_entitlements.create_index([('order', ASCENDING), ('contract', ASCENDING)])
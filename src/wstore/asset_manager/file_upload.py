@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+import base64
+import fcntl
+import hashlib
+import os
+import re
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+
+from wstore.store_commons.errors import ConflictError
+
+
+_WHITESPACE = re.compile(r'\s+')
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _get_file_mode():
+    # The umask can only be read by replacing it, so it is read once when the module is loaded
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# Mode of the stored files, the one they would have if created with open, so they
+# can be read by the web server when it is running as a different user
+_FILE_MODE = _get_file_mode()
+
+
+class Base64Decoder(object):
+    """
+    Decodes base64 content received in pieces. The characters which do not
+    complete a 4 characters quantum are kept until the next piece is received
+    """
+
+    def __init__(self):
+        self._pending = ''
+
+    def decode(self, data):
+        data = self._pending + _WHITESPACE.sub('', data)
+        size = len(data) - len(data) % 4
+
+        self._pending = data[size:]
+        return base64.b64decode(data[:size])
+
+    def finish(self):
+        # Incomplete content raises the same error as decoding it at once
+        pending, self._pending = self._pending, ''
+        return base64.b64decode(pending) if pending else b''
+
+
+def iter_base64_content(data, chunk_size=None):
+    """
+    Decodes base64 encoded content in chunks of approximately chunk_size bytes
+    """
+    chunk_size = chunk_size or settings.ASSET_UPLOAD_CHUNK_SIZE
+    step = max(chunk_size // 3, 1) * 4
+
+    decoder = Base64Decoder()
+    for i in range(0, len(data), step):
+        chunk = decoder.decode(data[i:i + step])
+        if chunk:
+            yield chunk
+
+    chunk = decoder.finish()
+    if chunk:
+        yield chunk
+
+
+def iter_file_content(file_, chunk_size=None):
+    chunk_size = chunk_size or settings.ASSET_UPLOAD_CHUNK_SIZE
+
+    file_.seek(0)
+    while True:
+        chunk = file_.read(chunk_size)
+        if not chunk:
+            break
+
+        yield chunk
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _check_digest(digest, checksum):
+    if checksum is not None and digest.hexdigest() != checksum.lower():
+        raise ValueError('The checksum of the uploaded file does not match its content')
+
+
+def _get_file_digest(path):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for chunk in iter_file_content(f):
+            digest.update(chunk)
+
+    return digest
+
+
+def get_file_digest(path):
+    """
+    Returns the SHA-256 hex digest of a stored file, reading it in chunks
+    """
+    return _get_file_digest(path).hexdigest()
+
+
+def save_upload(chunks, file_path, checksum=None):
+    """
+    Writes the uploaded chunks to a temporary file which is moved to file_path once
+    completed, so a partial upload is never visible at the final location
+    :param chunks: Iterable with the file content
+    :param file_path: Final location of the file
+    :param checksum: Optional SHA-256 hex digest the content must match
+    :return: SHA-256 hex digest of the content
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix='.upload-')
+    digest = hashlib.sha256()
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                digest.update(chunk)
+                f.write(chunk)
+
+        _check_digest(digest, checksum)
+
+        # Temporary files are only readable by their owner
+        os.chmod(tmp_path, _FILE_MODE)
+        os.rename(tmp_path, file_path)
+    except Exception:
+        _remove_file(tmp_path)
+        raise
+
+    return digest.hexdigest()
+
+
+def _get_uploads_dir(provider):
+    return os.path.join(settings.MEDIA_ROOT, 'uploads', provider)
+
+
+def _get_upload_path(provider, upload_id):
+    path = os.path.join(_get_uploads_dir(provider), '{}.part'.format(upload_id))
+
+    if not _UPLOAD_ID.match(upload_id) or not os.path.isfile(path):
+        raise ObjectDoesNotExist('The specified upload does not exist')
+
+    return path
+
+
+def _remove_expired_uploads(uploads_dir):
+    expiry = time.time() - settings.ASSET_UPLOAD_EXPIRY
+
+    for file_name in os.listdir(uploads_dir):
+        path = os.path.join(uploads_dir, file_name)
+        try:
+            if os.path.getmtime(path) < expiry:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def create_upload(provider):
+    """
+    Starts a resumable upload, whose content is sent in several requests
+    :param provider: Name of the organization uploading the file
+    :return: Id of the new upload
+    """
+    uploads_dir = _get_uploads_dir(provider)
+
+    if not os.path.isdir(uploads_dir):
+        os.makedirs(uploads_dir)
+    else:
+        _remove_expired_uploads(uploads_dir)
+
+    upload_id = uuid.uuid4().hex
+    open(os.path.join(uploads_dir, '{}.part'.format(upload_id)), 'wb').close()
+
+    return upload_id
+
+
+def get_upload_offset(provider, upload_id):
+    """
+    Returns the number of bytes already received, where the upload has to be resumed
+    """
+    return os.path.getsize(_get_upload_path(provider, upload_id))
+
+
+def append_upload_chunk(provider, upload_id, offset, chunks):
+    """
+    Appends content to a resumable upload
+    :param offset: Position of the content in the file, it must match the bytes already received
+    :param chunks: Iterable with the content
+    :return: The new offset of the upload
+    """
+    path = _get_upload_path(provider, upload_id)
+
+    with open(path, 'ab') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            raise ConflictError('The upload is being written by another request')
+
+        f.seek(0, os.SEEK_END)
+        if f.tell() != offset:
+            raise ValueError('Invalid upload offset, {} bytes have been received'.format(f.tell()))
+
+        for chunk in chunks:
+            f.write(chunk)
+
+        return f.tell()
+
+
+def remove_upload(provider, upload_id):
+    os.remove(_get_upload_path(provider, upload_id))
+
+
+def complete_upload(provider, upload_id, file_path, checksum=None):
+    """
+    Moves the content of a resumable upload to file_path
+    :return: SHA-256 hex digest of the content
+    """
+    path = _get_upload_path(provider, upload_id)
+    digest = _get_file_digest(path)
+
+    _check_digest(digest, checksum)
+    os.chmod(path, _FILE_MODE)
+    os.rename(path, file_path)
+
+    return digest.hexdigest()
@@ -21,7 +21,6 @@
 from __future__ import unicode_literals
 
 import math
-import requests
 from requests.exceptions import HTTPError
 from threading import Thread
 
@@ -32,6 +31,7 @@ from wstore.models import Context, Resource
 from wstore.ordering.inventory_client import InventoryClient
 from wstore.ordering.models import Order, Offering
 from wstore.store_commons.database import DocumentLock
+from wstore.store_commons import http_client
 
 
 PAGE_LEN = 100.0
@@ -49,7 +49,7 @@ class InventoryUpgrader(Thread):
             prod_url = '{}/api/catalogManagement/v2/productSpecification/{}?fields=name'\
                 .format(settings.CATALOG, self._asset.product_id)
 
-            resp = requests.get(prod_url)
+            resp = http_client.get(prod_url)
             resp.raise_for_status()
 
             self._product_name = resp.json()['name']
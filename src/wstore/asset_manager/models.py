@@ -34,6 +34,7 @@ from wstore.models import Organization
 class ResourceVersion(models.Model):
     version = models.CharField(max_length=20)
     resource_path = models.CharField(max_length=100)
+    content_hash = models.CharField(max_length=64, blank=True, null=True)  # Blob storing the file content
     download_link = models.URLField()
     content_type = models.CharField(max_length=100)
     meta_info = DictField()
@@ -46,6 +47,7 @@ class Resource(models.Model):
     content_type = models.CharField(max_length=100)
     download_link = models.URLField()
     resource_path = models.CharField(max_length=100)
+    content_hash = models.CharField(max_length=64, blank=True, null=True)  # Blob storing the file content
     old_versions = ListField(EmbeddedModelField(ResourceVersion))
     state = models.CharField(max_length=20)
     resource_type = models.CharField(max_length=100, blank=True, null=True)
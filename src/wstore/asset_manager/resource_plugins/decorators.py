@@ -21,12 +21,20 @@
 
 from __future__ import unicode_literals
 
+import threading
+import time
 from functools import wraps
 
+from django.conf import settings
+
 from wstore.models import ResourcePlugin
-from wstore.ordering.models import Offering
 from wstore.asset_manager.models import Resource
 from wstore.asset_manager.errors import ProductError
+from wstore.asset_manager.bundle_resolver import get_bundle_resolver
+from wstore.store_commons.database import get_database_connection
+
+
+VERSION_ID = 'version'
 
 
 def _get_plugin_model(name):
@@ -39,7 +47,7 @@ def _get_plugin_model(name):
     return plugin_model
 
 
-def load_plugin_module(asset_t):
+def _build_plugin(asset_t):
     plugin_model = _get_plugin_model(asset_t)
     module = plugin_model.module
     module_class_name = module.split('.')[-1]
@@ -50,6 +58,101 @@ def load_plugin_module(asset_t):
     return module_class(plugin_model)
 
 
+def _get_registry_version():
+    db = get_database_connection()
+    stamp = db.wstore_plugin_registry.find_one({'_id': VERSION_ID})
+
+    return stamp['value'] if stamp is not None else 0
+
+
+class PluginRegistry(object):
+    """
+    Process wide registry of the plugin instances by asset type. The version stamp
+    stored in the database, updated when plugins are installed or removed, is checked
+    at most every PLUGIN_REGISTRY_CHECK_INTERVAL seconds
+    """
+
+    def __init__(self):
+        self._plugins = {}
+        self._version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self._lock:
+            self._plugins.clear()
+
+            # The version stamp is read again on the next lookup
+            self._version = None
+            self._checked_at = 0
+
+    def _get_version(self):
+        now = time.time()
+
+        with self._lock:
+            if self._version is not None and now - self._checked_at < settings.PLUGIN_REGISTRY_CHECK_INTERVAL:
+                return self._version
+
+        version = _get_registry_version()
+
+        with self._lock:
+            if version != self._version:
+                self._plugins.clear()
+                self._version = version
+
+            self._checked_at = now
+
+        return version
+
+    def get(self, asset_t):
+        version = self._get_version()
+
+        with self._lock:
+            plugin = self._plugins.get(asset_t)
+
+            if plugin is not None:
+                self.hits += 1
+                return plugin
+
+            self.misses += 1
+
+        plugin = _build_plugin(asset_t)
+
+        with self._lock:
+            # The registry may have been invalidated while loading the plugin
+            if version == self._version:
+                self._plugins[asset_t] = plugin
+
+        return plugin
+
+
+_registry = PluginRegistry()
+
+
+def invalidate_plugin_registry():
+    """
+    Invalidates the plugins loaded by all the processes
+    """
+    db = get_database_connection()
+    db.wstore_plugin_registry.update_one({'_id': VERSION_ID}, {'$inc': {'value': 1}}, upsert=True)
+
+    _registry.clear()
+
+
+def get_plugin_registry_stats():
+    return {
+        'hits': _registry.hits,
+        'misses': _registry.misses
+    }
+
+
+def load_plugin_module(asset_t):
+    return _registry.get(asset_t)
+
+
 def on_product_spec_validation(func):
 
     @wraps(func)
@@ -115,34 +218,25 @@ def on_product_spec_upgrade(func):
     return wrapper
 
 
-def _expand_bundled_assets(offering_assets):
-    assets = []
-    for off_asset in offering_assets:
-        if len(off_asset.bundled_assets) > 0:
-            for bundled_asset_pk in off_asset.bundled_assets:
-                assets.append(Resource.objects.get(pk=bundled_asset_pk))
-        else:
-            assets.append(off_asset)
-
-    return assets
-
-
 def on_product_offering_validation(func):
 
     @wraps(func)
     def wrapper(self, provider, product_offering, bundled_offerings):
 
+        resolver = get_bundle_resolver()
+
         offering_assets = []
         if len(bundled_offerings) > 0:
             # Get bundled offerings assets
-            offering_assets = [offering.asset for offering in bundled_offerings if offering.is_digital]
+            offering_assets = resolver.get_resources(
+                [offering.asset_id for offering in bundled_offerings if offering.is_digital])
         else:
             # Get offering asset
             asset = Resource.objects.filter(product_id=product_offering['productSpecification']['id'])
             offering_assets.extend(asset)
 
         # Get the effective assets
-        assets = _expand_bundled_assets(offering_assets)
+        assets = resolver.expand_assets(offering_assets)
 
         for asset in assets:
             plugin_module = load_plugin_module(asset.resource_type)
@@ -170,16 +264,11 @@ def _execute_asset_event(asset, order, contract, type_):
 
 
 def process_product_notification(order, contract, type_):
-    # Get digital asset from the contract
-    offering_assets = []
-    if len(contract.offering.bundled_offerings) > 0:
-        offering_assets = [Offering.objects.get(pk=key).asset
-                           for key in contract.offering.bundled_offerings if Offering.objects.get(pk=key).is_digital]
+    resolver = get_bundle_resolver()
 
-    elif contract.offering.is_digital:
-        offering_assets = [contract.offering.asset]
-
-    assets = _expand_bundled_assets(offering_assets)
+    # Get digital asset from the contract
+    offering_assets = resolver.get_offering_assets(contract.offering)
+    assets = resolver.expand_assets(offering_assets)
 
     for event_asset in assets:
         _execute_asset_event(event_asset, order, contract, type_)
@@ -21,11 +21,29 @@
 
 from __future__ import unicode_literals
 
+from bson import ObjectId
 from copy import deepcopy
+from pymongo import ASCENDING
 from requests.exceptions import HTTPError
 
 from wstore.asset_manager.resource_plugins.plugin_error import PluginError
 from wstore.charging_engine.accounting.usage_client import UsageClient
+from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.worker import get_thread_pool
+
+_index_ready = False
+
+
+def ensure_usage_refresh_index():
+    global _index_ready
+
+    db = get_database_connection()
+    db.wstore_usage_refresh.create_index([('order', ASCENDING), ('product', ASCENDING), ('correlation', ASCENDING)])
+    _index_ready = True
+
+
+def _get_fingerprint(usage_record):
+    return '{}|{}|{}'.format(usage_record['date'], usage_record['unit'], usage_record['value'])
 
 
 class Plugin(object):
@@ -127,11 +145,73 @@ class Plugin(object):
     def get_pending_accounting(self, asset, contract, order):
         return []
 
+    def _build_usage(self, usage_template, usage_record, correlation_number):
+        usage = deepcopy(usage_template)
+
+        usage['date'] = usage_record['date']
+
+        usage['usageSpecification'] = {
+            'href': self._model.options['usage'][usage_record['unit']],
+            'name': usage_record['unit']
+        }
+
+        usage['usageCharacteristic'].append({
+            'name': 'unit',
+            'value': usage_record['unit']
+        })
+
+        usage['usageCharacteristic'].append({
+            'name': 'correlationNumber',
+            'value': correlation_number
+        })
+
+        usage['usageCharacteristic'].append({
+            'name': 'value',
+            'value': usage_record['value']
+        })
+
+        return usage
+
+    def _assign_correlation_numbers(self, db, query, pending_accounting, contract):
+        # Progress of the refreshes already saved in the contract is not needed anymore
+        db.wstore_usage_refresh.delete_many(dict(query, correlation={'$lt': contract.correlation_number}))
+
+        # Records submitted by an interrupted refresh keep their correlation number
+        submitted = {}
+        next_number = contract.correlation_number
+        for progress in db.wstore_usage_refresh.find(query).sort('correlation', ASCENDING):
+            submitted.setdefault(progress['fingerprint'], []).append(progress)
+            next_number = progress['correlation'] + 1
+
+        records = []
+        new_progress = []
+        for usage_record in pending_accounting:
+            fingerprint = _get_fingerprint(usage_record)
+
+            if len(submitted.get(fingerprint, [])):
+                progress = submitted[fingerprint].pop(0)
+            else:
+                progress = dict(query, _id=ObjectId(), correlation=next_number, fingerprint=fingerprint, usage=None)
+                new_progress.append(progress)
+                next_number += 1
+
+            records.append((usage_record, progress))
+
+        if len(new_progress):
+            db.wstore_usage_refresh.insert_many(new_progress)
+
+        return records, next_number
+
     def on_usage_refresh(self, asset, contract, order):
         if not self._model.pull_accounting:
             return
 
         pending_accounting, last_usage = self.get_pending_accounting(asset, contract, order)
+
+        for usage_record in pending_accounting:
+            if 'date' not in usage_record or 'unit' not in usage_record or 'value' not in usage_record:
+                raise PluginError('Invalid usage record, it must include date, unit and value')
+
         usage_template = {
             'type': 'event',
             'status': 'Received',
@@ -150,42 +230,42 @@ class Plugin(object):
         }
 
         usage_client = UsageClient()
-        for usage_record in pending_accounting:
-            if 'date' not in usage_record or 'unit' not in usage_record or 'value' not in usage_record:
-                raise PluginError('Invalid usage record, it must include date, unit and value')
+        db = get_database_connection()
+        query = {
+            'order': order.order_id,
+            'product': contract.product_id
+        }
 
-            # Generate a TMForum usage document for each usage record
-            usage = deepcopy(usage_template)
+        if len(pending_accounting):
+            # The index is created by the first refresh of the process
+            if not _index_ready:
+                ensure_usage_refresh_index()
 
-            usage['date'] = usage_record['date']
+            # Correlation numbers are assigned in the order of the records, so they can be submitted concurrently
+            records, next_number = self._assign_correlation_numbers(db, query, pending_accounting, contract)
 
-            usage['usageSpecification'] = {
-                'href': self._model.options['usage'][usage_record['unit']],
-                'name': usage_record['unit']
-            }
+            def submit(record):
+                usage_record, progress = record
+                usage_id = progress['usage']
 
-            usage['usageCharacteristic'].append({
-                'name': 'unit',
-                'value': usage_record['unit']
-            })
+                if usage_id is None:
+                    usage_doc = usage_client.create_usage(
+                        self._build_usage(usage_template, usage_record, progress['correlation']))
 
-            usage['usageCharacteristic'].append({
-                'name': 'correlationNumber',
-                'value': contract.correlation_number
-            })
+                    usage_id = usage_doc['id']
+                    db.wstore_usage_refresh.update_one({'_id': progress['_id']}, {'$set': {'usage': usage_id}})
 
-            usage['usageCharacteristic'].append({
-                'name': 'value',
-                'value': usage_record['value']
-            })
+                # All the  information is known so the document is directly created in Guided state
+                usage_client.update_usage_state(usage_id, 'Guided')
 
-            usage_doc = usage_client.create_usage(usage)
-            # All the  information is known so the document is directly created in Guided state
-            usage_client.update_usage_state(usage_doc['id'], 'Guided')
+            # If a record fails the order is not saved, so the next refresh resumes the submission
+            get_thread_pool('usage_refresh', 'USAGE_REFRESH_WORKERS').map(submit, records)
 
-            contract.correlation_number += 1
-            order.save()
+            contract.correlation_number = next_number
 
         if last_usage is not None:
             contract.last_usage = last_usage
+
+        if len(pending_accounting) or last_usage is not None:
             order.save()
+            db.wstore_usage_refresh.delete_many(query)
@@ -34,6 +34,7 @@ from wstore.asset_manager.resource_plugins.plugin_error import PluginError
 from wstore.asset_manager.resource_plugins.plugin_rollback import installPluginRollback
 from wstore.models import ResourcePlugin, Resource
 from wstore.asset_manager.resource_plugins.plugin import Plugin
+from wstore.asset_manager.resource_plugins.decorators import invalidate_plugin_registry
 
 
 class PluginLoader(object):
@@ -142,6 +143,9 @@ class PluginLoader(object):
         if plugin_model.pull_accounting:
             module_class(plugin_model).configure_usage_spec()
 
+        # Processes which have loaded a previous plugin for the same asset type must load it again
+        invalidate_plugin_registry()
+
         return plugin_id
 
     def uninstall_plugin(self, plugin_id):
@@ -173,3 +177,4 @@ class PluginLoader(object):
 
         # Remove model
         plugin_model.delete()
+        invalidate_plugin_registry()
@@ -27,8 +27,10 @@ from requests.exceptions import HTTPError
 from shutil import rmtree
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 
+from wstore.asset_manager import bundle_resolver
 from wstore.asset_manager.resource_plugins import plugin
 from wstore.asset_manager.resource_plugins import decorators
 from wstore.asset_manager.resource_plugins.plugin_validator import PluginValidator
@@ -59,6 +61,7 @@ class PluginLoaderTestCase(TestCase):
         self.manager_mock.validate_plugin_info.return_value = None
 
         plugin_loader.PluginValidator.return_value = self.manager_mock
+        plugin_loader.invalidate_plugin_registry = MagicMock()
 
     def _remove_plugin_dir(self, plugin_name):
         plugin_dir = os.path.join(os.path.join('wstore', 'test'), plugin_name)
@@ -131,6 +134,7 @@ class PluginLoaderTestCase(TestCase):
             self.assertEquals(error, None)
             # Check calls
             self.manager_mock.validate_plugin_info.assert_called_once_with(expected)
+            plugin_loader.invalidate_plugin_registry.assert_called_once_with()
 
             # Check plugin model
             plugin_model = ResourcePlugin.objects.all()[0]
@@ -153,6 +157,7 @@ class PluginLoaderTestCase(TestCase):
         else:
             self.assertTrue(isinstance(error, err_type))
             self.assertEquals(unicode(e), err_msg)
+            self.assertEquals(0, plugin_loader.invalidate_plugin_registry.call_count)
 
     def _plugin_in_use(self):
         plugin_loader.Resource.objects.filter.return_value = ['resource']
@@ -206,6 +211,7 @@ class PluginLoaderTestCase(TestCase):
             plugin_loader.Resource.objects.filter.assert_called_once_with(resource_type=plugin_name)
             plugin_loader.rmtree.assert_called_once_with(os.path.join(plugin_l._plugins_path, 'test_plugin'))
             plugin_mock.delete.assert_called_once_with()
+            plugin_loader.invalidate_plugin_registry.assert_called_once_with()
 
             self.assertEquals(pull, plugin_mock.usage_called)
         else:
@@ -385,6 +391,17 @@ class PluginTestCase(TestCase):
         self._usage_client = MagicMock()
         plugin.UsageClient = MagicMock(return_value=self._usage_client)
 
+        self._db = MagicMock()
+        self._db.wstore_usage_refresh.find.return_value.sort.return_value = []
+        plugin.get_database_connection = MagicMock(return_value=self._db)
+
+        self._pool = MagicMock()
+        self._pool.map.side_effect = map
+        plugin.get_thread_pool = MagicMock(return_value=self._pool)
+
+    def tearDown(self):
+        reload(plugin)
+
     def _call_configured(self):
         self._model.options = self._option
 
@@ -525,7 +542,140 @@ class PluginTestCase(TestCase):
 
             self.assertEquals(1, contract.correlation_number)
             self.assertEquals(usages[1], contract.last_usage)
-            self.assertEquals([call(), call()], order.save.call_args_list)
+            order.save.assert_called_once_with()
+
+            # The progress of the refresh is tracked until the order is saved
+            self.assertEquals(1, self._db.wstore_usage_refresh.insert_many.call_count)
+            progress = self._db.wstore_usage_refresh.insert_many.call_args[0][0][0]
+            self.assertEquals(0, progress['correlation'])
+            self._db.wstore_usage_refresh.update_one.assert_called_once_with(
+                {'_id': progress['_id']}, {'$set': {'usage': '1'}})
+            self._db.wstore_usage_refresh.delete_many.assert_called_with({
+                'order': self._order_id,
+                'product': self._product_id
+            })
+        else:
+            self.assertEquals(0, order.save.call_count)
+
+    def _build_pending_usage(self, dates):
+        return [{
+            'date': date,
+            'unit': 'api call',
+            'value': 130
+        } for date in dates]
+
+    def test_usage_refresh_batch(self):
+        self._model.options = self._option
+        self._model.pull_accounting = True
+
+        self._usage_client.create_usage.side_effect = lambda usage: {
+            'id': 'usage' + unicode(usage['usageCharacteristic'][3]['value'])
+        }
+
+        plugin_handler = plugin.Plugin(self._model)
+        plugin_handler.get_pending_accounting = MagicMock(
+            return_value=(self._build_pending_usage(['2017-06-06', '2017-06-07', '2017-06-08']), '2017-06-08'))
+
+        asset, contract, order = self._mock_order()
+        contract.correlation_number = 5
+
+        plugin_handler.on_usage_refresh(asset, contract, order)
+
+        # Correlation numbers follow the order of the records
+        self.assertEquals([
+            ('2017-06-06', 5),
+            ('2017-06-07', 6),
+            ('2017-06-08', 7)
+        ], [(c[0][0]['date'], c[0][0]['usageCharacteristic'][3]['value'])
+            for c in self._usage_client.create_usage.call_args_list])
+
+        self.assertEquals(
+            [call('usage5', 'Guided'), call('usage6', 'Guided'), call('usage7', 'Guided')],
+            self._usage_client.update_usage_state.call_args_list)
+
+        self.assertEquals(1, self._pool.map.call_count)
+        self.assertEquals(8, contract.correlation_number)
+        order.save.assert_called_once_with()
+
+        # The progress index is only created by the first refresh
+        plugin_handler.on_usage_refresh(asset, contract, order)
+        self._db.wstore_usage_refresh.create_index.assert_called_once_with(
+            [('order', 1), ('product', 1), ('correlation', 1)])
+
+    def test_usage_refresh_resume(self):
+        self._model.options = self._option
+        self._model.pull_accounting = True
+
+        # The previous refresh created the first record and assigned the second one
+        self._db.wstore_usage_refresh.find.return_value.sort.return_value = [{
+            '_id': 'progress1',
+            'correlation': 5,
+            'fingerprint': '2017-06-06|api call|130',
+            'usage': 'usage5'
+        }, {
+            '_id': 'progress2',
+            'correlation': 6,
+            'fingerprint': '2017-06-07|api call|130',
+            'usage': None
+        }]
+        self._usage_client.create_usage.return_value = {'id': 'new'}
+
+        plugin_handler = plugin.Plugin(self._model)
+        plugin_handler.get_pending_accounting = MagicMock(
+            return_value=(self._build_pending_usage(['2017-06-06', '2017-06-07', '2017-06-08']), None))
+
+        asset, contract, order = self._mock_order()
+        contract.correlation_number = 5
+
+        plugin_handler.on_usage_refresh(asset, contract, order)
+
+        self._db.wstore_usage_refresh.delete_many.assert_any_call({
+            'order': self._order_id,
+            'product': self._product_id,
+            'correlation': {'$lt': 5}
+        })
+
+        # Only the not created records are submitted again
+        self.assertEquals([
+            ('2017-06-07', 6),
+            ('2017-06-08', 7)
+        ], [(c[0][0]['date'], c[0][0]['usageCharacteristic'][3]['value'])
+            for c in self._usage_client.create_usage.call_args_list])
+
+        self.assertEquals(
+            [call('usage5', 'Guided'), call('new', 'Guided'), call('new', 'Guided')],
+            self._usage_client.update_usage_state.call_args_list)
+
+        new_progress = self._db.wstore_usage_refresh.insert_many.call_args[0][0]
+        self.assertEquals([7], [progress['correlation'] for progress in new_progress])
+
+        self.assertEquals(8, contract.correlation_number)
+        order.save.assert_called_once_with()
+
+    def test_usage_refresh_interrupted(self):
+        self._model.options = self._option
+        self._model.pull_accounting = True
+
+        self._usage_client.create_usage.side_effect = [{'id': 'usage0'}, HTTPError()]
+
+        plugin_handler = plugin.Plugin(self._model)
+        plugin_handler.get_pending_accounting = MagicMock(
+            return_value=(self._build_pending_usage(['2017-06-06', '2017-06-07']), '2017-06-07'))
+
+        asset, contract, order = self._mock_order()
+
+        with self.assertRaises(HTTPError):
+            plugin_handler.on_usage_refresh(asset, contract, order)
+
+        # The progress is kept, and the contract is not saved
+        self.assertEquals(0, contract.correlation_number)
+        self.assertEquals(0, order.save.call_count)
+        self.assertEquals(1, self._db.wstore_usage_refresh.update_one.call_count)
+        self._db.wstore_usage_refresh.delete_many.assert_called_once_with({
+            'order': self._order_id,
+            'product': self._product_id,
+            'correlation': {'$lt': 0}
+        })
 
     def test_usage_refresh_error(self):
         plugin_handler = plugin.Plugin(self._model)
@@ -547,6 +697,71 @@ class PluginTestCase(TestCase):
         self.assertEquals(0, plugin_handler.get_pending_accounting.call_count)
 
 
+@override_settings(PLUGIN_REGISTRY_CHECK_INTERVAL=10)
+class PluginRegistryTestCase(TestCase):
+
+    tags = ('plugin', )
+
+    def setUp(self):
+        self._plugin_model = MagicMock(module='wstore.asset_manager.resource_plugins.tests.TestPlugin')
+        decorators.ResourcePlugin = MagicMock()
+        decorators.ResourcePlugin.objects.get.return_value = self._plugin_model
+
+        decorators.get_database_connection = MagicMock()
+        self._db = decorators.get_database_connection.return_value
+        self._db.wstore_plugin_registry.find_one.return_value = {'_id': 'version', 'value': 1}
+
+        decorators.time = MagicMock()
+        decorators.time.time.return_value = 100
+
+    def tearDown(self):
+        reload(decorators)
+
+    def test_plugin_cached(self):
+        plugin1 = decorators.load_plugin_module('asset')
+        plugin2 = decorators.load_plugin_module('asset')
+
+        self.assertTrue(isinstance(plugin1, TestPlugin))
+        self.assertTrue(plugin1 is plugin2)
+        self.assertEquals(self._plugin_model, plugin1._plugin_model)
+
+        decorators.ResourcePlugin.objects.get.assert_called_once_with(name='asset')
+        self.assertEquals(1, self._db.wstore_plugin_registry.find_one.call_count)
+        self.assertEquals({'hits': 1, 'misses': 1}, decorators.get_plugin_registry_stats())
+
+    def test_plugin_version_changed(self):
+        plugin1 = decorators.load_plugin_module('asset')
+
+        # Another process has installed a plugin, the stamp is checked once the interval has passed
+        self._db.wstore_plugin_registry.find_one.return_value = {'_id': 'version', 'value': 2}
+        decorators.time.time.return_value = 105
+        self.assertTrue(plugin1 is decorators.load_plugin_module('asset'))
+
+        decorators.time.time.return_value = 111
+        plugin2 = decorators.load_plugin_module('asset')
+
+        self.assertFalse(plugin1 is plugin2)
+        self.assertEquals(2, decorators.ResourcePlugin.objects.get.call_count)
+        self.assertEquals({'hits': 1, 'misses': 2}, decorators.get_plugin_registry_stats())
+
+    def test_plugin_registry_invalidated(self):
+        plugin1 = decorators.load_plugin_module('asset')
+
+        decorators.invalidate_plugin_registry()
+
+        self._db.wstore_plugin_registry.update_one.assert_called_once_with(
+            {'_id': 'version'}, {'$inc': {'value': 1}}, upsert=True)
+
+        self.assertFalse(plugin1 is decorators.load_plugin_module('asset'))
+        self.assertEquals(2, decorators.ResourcePlugin.objects.get.call_count)
+
+    def test_plugin_not_supported(self):
+        decorators.ResourcePlugin.objects.get.side_effect = Exception('Not found')
+
+        with self.assertRaises(decorators.ProductError):
+            decorators.load_plugin_module('asset')
+
+
 class DecoratorsTestCase(TestCase):
 
     tags = ('decorators', )
@@ -559,10 +774,11 @@ class DecoratorsTestCase(TestCase):
 
     def tearDown(self):
         reload(decorators)
+        reload(bundle_resolver)
 
-    def _get_offering_mock(self, bundle_asset=False):
-        offering = MagicMock(is_digital=True)
-        asset = MagicMock(resource_type='asset')
+    def _get_offering_mock(self, pk, bundle_asset=False):
+        offering = MagicMock(pk='off' + pk, is_digital=True, asset_id=pk, bundled_offerings=[])
+        asset = MagicMock(pk=pk, resource_type='asset')
 
         if bundle_asset:
             asset.bundled_assets = ['3', '4']
@@ -574,22 +790,29 @@ class DecoratorsTestCase(TestCase):
 
     def test_product_acquired(self):
         # Include order and contract info
-        offering1 = self._get_offering_mock()
-        offering2 = self._get_offering_mock()
-        offering3 = self._get_offering_mock(bundle_asset=True)
+        offering1 = self._get_offering_mock('1')
+        offering2 = self._get_offering_mock('2')
+        offering3 = self._get_offering_mock('5', bundle_asset=True)
 
-        decorators.Offering = MagicMock()
-        decorators.Offering.objects.get.side_effect = [offering1, offering1, offering2, offering2, offering3, offering3]
+        bundle_resolver.Offering = MagicMock()
+        bundle_resolver.Offering.objects.filter.return_value = [offering3, offering1, offering2]
 
-        decorators.Resource = MagicMock()
-        asset1 = MagicMock(resource_type='asset3')
-        asset2 = MagicMock(resource_type='asset4')
-        decorators.Resource.objects.get.side_effect = [asset1, asset2]
+        bundle_resolver.Resource = MagicMock()
+        asset1 = MagicMock(pk='3', resource_type='asset3')
+        asset2 = MagicMock(pk='4', resource_type='asset4')
+        bundle_resolver.Resource.objects.filter.side_effect = [
+            [offering1.asset, offering2.asset, offering3.asset], [asset2, asset1]]
 
-        self._contract.offering.bundled_offerings = ['1', '2', '3']
+        self._contract.offering.bundled_offerings = ['off1', 'off2', 'off5']
 
         decorators.on_product_acquired(self._order, self._contract)
 
+        # Bundled offerings and assets are retrieved with a query per type
+        bundle_resolver.Offering.objects.filter.assert_called_once_with(pk__in=['off1', 'off2', 'off5'])
+        self.assertEquals(2, bundle_resolver.Resource.objects.filter.call_count)
+        self.assertItemsEqual(['1', '2', '5'], bundle_resolver.Resource.objects.filter.call_args_list[0][1]['pk__in'])
+        self.assertItemsEqual(['3', '4'], bundle_resolver.Resource.objects.filter.call_args_list[1][1]['pk__in'])
+
         # Check calls
         self.assertEquals(
             [call('asset'), call('asset'), call('asset3'), call('asset4')], decorators.load_plugin_module.call_args_list)
@@ -602,7 +825,9 @@ class DecoratorsTestCase(TestCase):
             self._module.on_product_acquisition.call_args_list)
 
     def test_product_suspended(self):
-        self._contract.offering = self._get_offering_mock()
+        self._contract.offering = self._get_offering_mock('1')
+        bundle_resolver.Resource = MagicMock()
+        bundle_resolver.Resource.objects.filter.return_value = [self._contract.offering.asset]
 
         decorators.on_product_suspended(self._order, self._contract)
 
@@ -611,7 +836,9 @@ class DecoratorsTestCase(TestCase):
             self._contract.offering.asset, self._contract, self._order)
 
     def test_usage_refreshed(self):
-        self._contract.offering = self._get_offering_mock()
+        self._contract.offering = self._get_offering_mock('1')
+        bundle_resolver.Resource = MagicMock()
+        bundle_resolver.Resource.objects.filter.return_value = [self._contract.offering.asset]
 
         decorators.on_usage_refreshed(self._order, self._contract)
 
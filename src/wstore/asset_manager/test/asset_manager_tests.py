@@ -23,7 +23,7 @@ from __future__ import unicode_literals
 import urllib
 
 from copy import deepcopy
-from mock import MagicMock, mock_open
+from mock import MagicMock, ANY
 from nose_parameterized import parameterized
 
 from django.test import TestCase
@@ -176,23 +176,29 @@ class UploadAssetTestCase(TestCase):
         asset_manager.os.path.exists = MagicMock()
         asset_manager.os.path.exists.return_value = False
 
-        self.open_mock = mock_open()
-        self._old_open = asset_manager.__builtins__['open']
-        asset_manager.__builtins__['open'] = self.open_mock
+        # Mock file writing, the content chunks are stored for checking them
+        self._saved_content = []
+
+        def save_upload(chunks, file_path, checksum=None):
+            self._saved_content.append(b''.join(chunks))
+            return 'digest'
+
+        asset_manager.save_upload = MagicMock(side_effect=save_upload)
+        asset_manager.complete_upload = MagicMock(return_value='digest')
+        asset_manager.store_asset_file = MagicMock()
 
     def tearDown(self):
         import wstore.store_commons.rollback
         reload(wstore.store_commons.rollback)
 
         self._file = None
-        asset_manager.__builtins__['open'] = self._old_open
         reload(asset_manager)
 
     def _use_file(self):
         # Mock file
         self._file = MagicMock(name="example.wgt")
         self._file.name = "example.wgt"
-        self._file.read.return_value = "Test data content"
+        self._file.read.side_effect = ["Test data content", ""]
         asset_manager.os.path.isdir.return_value = False
         asset_manager.os.mkdir = MagicMock()
 
@@ -204,11 +210,14 @@ class UploadAssetTestCase(TestCase):
         asset_manager.os.path.exists.return_value = True
         self.res_mock.product_id = '1'
 
-    def _check_file_calls(self, file_name='example.wgt'):
+    def _check_file_calls(self, file_name='example.wgt', checksum=None):
         asset_manager.os.path.isdir.assert_called_once_with("/home/test/media/assets/test_user")
         asset_manager.os.path.exists.assert_called_once_with("/home/test/media/assets/test_user/{}".format(file_name))
-        self.open_mock.assert_called_once_with("/home/test/media/assets/test_user/{}".format(file_name), "wb")
-        self.open_mock().write.assert_called_once_with("Test data content")
+        asset_manager.save_upload.assert_called_once_with(
+            ANY, "/home/test/media/assets/test_user/{}".format(file_name), checksum=checksum)
+        asset_manager.store_asset_file.assert_called_once_with(
+            'digest', "/home/test/media/assets/test_user/{}".format(file_name))
+        self.assertEquals(["Test data content"], self._saved_content)
 
     @parameterized.expand([
         ('basic', UPLOAD_CONTENT),
@@ -274,6 +283,7 @@ class UploadAssetTestCase(TestCase):
                 version='',
                 download_link='http://testdomain.com/charging/media/assets/test_user/{}'.format(urllib.quote(file_name)),
                 resource_path='media/assets/test_user/{}'.format(file_name),
+                content_hash='digest',
                 content_type='application/x-widget',
                 resource_type='',
                 state='',
@@ -284,6 +294,58 @@ class UploadAssetTestCase(TestCase):
             self.assertTrue(isinstance(error, err_type))
             self.assertEquals(err_msg, unicode(error))
 
+    @parameterized.expand([
+        ('content', {
+            'contentType': 'application/x-widget',
+            'content': {
+                'name': 'example.wgt',
+                'data': 'VGVzdCBkYXRh\nIGNvbnRlbnQ=',
+                'checksum': 'abcdef'
+            }
+        }),
+        ('file', {'contentType': 'application/x-widget', 'checksum': 'abcdef'}, _use_file)
+    ])
+    @override_settings(MEDIA_ROOT='/home/test/media')
+    def test_upload_asset_checksum(self, name, data, side_effect=None):
+        if side_effect is not None:
+            side_effect(self)
+
+        am = asset_manager.AssetManager()
+        am.rollback_logger = {
+            'files': [],
+            'models': []
+        }
+
+        am.upload_asset(self._user, data, file_=self._file)
+
+        self._check_file_calls(checksum='abcdef')
+
+    @override_settings(MEDIA_ROOT='/home/test/media')
+    def test_upload_asset_resumable(self):
+        am = asset_manager.AssetManager()
+        am.rollback_logger = {
+            'files': [],
+            'models': []
+        }
+
+        am.upload_asset(self._user, {
+            'contentType': 'application/x-widget',
+            'content': {
+                'name': 'example.wgt',
+                'uploadId': '0123456789abcdef0123456789abcdef'
+            }
+        })
+
+        asset_manager.complete_upload.assert_called_once_with(
+            'test_user', '0123456789abcdef0123456789abcdef', '/home/test/media/assets/test_user/example.wgt', checksum=None)
+        asset_manager.store_asset_file.assert_called_once_with('digest', '/home/test/media/assets/test_user/example.wgt')
+        self.assertEquals(0, asset_manager.save_upload.call_count)
+
+        self.assertEquals({
+            'files': ['/home/test/media/assets/test_user/example.wgt'],
+            'models': [self.res_mock]
+        }, am.rollback_logger)
+
     def _mock_resource_type(self, form):
         asset_manager.ResourcePlugin = MagicMock()
         asset_manager.Resource.objects.filter.return_value = []
@@ -369,6 +431,7 @@ class UploadAssetTestCase(TestCase):
             version='',
             download_link=self.LINK,
             resource_path='',
+            content_hash=None,
             content_type='application/json',
             resource_type='service',
             state='',
@@ -485,6 +548,7 @@ class UploadAssetTestCase(TestCase):
             product_id='2',
             is_public=False,
             resource_path=prev_path,
+            content_hash='prev_digest',
             download_link=prev_link,
             content_type=prev_type,
             version=prev_version,
@@ -519,6 +583,7 @@ class UploadAssetTestCase(TestCase):
 
         # Check resource creation
         self.assertEquals('media/assets/test_user/example.wgt', asset.resource_path)
+        self.assertEquals('digest', asset.content_hash)
         self.assertEquals('http://testdomain.com/charging/media/assets/test_user/example.wgt', asset.download_link)
         self.assertEquals('application/x-widget', asset.content_type)
         self.assertEquals('upgrading', asset.state)
@@ -529,6 +594,7 @@ class UploadAssetTestCase(TestCase):
         old_version = asset.old_versions[0]
 
         self.assertEquals(prev_path, old_version.resource_path)
+        self.assertEquals('prev_digest', old_version.content_hash)
         self.assertEquals(prev_link, old_version.download_link)
         self.assertEquals(prev_type, old_version.content_type)
         self.assertEquals(prev_version, old_version.version)
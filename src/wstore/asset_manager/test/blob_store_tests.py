@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+
+from mock import MagicMock, call
+from pymongo import ReturnDocument
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from wstore.asset_manager import blob_store
+
+
+DIGEST = 'abcdef0123456789'
+
+
+class BlobStoreTestCase(TestCase):
+
+    tags = ('asset-blobs', )
+
+    def setUp(self):
+        self._db = MagicMock()
+        self._db.wstore_asset_blobs.find.return_value = []
+        blob_store.get_database_connection = MagicMock(return_value=self._db)
+
+        self._media_root = tempfile.mkdtemp()
+        self._override = override_settings(MEDIA_ROOT=self._media_root)
+        self._override.enable()
+
+        os.makedirs(os.path.join(self._media_root, 'assets', 'test_user'))
+        self._blob_path = os.path.join(self._media_root, 'blobs', 'ab', DIGEST)
+
+    def tearDown(self):
+        self._override.disable()
+        shutil.rmtree(self._media_root)
+        reload(blob_store)
+
+    def _create_file(self, name, content=b'content'):
+        path = os.path.join(self._media_root, 'assets', 'test_user', name)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+        return path
+
+    def test_store_new_content(self):
+        path = self._create_file('example.wgt')
+
+        blob_store.store_asset_file(DIGEST, path)
+
+        # The file becomes the blob
+        self.assertTrue(os.path.samefile(self._blob_path, path))
+
+        self._db.wstore_asset_blobs.update_one.assert_called_once_with({'_id': DIGEST}, {
+            '$addToSet': {'refs': 'assets/test_user/example.wgt'},
+            '$setOnInsert': {'size': 7}
+        }, upsert=True)
+
+        self._db.wstore_asset_blobs.find.assert_called_once_with(
+            {'refs': 'assets/test_user/example.wgt', '_id': {'$ne': DIGEST}}, {'_id': True})
+
+    def test_store_existing_content(self):
+        path1 = self._create_file('example1.wgt')
+        path2 = self._create_file('example2.wgt')
+
+        blob_store.store_asset_file(DIGEST, path1)
+        blob_store.store_asset_file(DIGEST, path2)
+
+        # Both files are links to the same blob
+        self.assertTrue(os.path.samefile(self._blob_path, path1))
+        self.assertTrue(os.path.samefile(self._blob_path, path2))
+        self.assertEquals(3, os.stat(self._blob_path).st_nlink)
+
+        # Temporary links are not kept
+        self.assertEquals(['example1.wgt', 'example2.wgt'], sorted(os.listdir(os.path.dirname(path1))))
+
+        with open(path2, 'rb') as f:
+            self.assertEquals(b'content', f.read())
+
+    def test_store_already_stored(self):
+        path = self._create_file('example.wgt')
+
+        blob_store.store_asset_file(DIGEST, path)
+        blob_store.store_asset_file(DIGEST, path)
+
+        self.assertEquals(2, os.stat(self._blob_path).st_nlink)
+        self.assertEquals(['example.wgt'], os.listdir(os.path.dirname(path)))
+
+    def test_store_replaced_file(self):
+        path = self._create_file('example.wgt')
+        self._db.wstore_asset_blobs.find.return_value = [{'_id': 'old_digest'}]
+        self._db.wstore_asset_blobs.find_one_and_update.return_value = {'_id': 'old_digest', 'refs': []}
+        self._db.wstore_asset_blobs.delete_one.return_value = MagicMock(deleted_count=1)
+
+        blob_store.store_asset_file(DIGEST, path)
+
+        # The reference of the previous content of the file is removed, and its blob is collected
+        self._db.wstore_asset_blobs.find_one_and_update.assert_called_once_with(
+            {'_id': 'old_digest'}, {'$pull': {'refs': 'assets/test_user/example.wgt'}}, return_document=ReturnDocument.AFTER)
+        self._db.wstore_asset_blobs.delete_one.assert_called_once_with({'_id': 'old_digest', 'refs': {'$size': 0}})
+
+    def _release(self, refs, deleted=1):
+        path = self._create_file('example.wgt')
+        blob_store.store_asset_file(DIGEST, path)
+        os.remove(path)
+
+        self._db.wstore_asset_blobs.find_one.return_value = {'_id': DIGEST}
+        self._db.wstore_asset_blobs.find_one_and_update.return_value = {'_id': DIGEST, 'refs': refs}
+        self._db.wstore_asset_blobs.delete_one.return_value = MagicMock(deleted_count=deleted)
+
+        blob_store.release_asset_file(path)
+
+        self._db.wstore_asset_blobs.find_one.assert_called_once_with({'refs': 'assets/test_user/example.wgt'}, {'_id': True})
+        self._db.wstore_asset_blobs.find_one_and_update.assert_called_once_with(
+            {'_id': DIGEST}, {'$pull': {'refs': 'assets/test_user/example.wgt'}}, return_document=ReturnDocument.AFTER)
+
+    def test_release_last_reference(self):
+        self._release([])
+
+        self._db.wstore_asset_blobs.delete_one.assert_called_once_with({'_id': DIGEST, 'refs': {'$size': 0}})
+        self.assertFalse(os.path.exists(self._blob_path))
+
+    def test_release_shared_blob(self):
+        self._release(['assets/test_user/other.wgt'])
+
+        self.assertEquals(0, self._db.wstore_asset_blobs.delete_one.call_count)
+        self.assertTrue(os.path.exists(self._blob_path))
+
+    def test_release_referenced_meanwhile(self):
+        self._release([], deleted=0)
+
+        self.assertTrue(os.path.exists(self._blob_path))
+
+    def test_release_not_stored(self):
+        self._db.wstore_asset_blobs.find_one.return_value = None
+
+        blob_store.release_asset_file(os.path.join(self._media_root, 'assets', 'test_user', 'example.wgt'))
+
+        self.assertEquals(0, self._db.wstore_asset_blobs.find_one_and_update.call_count)
+
+    def test_collect_garbage(self):
+        path = self._create_file('example.wgt')
+        blob_store.store_asset_file(DIGEST, path)
+        os.remove(path)
+
+        self._db.wstore_asset_blobs.reset_mock()
+        self._db.wstore_asset_blobs.find.side_effect = [
+            [{'_id': DIGEST, 'refs': ['assets/test_user/example.wgt']}, {'_id': 'digest2', 'refs': ['assets/test_user/other.wgt']}],
+            [{'_id': DIGEST}]
+        ]
+        self._create_file('other.wgt')
+        self._db.wstore_asset_blobs.delete_one.return_value = MagicMock(deleted_count=1)
+
+        self.assertEquals(1, blob_store.collect_garbage())
+
+        # Only the references of missing files are removed
+        self._db.wstore_asset_blobs.update_one.assert_called_once_with(
+            {'_id': DIGEST}, {'$pull': {'refs': {'$in': ['assets/test_user/example.wgt']}}})
+        self.assertEquals([
+            call({}, {'refs': True}),
+            call({'refs': {'$size': 0}}, {'_id': True})
+        ], self._db.wstore_asset_blobs.find.call_args_list)
+
+        self._db.wstore_asset_blobs.delete_one.assert_called_once_with({'_id': DIGEST, 'refs': {'$size': 0}})
+        self.assertFalse(os.path.exists(self._blob_path))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+from mock import MagicMock
+
+from django.test import TestCase
+
+from wstore.asset_manager import bundle_resolver
+
+
+class BundleResolverTestCase(TestCase):
+
+    tags = ('bundles', )
+
+    def setUp(self):
+        bundle_resolver.Resource = MagicMock()
+        bundle_resolver.Resource.DoesNotExist = Exception
+        bundle_resolver.Resource.objects.filter.side_effect = lambda pk__in: [
+            MagicMock(pk=pk) for pk in pk__in if pk != 'missing']
+
+    def tearDown(self):
+        bundle_resolver.end_request_scope()
+        reload(bundle_resolver)
+
+    def test_resources_memoized(self):
+        resolver = bundle_resolver.BundleResolver()
+
+        resources = resolver.get_resources(['1', '2', '1'])
+        self.assertEquals(['1', '2', '1'], [resource.pk for resource in resources])
+
+        resources2 = resolver.get_resources(['2', '3'])
+        self.assertTrue(resources[1] is resources2[0])
+
+        # Only the resources not resolved before are retrieved
+        self.assertEquals(2, bundle_resolver.Resource.objects.filter.call_count)
+        self.assertItemsEqual(['1', '2'], bundle_resolver.Resource.objects.filter.call_args_list[0][1]['pk__in'])
+        self.assertEquals(['3'], bundle_resolver.Resource.objects.filter.call_args_list[1][1]['pk__in'])
+
+    def test_resource_missing(self):
+        resolver = bundle_resolver.BundleResolver()
+
+        with self.assertRaises(Exception) as e:
+            resolver.get_resources(['1', 'missing'])
+
+        self.assertEquals('The entity missing does not exist', unicode(e.exception))
+
+    def test_request_scope(self):
+        self.assertFalse(bundle_resolver.get_bundle_resolver() is bundle_resolver.get_bundle_resolver())
+
+        bundle_resolver.start_request_scope()
+        resolver = bundle_resolver.get_bundle_resolver()
+
+        self.assertTrue(resolver is bundle_resolver.get_bundle_resolver())
+
+        bundle_resolver.end_request_scope()
+        self.assertFalse(resolver is bundle_resolver.get_bundle_resolver())
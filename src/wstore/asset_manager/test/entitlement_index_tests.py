@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+from datetime import datetime
+from mock import MagicMock
+
+from django.test import TestCase
+
+from wstore.asset_manager import entitlement_index
+
+
+class EntitlementIndexTestCase(TestCase):
+
+    tags = ('entitlements', )
+
+    def setUp(self):
+        self._db = MagicMock()
+        entitlement_index.get_database_connection = MagicMock(return_value=self._db)
+        entitlement_index.UpdateOne = MagicMock(side_effect=lambda query, update, upsert: (query, update, upsert))
+
+        entitlement_index.datetime = MagicMock()
+        self._now = datetime(2017, 6, 1)
+        entitlement_index.datetime.utcnow.return_value = self._now
+
+        # Offerings include their assets, bundle assets are expanded to the included ones
+        self._resolver = MagicMock()
+        self._resolver.get_offering_assets.side_effect = lambda offering: offering.assets
+        self._resolver.expand_assets.side_effect = lambda assets: [
+            MagicMock(pk=pk) for asset in assets for pk in (asset.bundled_assets or [asset.pk])]
+
+        entitlement_index.get_bundle_resolver = MagicMock(return_value=self._resolver)
+        entitlement_index.BundleResolver = MagicMock(return_value=self._resolver)
+
+        self._org = MagicMock(pk='org1', acquired_offerings=['off1', 'off2'])
+        self._order = MagicMock(pk='order1', owner_organization=self._org)
+
+    def tearDown(self):
+        reload(entitlement_index)
+
+    def _get_contract(self, item_id, offering_pk, assets, terminated=False):
+        offering = MagicMock(pk=offering_pk, assets=assets)
+        return MagicMock(item_id=item_id, offering=offering, offering_id=offering_pk, terminated=terminated)
+
+    def _get_entitlements(self):
+        entitlements = []
+        for bulk in self._db.wstore_entitlements.bulk_write.call_args_list:
+            self.assertEquals({'ordered': False}, bulk[1])
+            entitlements.extend(bulk[0][0])
+
+        return entitlements
+
+    def _entitlement(self, asset, contract):
+        return ({
+            'organization': 'org1',
+            'asset': asset,
+            'order': 'order1',
+            'contract': contract
+        }, {'$set': {'updated': self._now}}, True)
+
+    def test_grant_entitlements(self):
+        contracts = [
+            self._get_contract('1', 'off1', [MagicMock(pk='asset1', bundled_assets=[])]),
+            self._get_contract('2', 'off2', [MagicMock(pk='bundle', bundled_assets=['asset2', 'asset3'])]),
+            self._get_contract('3', 'off3', [])
+        ]
+
+        entitlement_index.grant_entitlements(self._order, contracts)
+
+        self.assertEquals(1, self._db.wstore_entitlements.bulk_write.call_count)
+        self.assertItemsEqual([
+            self._entitlement('asset1', '1'),
+            self._entitlement('asset2', '2'),
+            self._entitlement('asset3', '2')
+        ], self._get_entitlements())
+
+    def test_grant_entitlements_no_assets(self):
+        entitlement_index.grant_entitlements(self._order, [self._get_contract('1', 'off1', [])])
+
+        self.assertEquals(0, self._db.wstore_entitlements.bulk_write.call_count)
+
+    def test_revoke_entitlements(self):
+        entitlement_index.revoke_entitlements(self._order, self._get_contract('1', 'off1', []))
+
+        self._db.wstore_entitlements.delete_many.assert_called_once_with({
+            'order': 'order1',
+            'contract': '1'
+        })
+
+    def test_has_entitlement(self):
+        self._db.wstore_entitlements.find_one.side_effect = [{'_id': '1'}, None]
+
+        self.assertTrue(entitlement_index.has_entitlement(self._org, MagicMock(pk='asset1')))
+        self.assertFalse(entitlement_index.has_entitlement(self._org, MagicMock(pk='asset2')))
+
+        self._db.wstore_entitlements.find_one.assert_called_with({
+            'organization': 'org1',
+            'asset': 'asset2'
+        }, {'_id': True})
+
+    def test_rebuild_entitlements(self):
+        self._order.contracts = [
+            self._get_contract('1', 'off1', [MagicMock(pk='asset1', bundled_assets=[])]),
+            self._get_contract('2', 'off2', [MagicMock(pk='asset2', bundled_assets=[])], terminated=True),
+            self._get_contract('3', 'off3', [MagicMock(pk='asset3', bundled_assets=[])])
+        ]
+
+        count = entitlement_index.rebuild_entitlements([self._order, MagicMock(owner_organization=None)])
+
+        # Only acquired contracts which have not been terminated are indexed
+        self.assertEquals(1, count)
+        self.assertEquals([self._entitlement('asset1', '1')], self._get_entitlements())
+
+        # Entitlements not included in the new index are removed
+        self._db.wstore_entitlements.delete_many.assert_called_once_with({'updated': {'$lt': self._now}})
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+
+from nose_parameterized import parameterized
+from StringIO import StringIO
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from wstore.asset_manager import file_upload
+from wstore.store_commons.errors import ConflictError
+
+
+CONTENT = b'Test data content'
+CONTENT_DIGEST = hashlib.sha256(CONTENT).hexdigest()
+
+
+class Base64DecodingTestCase(TestCase):
+
+    tags = ('asset-upload', )
+
+    @parameterized.expand([
+        ('aligned', 'VGVzdCBkYXRhIGNvbnRlbnQ=', 3, [b'Tes', b't d', b'ata', b' co', b'nte', b'nt']),
+        ('unaligned', 'VGVzdCBkYXRhIGNvbnRlbnQ=', 4, [b'Tes', b't d', b'ata', b' co', b'nte', b'nt']),
+        ('whitespace', 'VGVz\nd CBk\r\nYXRh IGNv\nbnRlbnQ=', 6, [b'Tes', b't data', b' co', b'ntent']),
+        ('large_chunk', 'VGVzdCBkYXRhIGNvbnRlbnQ=', 1024, [CONTENT]),
+        ('empty', '', 3, [])
+    ])
+    def test_iter_base64_content(self, name, data, chunk_size, expected):
+        self.assertEquals(expected, list(file_upload.iter_base64_content(data, chunk_size)))
+
+    def test_base64_decoder_pending(self):
+        decoder = file_upload.Base64Decoder()
+
+        self.assertEquals(b'', decoder.decode('VGU'))
+        self.assertEquals(b'Te', decoder.decode('='))
+        self.assertEquals(b'', decoder.finish())
+
+    def test_base64_decoder_incomplete(self):
+        decoder = file_upload.Base64Decoder()
+        decoder.decode('VGVzdCB')
+
+        with self.assertRaises(TypeError):
+            decoder.finish()
+
+    def test_iter_file_content(self):
+        file_ = StringIO(CONTENT)
+        file_.read()
+
+        self.assertEquals([b'Test da', b'ta cont', b'ent'], list(file_upload.iter_file_content(file_, 7)))
+
+
+class SaveUploadTestCase(TestCase):
+
+    tags = ('asset-upload', )
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'example.wgt')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    @parameterized.expand([
+        ('basic', None),
+        ('checksum', CONTENT_DIGEST),
+        ('checksum_upper', CONTENT_DIGEST.upper())
+    ])
+    def test_save_upload(self, name, checksum):
+        digest = file_upload.save_upload(iter([b'Test data', b' content']), self._path, checksum=checksum)
+
+        self.assertEquals(CONTENT_DIGEST, digest)
+        self.assertEquals(CONTENT, self._read(self._path))
+        self.assertEquals(['example.wgt'], os.listdir(self._dir))
+
+        # The file gets the mode of the umask instead of the one of the temporary file
+        self.assertEquals(file_upload._FILE_MODE, stat.S_IMODE(os.stat(self._path).st_mode))
+
+    def test_file_mode(self):
+        umask = os.umask(0o027)
+        try:
+            self.assertEquals(0o640, file_upload._get_file_mode())
+        finally:
+            os.umask(umask)
+
+    def test_get_file_digest(self):
+        with open(self._path, 'wb') as f:
+            f.write(CONTENT)
+
+        self.assertEquals(CONTENT_DIGEST, file_upload.get_file_digest(self._path))
+
+    def test_save_upload_replace(self):
+        with open(self._path, 'wb') as f:
+            f.write(b'Previous content')
+
+        file_upload.save_upload(iter([CONTENT]), self._path)
+
+        self.assertEquals(CONTENT, self._read(self._path))
+
+    def test_save_upload_checksum_error(self):
+        with self.assertRaises(ValueError) as e:
+            file_upload.save_upload(iter([CONTENT]), self._path, checksum='abcdef')
+
+        self.assertEquals('The checksum of the uploaded file does not match its content', unicode(e.exception))
+
+        # The temporary file is removed
+        self.assertEquals([], os.listdir(self._dir))
+
+    def test_save_upload_interrupted(self):
+        def chunks():
+            yield b'Test data'
+            raise TypeError('Incorrect padding')
+
+        with self.assertRaises(TypeError):
+            file_upload.save_upload(chunks(), self._path)
+
+        self.assertEquals([], os.listdir(self._dir))
+
+
+class ResumableUploadTestCase(TestCase):
+
+    tags = ('asset-upload', )
+
+    def setUp(self):
+        self._media_root = tempfile.mkdtemp()
+        self._override = override_settings(MEDIA_ROOT=self._media_root, ASSET_UPLOAD_EXPIRY=3600)
+        self._override.enable()
+
+        self._uploads_dir = os.path.join(self._media_root, 'uploads', 'test_user')
+        self._path = os.path.join(self._media_root, 'example.wgt')
+
+    def tearDown(self):
+        self._override.disable()
+        shutil.rmtree(self._media_root)
+
+    def test_resumable_upload(self):
+        upload_id = file_upload.create_upload('test_user')
+
+        self.assertEquals(['{}.part'.format(upload_id)], os.listdir(self._uploads_dir))
+        self.assertEquals(0, file_upload.get_upload_offset('test_user', upload_id))
+
+        self.assertEquals(9, file_upload.append_upload_chunk('test_user', upload_id, 0, iter([b'Test', b' data'])))
+        self.assertEquals(9, file_upload.get_upload_offset('test_user', upload_id))
+
+        self.assertEquals(17, file_upload.append_upload_chunk('test_user', upload_id, 9, iter([b' content'])))
+
+        digest = file_upload.complete_upload('test_user', upload_id, self._path, checksum=CONTENT_DIGEST)
+
+        self.assertEquals(CONTENT_DIGEST, digest)
+        with open(self._path, 'rb') as f:
+            self.assertEquals(CONTENT, f.read())
+
+        self.assertEquals(file_upload._FILE_MODE, stat.S_IMODE(os.stat(self._path).st_mode))
+
+        self.assertEquals([], os.listdir(self._uploads_dir))
+
+    def test_append_invalid_offset(self):
+        upload_id = file_upload.create_upload('test_user')
+        file_upload.append_upload_chunk('test_user', upload_id, 0, iter([b'Test']))
+
+        with self.assertRaises(ValueError) as e:
+            file_upload.append_upload_chunk('test_user', upload_id, 0, iter([b'Test']))
+
+        self.assertEquals('Invalid upload offset, 4 bytes have been received', unicode(e.exception))
+        self.assertEquals(4, file_upload.get_upload_offset('test_user', upload_id))
+
+    def test_append_locked(self):
+        import fcntl
+
+        upload_id = file_upload.create_upload('test_user')
+
+        with open(os.path.join(self._uploads_dir, '{}.part'.format(upload_id)), 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+            with self.assertRaises(ConflictError):
+                file_upload.append_upload_chunk('test_user', upload_id, 0, iter([b'Test']))
+
+    def test_complete_checksum_error(self):
+        upload_id = file_upload.create_upload('test_user')
+        file_upload.append_upload_chunk('test_user', upload_id, 0, iter([CONTENT]))
+
+        with self.assertRaises(ValueError):
+            file_upload.complete_upload('test_user', upload_id, self._path, checksum='abcdef')
+
+        self.assertFalse(os.path.exists(self._path))
+
+    @parameterized.expand([
+        ('not_existing', '0123456789abcdef0123456789abcdef'),
+        ('invalid_id', '..'),
+    ])
+    def test_upload_not_found(self, name, upload_id):
+        file_upload.create_upload('test_user')
+
+        with self.assertRaises(ObjectDoesNotExist):
+            file_upload.get_upload_offset('test_user', upload_id)
+
+        with self.assertRaises(ObjectDoesNotExist):
+            file_upload.complete_upload('test_user', upload_id, self._path)
+
+    def test_expired_uploads_removed(self):
+        expired_id = file_upload.create_upload('test_user')
+        os.utime(os.path.join(self._uploads_dir, '{}.part'.format(expired_id)), (1500000000, 1500000000))
+
+        upload_id = file_upload.create_upload('test_user')
+
+        self.assertEquals(['{}.part'.format(upload_id)], os.listdir(self._uploads_dir))
+
+    def test_remove_upload(self):
+        upload_id = file_upload.create_upload('test_user')
+        file_upload.remove_upload('test_user', upload_id)
+
+        self.assertEquals([], os.listdir(self._uploads_dir))
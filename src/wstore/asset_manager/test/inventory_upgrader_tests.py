@@ -286,12 +286,12 @@ class InventoryUpgraderTestCase(TestCase):
         self._lock_inst = MagicMock()
         inventory_upgrader.DocumentLock = MagicMock(return_value=self._lock_inst)
 
-        inventory_upgrader.requests = MagicMock()
+        inventory_upgrader.http_client = MagicMock()
         self._resp = MagicMock()
         self._resp.json.return_value = {
             'name': self._product_spec_name
         }
-        inventory_upgrader.requests.get.return_value = self._resp
+        inventory_upgrader.http_client.get.return_value = self._resp
 
         inventory_upgrader.PAGE_LEN = 2.0
 
@@ -318,7 +318,7 @@ class InventoryUpgraderTestCase(TestCase):
         inventory_upgrader.settings.CATALOG = self._cat_url
 
     def _check_product_spec_retrieved(self):
-        inventory_upgrader.requests.get.assert_called_once_with(self._product_spec_url)
+        inventory_upgrader.http_client.get.assert_called_once_with(self._product_spec_url)
         self._resp.raise_for_status.assert_called_once_with()
         self._resp.json.assert_called_once_with()
 
@@ -631,7 +631,7 @@ class InventoryUpgraderTestCase(TestCase):
 
         self._client_instance.patch_product.side_effect = [None, HTTPError()]
 
-        inventory_upgrader.requests.get.side_effect = HTTPError()
+        inventory_upgrader.http_client.get.side_effect = HTTPError()
 
         # Execute the tested method
         upgrader = inventory_upgrader.InventoryUpgrader(self._asset)
@@ -669,7 +669,7 @@ class InventoryUpgraderTestCase(TestCase):
             })
         ], self._client_instance.patch_product.call_args_list)
 
-        inventory_upgrader.requests.get.assert_called_once_with(self._product_spec_url)
+        inventory_upgrader.http_client.get.assert_called_once_with(self._product_spec_url)
         self.assertEquals(0, self._resp.raise_for_status.call_count)
         self.assertEquals(0, self._resp.json.call_count)
 
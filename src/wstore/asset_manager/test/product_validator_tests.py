@@ -26,7 +26,7 @@ from nose_parameterized import parameterized
 from django.core.exceptions import PermissionDenied
 from django.test.testcases import TestCase
 
-from wstore.asset_manager import product_validator, offering_validator
+from wstore.asset_manager import bundle_resolver, catalog_validator, product_validator, offering_validator
 from wstore.asset_manager.errors import ProductError
 from wstore.asset_manager.test.product_validator_test_data import *
 from wstore.store_commons.errors import ConflictError
@@ -70,7 +70,17 @@ class ValidatorTestCase(TestCase):
         # Mock Site
         product_validator.settings.SITE = "http://testlocation.org/"
 
+        self._invalidate_downloads = catalog_validator.invalidate_downloads
+        catalog_validator.invalidate_downloads = MagicMock()
+
+        # The assets of bundled offerings are resolved by id
+        bundle_resolver.Resource = MagicMock()
+        bundle_resolver.Resource.objects.filter.side_effect = lambda pk__in: [
+            MagicMock(pk=pk, bundled_assets=[]) for pk in pk__in]
+
     def tearDown(self):
+        catalog_validator.invalidate_downloads = self._invalidate_downloads
+        reload(bundle_resolver)
         reload(offering_validator)
         reload(product_validator)
 
@@ -251,6 +261,19 @@ class ValidatorTestCase(TestCase):
         # The method did nothing
         self.assertEquals(0, product_validator.ResourcePlugin.objects.get.call_count)
 
+    @parameterized.expand([
+        ('create', 'create', False),
+        ('attach', 'attach', False),
+        ('upgrade', 'upgrade', True),
+        ('attach_upgrade', 'attach_upgrade', True),
+        ('delete', 'delete', True)
+    ])
+    def test_downloads_invalidation(self, name, action, invalidated):
+        validator = catalog_validator.CatalogValidator()
+        validator.validate(action, self._provider, {})
+
+        self.assertEquals(invalidated, catalog_validator.invalidate_downloads.called)
+
     @parameterized.expand([
         ('missing_version', {}),
         ('missing_charact', {'version': '1.0'}),
@@ -20,7 +20,7 @@
 
 import json
 
-from mock import MagicMock
+from mock import MagicMock, ANY
 from StringIO import StringIO
 from nose_parameterized import parameterized
 
@@ -472,3 +472,107 @@ class AssetCollectionTestCase(TestCase):
             off_validator.validate.assert_called_once_with('create', self.user.userprofile.current_organization, {})
 
         self._test_post_api(views.ValidateOfferingCollection, data, 'application/json', None, 200, validator)
+
+
+class UploadSessionTestCase(TestCase):
+
+    tags = ('asset-api', 'asset-upload')
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+        self.user = MagicMock()
+        self.user.is_anonymous.return_value = False
+        self.user.is_staff = False
+        self.user.userprofile.get_current_roles.return_value = ['provider', 'customer']
+        self.user.userprofile.current_organization.name = 'test_user'
+
+        views.file_upload = MagicMock()
+        views.file_upload.create_upload.return_value = 'upload1'
+        views.file_upload.get_upload_offset.return_value = 4
+        views.file_upload.append_upload_chunk.side_effect = lambda provider, upload_id, offset, chunks: \
+            offset + len(b''.join(chunks))
+
+    def tearDown(self):
+        reload(views)
+
+    def _check_response(self, response, code, body):
+        self.assertEquals(code, response.status_code)
+        self.assertEquals(body, json.loads(response.content))
+
+    def _no_provider(self):
+        self.user.userprofile.get_current_roles.return_value = ['customer']
+
+    def _not_found(self):
+        views.file_upload.get_upload_offset.side_effect = ObjectDoesNotExist('The specified upload does not exist')
+        views.file_upload.append_upload_chunk.side_effect = ObjectDoesNotExist('The specified upload does not exist')
+
+    def _invalid_offset(self):
+        views.file_upload.append_upload_chunk.side_effect = ValueError('Invalid upload offset, 4 bytes have been received')
+
+    def _locked(self):
+        views.file_upload.append_upload_chunk.side_effect = ConflictError('The upload is being written by another request')
+
+    def test_create_upload(self):
+        request = self.factory.post('/charging/api/assetManagement/assets/uploads', HTTP_ACCEPT='application/json')
+        request.user = self.user
+
+        response = views.UploadSessionCollection(permitted_methods=('POST',)).create(request)
+
+        self._check_response(response, 201, {'id': 'upload1', 'offset': 0})
+        self.assertEquals('0', response['Upload-Offset'])
+        views.file_upload.create_upload.assert_called_once_with('test_user')
+
+    @parameterized.expand([
+        ('basic', None, 200, {'id': 'upload1', 'offset': 4}),
+        ('not_provider', _no_provider, 403, {'result': 'error', 'error': "You don't have the seller role"}),
+        ('not_found', _not_found, 404, {'result': 'error', 'error': 'The specified upload does not exist'})
+    ])
+    def test_get_upload_offset(self, name, side_effect, code, body):
+        if side_effect is not None:
+            side_effect(self)
+
+        request = self.factory.get('/charging/api/assetManagement/assets/uploads/upload1', HTTP_ACCEPT='application/json')
+        request.user = self.user
+
+        response = views.UploadSessionEntry(permitted_methods=('GET',)).read(request, 'upload1')
+
+        self._check_response(response, code, body)
+
+    @parameterized.expand([
+        ('basic', '4', None, 200, {'id': 'upload1', 'offset': 17}),
+        ('missing_offset', None, None, 422, {'result': 'error', 'error': 'Missing or invalid Upload-Offset header'}),
+        ('invalid_offset_header', 'inv', None, 422, {'result': 'error', 'error': 'Missing or invalid Upload-Offset header'}),
+        ('invalid_offset', '0', _invalid_offset, 422, {'result': 'error', 'error': 'Invalid upload offset, 4 bytes have been received'}),
+        ('locked', '4', _locked, 409, {'result': 'error', 'error': 'The upload is being written by another request'}),
+        ('not_found', '4', _not_found, 404, {'result': 'error', 'error': 'The specified upload does not exist'})
+    ])
+    def test_append_upload_chunk(self, name, offset, side_effect, code, body):
+        if side_effect is not None:
+            side_effect(self)
+
+        headers = {'HTTP_ACCEPT': 'application/json'}
+        if offset is not None:
+            headers['HTTP_UPLOAD_OFFSET'] = offset
+
+        request = self.factory.generic(
+            'PATCH', '/charging/api/assetManagement/assets/uploads/upload1', b' data content',
+            content_type='application/offset+octet-stream', **headers)
+        request.user = self.user
+
+        response = views.UploadSessionEntry(permitted_methods=('PATCH',)).patch(request, 'upload1')
+
+        self._check_response(response, code, body)
+
+        if code == 200:
+            self.assertEquals('17', response['Upload-Offset'])
+            views.file_upload.append_upload_chunk.assert_called_once_with('test_user', 'upload1', 4, ANY)
+
+    def test_remove_upload(self):
+        request = self.factory.delete('/charging/api/assetManagement/assets/uploads/upload1', HTTP_ACCEPT='application/json')
+        request.user = self.user
+
+        response = views.UploadSessionEntry(permitted_methods=('DELETE',)).delete(request, 'upload1')
+
+        self.assertEquals(204, response.status_code)
+        views.file_upload.remove_upload.assert_called_once_with('test_user', 'upload1')
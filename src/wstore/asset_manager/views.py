@@ -22,6 +22,7 @@ from __future__ import unicode_literals
 
 import json
 
+from django.conf import settings
 from django.http import HttpResponse
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.contrib.auth.models import User
@@ -32,6 +33,7 @@ from wstore.store_commons.resource import Resource
 from wstore.store_commons.utils.http import build_response, get_content_type, supported_request_mime_types, \
     authentication_required
 from wstore.asset_manager.asset_manager import AssetManager
+from wstore.asset_manager import file_upload
 from wstore.asset_manager.product_validator import ProductValidator
 from wstore.asset_manager.offering_validator import OfferingValidator
 from wstore.store_commons.errors import ConflictError
@@ -209,6 +211,107 @@ class UpgradeCollection(Resource):
         return _manage_digital_asset(request, upgrade_asset)
 
 
+def _upload_response(upload_id, offset, status=200):
+    response = HttpResponse(json.dumps({
+        'id': upload_id,
+        'offset': offset
+    }), status=status, mimetype='application/json; charset=utf-8')
+
+    response['Upload-Offset'] = unicode(offset)
+    return response
+
+
+def _manage_upload(request, manager):
+    user = request.user
+
+    if 'provider' not in user.userprofile.get_current_roles() and not user.is_staff:
+        return build_response(request, 403, "You don't have the seller role")
+
+    try:
+        response = manager(user.userprofile.current_organization.name)
+    except ValueError as e:
+        return build_response(request, 422, unicode(e))
+    except ConflictError as e:
+        return build_response(request, 409, unicode(e))
+    except ObjectDoesNotExist as e:
+        return build_response(request, 404, unicode(e))
+    except Exception as e:
+        return build_response(request, 400, unicode(e))
+
+    return response
+
+
+class UploadSessionCollection(Resource):
+
+    @authentication_required
+    def create(self, request):
+        """
+        Starts a resumable upload, used for sending large digital asset files in several requests.
+        The upload is completed including its id in the content of an uploadJob or upgradeJob
+        :param request:
+        :return: 201 Created, including the id of the upload
+        """
+
+        def create_upload(provider):
+            return _upload_response(file_upload.create_upload(provider), 0, status=201)
+
+        return _manage_upload(request, create_upload)
+
+
+class UploadSessionEntry(Resource):
+
+    @authentication_required
+    def read(self, request, upload_id):
+        """
+        Retrieves the offset where a resumable upload has to be continued
+        :param request:
+        :param upload_id: Id of the upload
+        :return: JSON document including the number of bytes already received
+        """
+
+        def get_offset(provider):
+            return _upload_response(upload_id, file_upload.get_upload_offset(provider, upload_id))
+
+        return _manage_upload(request, get_offset)
+
+    @authentication_required
+    def patch(self, request, upload_id):
+        """
+        Appends the request body to a resumable upload, the Upload-Offset header must include
+        the number of bytes already received
+        :param request:
+        :param upload_id: Id of the upload
+        :return: JSON document including the new offset of the upload
+        """
+
+        def append_chunk(provider):
+            try:
+                offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+            except (KeyError, ValueError):
+                raise ValueError('Missing or invalid Upload-Offset header')
+
+            # The body is read in chunks so it is not loaded into memory
+            chunks = iter(lambda: request.read(settings.ASSET_UPLOAD_CHUNK_SIZE), b'')
+            return _upload_response(upload_id, file_upload.append_upload_chunk(provider, upload_id, offset, chunks))
+
+        return _manage_upload(request, append_chunk)
+
+    @authentication_required
+    def delete(self, request, upload_id):
+        """
+        Cancels a resumable upload
+        :param request:
+        :param upload_id: Id of the upload
+        :return: 204 No Content
+        """
+
+        def remove_upload(provider):
+            file_upload.remove_upload(provider, upload_id)
+            return HttpResponse(status=204)
+
+        return _manage_upload(request, remove_upload)
+
+
 def _validate_catalog_element(request, element, validator):
     # Validate user permissions
     user = request.user
@@ -20,6 +20,8 @@
 
 from __future__ import unicode_literals
 
+import re
+from collections import OrderedDict
 from datetime import datetime
 
 from django.core.exceptions import PermissionDenied
@@ -29,6 +31,46 @@ from wstore.models import Organization
 from wstore.ordering.models import Order
 
 
+EXPECTED_FIELDS = frozenset(['orderid', 'productid', 'correlationnumber', 'unit', 'value'])
+
+# Spelling of the expected characteristic names found in the SDRs
+_FIELD_NAMES = {}
+
+# YYYY-MM-ddTHH:mm:ss or YYYY-MM-dd HH:mm:ss, with optional fraction of seconds and UTC offset
+_DATE_RE = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?(?:Z|[+-]\d{2}:?\d{2})?$')
+
+_DATE_ERROR = 'Invalid date format, must be YYYY-MM-ddTHH:mm:ss.ms, YYYY-MM-dd HH:mm:ss.ms, or YYYY-MM-ddTHH:mm:ss+HH:mm'
+
+
+def parse_sdr_date(raw_time):
+    """
+    Parses the date of an SDR, the fraction of seconds is truncated to milliseconds
+    and the UTC offset is ignored
+    :param raw_time: ISO-8601 date string
+    :return: datetime object
+    """
+    try:
+        match = _DATE_RE.match(raw_time)
+    except TypeError:
+        match = None
+
+    if match is None:
+        raise ValueError(_DATE_ERROR)
+
+    year, month, day, hour, minute, second, fraction = match.groups()
+
+    micros = 0
+    if fraction is not None:
+        millis = fraction[:3]
+        micros = int(millis) * 10 ** (6 - len(millis))
+
+    try:
+        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), micros)
+    except ValueError:
+        raise ValueError(_DATE_ERROR)
+
+
 class SDRManager(object):
 
     def __init__(self):
@@ -54,58 +96,51 @@ class SDRManager(object):
         return order, contract
 
     def _get_datetime(self, raw_time):
-        try:
-            if '+' in raw_time:
-                # Time with offset, remove it from the string
-                time = raw_time.split('+')[0] + '.0'
-            else:
-                sp_time = raw_time.split('.')
-                milis = sp_time[1]
-
-                if len(milis) > 3:
-                    milis = milis[:3]
+        return parse_sdr_date(raw_time)
 
-                time = sp_time[0] + '.' + milis
+    def get_sdr_values(self, sdr):
+        try:
+            characteristics = sdr['usageCharacteristic']
+        except KeyError:
+            raise ValueError('Missing required field usageCharacteristic')
 
-            try:
-                time_stamp = datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.%f')
-            except:
-                time_stamp = datetime.strptime(time, '%Y-%m-%d %H:%M:%S.%f')
-        except:
-            raise ValueError('Invalid date format, must be YYYY-MM-ddTHH:mm:ss.ms, YYYY-MM-dd HH:mm:ss.ms, or YYYY-MM-ddTHH:mm:ss+HH:mm')
+        values = {}
+        for usage_value in characteristics:
+            name = usage_value['name']
 
-        return time_stamp
+            # Names are usually sent with the same case, so they are only lowercased once
+            field = _FIELD_NAMES.get(name)
+            if field is None:
+                field = name.lower()
+                if field not in EXPECTED_FIELDS:
+                    continue
 
-    def get_sdr_values(self, sdr):
-        expected_fields = ['orderid', 'productid', 'correlationnumber', 'unit', 'value']
-        values = {}
+                _FIELD_NAMES[name] = field
 
-        if 'usageCharacteristic' not in sdr:
-            raise ValueError('Missing required field usageCharacteristic')
+            if field in values:
+                raise ValueError('Only a value is supported for characteristic ' + name)
 
-        for usage_value in sdr['usageCharacteristic']:
-            if usage_value['name'].lower() in expected_fields:
-                if usage_value['name'].lower() not in values:
-                    values[usage_value['name'].lower()] = usage_value['value']
-                else:
-                    raise ValueError('Only a value is supported for characteristic ' + usage_value['name'])
+            values[field] = usage_value['value']
 
-        if len(values) != len(expected_fields):
+        if len(values) != len(EXPECTED_FIELDS):
             raise ValueError('Missing mandatory characteristics, must be: orderId, productId, correlationNumber, unit, value')
 
         return values
 
-    def validate_sdr(self, sdr):
-        if sdr['status'].lower() != 'received':
-            raise ValueError('Invalid initial status, must be Received')
+    def _get_customer(self, customer_name):
+        # Check that the customer exist
+        customer = Organization.objects.filter(name=customer_name)
 
-        sdr_values = self.get_sdr_values(sdr)
-        self._order, self._contract = self._get_order_contract(sdr_values['orderid'], sdr_values['productid'])
+        if not len(customer):
+            raise ValueError('The specified customer ' + customer_name + ' does not exist')
 
-        if self._order is None:
+        return User.objects.get(username=customer_name)
+
+    def _validate_usage(self, sdr, sdr_values, order, contract):
+        if order is None:
             raise ValueError('Invalid orderId, the order does not exists')
 
-        if self._contract is None:
+        if contract is None:
             raise ValueError('Invalid productId, the contract does not exist')
 
         # Check that the value field is a valid number
@@ -117,35 +152,28 @@ class SDRManager(object):
         if 'relatedParty' not in sdr:
             raise ValueError('Missing required field relatedParty')
 
-        # Check that the customer exist
-        customer_name = sdr['relatedParty'][0]['id']
-        customer = Organization.objects.filter(name=customer_name)
-
-        if not len(customer):
-            raise ValueError('The specified customer ' + customer_name + ' does not exist')
-
         # Check if the user making the request belongs to the customer organization
-        user = User.objects.get(username=customer_name)
+        user = self._get_customer(sdr['relatedParty'][0]['id'])
 
         for org in user.userprofile.organizations:
-            if org['organization'] == self._order.owner_organization.pk:
+            if org['organization'] == order.owner_organization.pk:
                 break
         else:
             raise PermissionDenied("You don't belong to the customer organization")
 
         # Validate that the price mode included in the contract correspond to the one specified in the SDR
-        price_model = self._contract.pricing_model
+        price_model = contract.pricing_model
         if 'pay_per_use' not in price_model:
             raise ValueError('The pricing model of the offering does not define pay-per-use components')
 
         # Check the correlation number and timestamp
-        if int(sdr_values['correlationnumber']) != self._contract.correlation_number:
-            raise ValueError('Invalid correlation number, expected: ' + unicode(self._contract.correlation_number))
+        if int(sdr_values['correlationnumber']) != contract.correlation_number:
+            raise ValueError('Invalid correlation number, expected: ' + unicode(contract.correlation_number))
 
         # Truncate ms to 3 decimals (database supported)
-        self._time_stamp = self._get_datetime(sdr['date'])
+        time_stamp = self._get_datetime(sdr['date'])
 
-        if self._contract.last_usage is not None and self._contract.last_usage > self._time_stamp:
+        if contract.last_usage is not None and contract.last_usage > time_stamp:
             raise ValueError('The provided timestamp specifies a lower timing than the last SDR received')
 
         # Check that the pricing model contains the specified unit
@@ -155,8 +183,108 @@ class SDRManager(object):
         else:
             raise ValueError('The specified unit is not included in the pricing model')
 
+        return time_stamp
+
+    def _get_initial_values(self, sdr):
+        if sdr['status'].lower() != 'received':
+            raise ValueError('Invalid initial status, must be Received')
+
+        return self.get_sdr_values(sdr)
+
+    def validate_sdr(self, sdr):
+        sdr_values = self._get_initial_values(sdr)
+        self._order, self._contract = self._get_order_contract(sdr_values['orderid'], sdr_values['productid'])
+
+        self._time_stamp = self._validate_usage(sdr, sdr_values, self._order, self._contract)
+
     def update_usage(self):
         # Save new usage information
         self._contract.last_usage = self._time_stamp
         self._contract.correlation_number += 1
         self._order.save()
+
+
+class SDRBatchManager(SDRManager):
+    """
+    Validates a batch of SDRs. Every order and customer is retrieved once, and the SDRs
+    of each contract are checked in correlation number order, taking into account the
+    ones of the batch which have been already accepted
+    """
+
+    def __init__(self):
+        super(SDRBatchManager, self).__init__()
+        self._orders = {}
+        self._customers = {}
+        self._updated_orders = OrderedDict()
+
+    def _get_order_contract(self, order_id, product_id):
+        if order_id not in self._orders:
+            try:
+                self._orders[order_id] = Order.objects.get(order_id=order_id)
+            except:
+                self._orders[order_id] = None
+
+        order = self._orders[order_id]
+        contract = None
+
+        try:
+            contract = order.get_product_contract(product_id)
+        except:
+            pass
+
+        return order, contract
+
+    def _get_customer(self, customer_name):
+        if customer_name not in self._customers:
+            try:
+                self._customers[customer_name] = super(SDRBatchManager, self)._get_customer(customer_name)
+            except ValueError as e:
+                self._customers[customer_name] = e
+
+        customer = self._customers[customer_name]
+        if isinstance(customer, Exception):
+            raise customer
+
+        return customer
+
+    def validate_batch(self, sdrs):
+        """
+        Validates the given SDRs, updating the usage of the related contracts with the valid ones
+        :param sdrs: List of SDR documents
+        :return: List with the validation error of each SDR, None if the SDR is valid
+        """
+        errors = [None] * len(sdrs)
+        contracts = OrderedDict()
+
+        for ix, sdr in enumerate(sdrs):
+            try:
+                sdr_values = self._get_initial_values(sdr)
+                correlation_number = int(sdr_values['correlationnumber'])
+            except Exception as e:
+                errors[ix] = e
+                continue
+
+            key = (sdr_values['orderid'], sdr_values['productid'])
+            contracts.setdefault(key, []).append((correlation_number, ix, sdr, sdr_values))
+
+        for (order_id, product_id), contract_sdrs in contracts.items():
+            order, contract = self._get_order_contract(order_id, product_id)
+
+            for correlation_number, ix, sdr, sdr_values in sorted(contract_sdrs, key=lambda c_sdr: c_sdr[:2]):
+                try:
+                    time_stamp = self._validate_usage(sdr, sdr_values, order, contract)
+                except Exception as e:
+                    errors[ix] = e
+                    continue
+
+                # Following SDRs of the contract are validated against the accepted ones
+                contract.last_usage = time_stamp
+                contract.correlation_number += 1
+                self._updated_orders[order.pk] = order
+
+        return errors
+
+    def update_usage(self):
+        # Every order is saved once with the usage of all its contracts
+        for order in self._updated_orders.values():
+            order.save()
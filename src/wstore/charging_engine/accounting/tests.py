@@ -23,17 +23,21 @@ from __future__ import unicode_literals
 import json
 
 from copy import deepcopy
-from datetime import datetime
-from mock import MagicMock
+from datetime import datetime, timedelta
+from mock import MagicMock, call
 from nose_parameterized import parameterized
+from requests.exceptions import HTTPError
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.core.exceptions import PermissionDenied
 
 from wstore.charging_engine.accounting import sdr_manager
 from wstore.charging_engine.accounting import usage_client
+from wstore.charging_engine.accounting import usage_rating
 from wstore.charging_engine.accounting.errors import UsageError
 from wstore.charging_engine.accounting import views
+from wstore.store_commons import spool
 
 BASIC_SDR = {
     'status': 'Received',
@@ -224,6 +228,93 @@ class SDRManagerTestCase(TestCase):
 
         self._order.save.assert_called_once_with()
 
+    @parameterized.expand([
+        ('iso', '2015-10-20T17:31:57.100', datetime(2015, 10, 20, 17, 31, 57, 100000)),
+        ('space', '2015-10-20 17:31:57.1', datetime(2015, 10, 20, 17, 31, 57, 100000)),
+        ('micros', '2015-10-20 17:31:57.123456', datetime(2015, 10, 20, 17, 31, 57, 123000)),
+        ('offset', '2015-10-20T17:31:57+02:00', datetime(2015, 10, 20, 17, 31, 57)),
+        ('offset_fraction', '2015-10-20T17:31:57.25-01:00', datetime(2015, 10, 20, 17, 31, 57, 250000)),
+        ('utc', '2015-10-20T17:31:57.010Z', datetime(2015, 10, 20, 17, 31, 57, 10000)),
+        ('inv_format', '20/10/2015 17:31:57'),
+        ('inv_date', '2015-13-20T17:31:57.100'),
+        ('inv_suffix', '2015-10-20T17:31:57.100abc'),
+        ('inv_type', None)
+    ])
+    def test_parse_sdr_date(self, name, raw_time, expected=None):
+        if expected is not None:
+            self.assertEquals(expected, sdr_manager.parse_sdr_date(raw_time))
+        else:
+            with self.assertRaises(ValueError) as cm:
+                sdr_manager.parse_sdr_date(raw_time)
+
+            self.assertEquals(
+                'Invalid date format, must be YYYY-MM-ddTHH:mm:ss.ms, YYYY-MM-dd HH:mm:ss.ms, or YYYY-MM-ddTHH:mm:ss+HH:mm',
+                unicode(cm.exception))
+
+    def test_sdr_values_case(self):
+        sdr = deepcopy(BASIC_SDR)
+        sdr['usageCharacteristic'][0]['name'] = 'ORDERID'
+        sdr['usageCharacteristic'].append({
+            'name': 'region',
+            'value': 'eu'
+        })
+
+        values = sdr_manager.SDRManager().get_sdr_values(sdr)
+
+        self.assertEquals({
+            'orderid': '1',
+            'productid': '2',
+            'correlationnumber': '1',
+            'unit': 'invocation',
+            'value': '10'
+        }, values)
+
+    def _get_batch_sdr(self, correlation_number, date):
+        sdr = deepcopy(BASIC_SDR)
+        sdr['usageCharacteristic'][2]['value'] = unicode(correlation_number)
+        sdr['date'] = date
+        return sdr
+
+    def test_sdr_batch_validation(self):
+        invalid_state = self._get_batch_sdr(3, '2015-10-20 17:35:00.000000')
+        invalid_state['status'] = 'Rated'
+
+        other_order = self._get_batch_sdr(1, '2015-10-20 17:31:57.100000')
+        other_order['usageCharacteristic'][0]['value'] = '5'
+
+        sdrs = [
+            self._get_batch_sdr(2, '2015-10-20 17:33:00.000000'),
+            self._get_batch_sdr(1, '2015-10-20 17:31:57.100000'),
+            invalid_state,
+            self._get_batch_sdr(4, '2015-10-20 17:34:00.000000'),
+            other_order
+        ]
+
+        sdr_manager.Order.objects.get.side_effect = lambda order_id: self._order if order_id == '1' else None
+
+        sdr_mng = sdr_manager.SDRBatchManager()
+        errors = sdr_mng.validate_batch(sdrs)
+
+        self.assertEquals([None, None], errors[:2])
+        self.assertEquals(
+            ['Invalid initial status, must be Received',
+             'Invalid correlation number, expected: 3',
+             'Invalid orderId, the order does not exists'],
+            [unicode(error) for error in errors[2:]])
+
+        # Orders and customers are retrieved once
+        self.assertEquals([call(order_id='1'), call(order_id='5')], sdr_manager.Order.objects.get.call_args_list)
+        self._order.get_product_contract.assert_called_once_with('2')
+        sdr_manager.Organization.objects.filter.assert_called_once_with(name='test_user')
+        sdr_manager.User.objects.get.assert_called_once_with(username='test_user')
+
+        # The contract includes the accepted SDRs
+        self.assertEquals(3, self._contract.correlation_number)
+        self.assertEquals(datetime(2015, 10, 20, 17, 33), self._contract.last_usage)
+
+        sdr_mng.update_usage()
+        self._order.save.assert_called_once_with()
+
 BASIC_USAGE = {
     'id': '3',
     'usageCharacteristic': [{
@@ -252,7 +343,8 @@ class UsageClientTestCase(TestCase):
 
     def setUp(self):
         usage_client.settings.USAGE = 'http://example.com/DSUsageManagement'
-        usage_client.requests = MagicMock()
+        usage_client.http_client = MagicMock()
+        self._http_client = usage_client.http_client
         self._old_inv = usage_client.settings.INVENTORY
         usage_client.settings.INVENTORY = 'http://localhost:8080/DSProductInventory'
 
@@ -265,29 +357,81 @@ class UsageClientTestCase(TestCase):
     @parameterized.expand([
         ('all_usages', [NON_PRODUCT_USAGE, BASIC_USAGE], [BASIC_USAGE]),
         ('filtered_by_state', [NON_PRODUCT_USAGE, BASIC_USAGE], [BASIC_USAGE], '&status=Guided', 'Guided'),
+        ('filtered_by_product', [NON_PRODUCT_USAGE, BASIC_USAGE], [BASIC_USAGE], '&usageCharacteristic.value=1', None, True),
         ('product_not_found', [NON_PRODUCT_USAGE], [])
     ])
-    def test_retrieve_usage(self, name, response, exp_resp, extra_query='', state=None):
+    def test_retrieve_usage(self, name, response, exp_resp, extra_query='', state=None, product_filter=False):
         # Create mocks
         mock_response = MagicMock()
         mock_response.json.return_value = response
-        usage_client.requests.get.return_value = mock_response
+        self._http_client.get.return_value = mock_response
         client = usage_client.UsageClient()
 
-        cust_usage = client.get_customer_usage(self._customer, self._product_id, state=state)
+        with override_settings(USAGE_PAGE_SIZE=5, USAGE_PRODUCT_FILTER=product_filter):
+            cust_usage = client.get_customer_usage(self._customer, self._product_id, state=state)
 
-        # Verify response
-        self.assertEquals(exp_resp, cust_usage)
+            # Verify response
+            self.assertEquals(exp_resp, list(cust_usage))
 
         # Verify calls
-        usage_client.requests.get.assert_called_once_with(
-            usage_client.settings.USAGE + '/api/usageManagement/v2/usage?relatedParty.id=' + self._customer + extra_query,
+        self._http_client.get.assert_called_once_with(
+            usage_client.settings.USAGE + '/api/usageManagement/v2/usage?relatedParty.id=' + self._customer +
+            extra_query + '&offset=0&limit=5',
             headers={u'Accept': u'application/json'}
         )
 
         mock_response.raise_for_status.assert_called_once_with()
         mock_response.json.assert_called_once_with()
 
+    def _mock_pages(self, pages):
+        responses = []
+        for page in pages:
+            response = MagicMock()
+            response.json.return_value = page
+            responses.append(response)
+
+        self._http_client.get.side_effect = responses
+
+    @override_settings(USAGE_PAGE_SIZE=2, USAGE_PRODUCT_FILTER=False)
+    def test_retrieve_usage_pages(self):
+        self._mock_pages([[BASIC_USAGE, NON_PRODUCT_USAGE], [BASIC_USAGE, BASIC_USAGE], []])
+        client = usage_client.UsageClient()
+
+        cust_usage = client.get_customer_usage(self._customer, self._product_id)
+
+        # Usage is not requested until consumed
+        self._http_client.get.assert_not_called()
+        self.assertEquals([BASIC_USAGE, BASIC_USAGE, BASIC_USAGE], list(cust_usage))
+
+        url = usage_client.settings.USAGE + '/api/usageManagement/v2/usage?relatedParty.id=' + self._customer
+        self.assertEquals([
+            call(url + '&offset=0&limit=2', headers={u'Accept': u'application/json'}),
+            call(url + '&offset=2&limit=2', headers={u'Accept': u'application/json'}),
+            call(url + '&offset=4&limit=2', headers={u'Accept': u'application/json'})
+        ], self._http_client.get.call_args_list)
+
+    @override_settings(USAGE_PAGE_SIZE=2, USAGE_PRODUCT_FILTER=False)
+    def test_retrieve_usage_pagination_ignored(self):
+        # The usage API returns the same page whatever the offset is
+        self._mock_pages([[BASIC_USAGE, NON_PRODUCT_USAGE], [BASIC_USAGE, NON_PRODUCT_USAGE]])
+        client = usage_client.UsageClient()
+
+        self.assertEquals([BASIC_USAGE], list(client.get_customer_usage(self._customer, self._product_id)))
+        self.assertEquals(2, self._http_client.get.call_count)
+
+    @override_settings(USAGE_PAGE_SIZE=5, USAGE_PRODUCT_FILTER=True)
+    def test_retrieve_usage_encoded_query(self):
+        self._mock_pages([[]])
+        client = usage_client.UsageClient()
+
+        list(client.get_customer_usage('test customer&status=Billed', '1&2'))
+
+        self._http_client.get.assert_called_once_with(
+            usage_client.settings.USAGE + '/api/usageManagement/v2/usage?relatedParty.id=test+customer%26status%3DBilled' +
+            '&usageCharacteristic.value=1%262&offset=0&limit=5',
+            headers={u'Accept': u'application/json'}
+        )
+
     def _test_invalid_state(self, method, args, kwargs):
         error = None
         try:
@@ -304,12 +448,12 @@ class UsageClientTestCase(TestCase):
 
     def _test_patch(self, expected_json, method, args):
         mock_response = MagicMock()
-        usage_client.requests.patch.return_value = mock_response
+        self._http_client.patch.return_value = mock_response
 
         method(*args)
 
         # Verify calls
-        usage_client.requests.patch.assert_called_once_with(
+        self._http_client.patch.assert_called_once_with(
             usage_client.settings.USAGE + '/api/usageManagement/v2/usage/' + BASIC_USAGE['id'],
             json=expected_json
         )
@@ -378,6 +522,141 @@ MANAGER_VALUE_RESP = {
 }
 
 
+RATING = {
+    'usage_id': '1',
+    'timestamp': '2016-04-15',
+    'duty_free': '10',
+    'price': '12',
+    'rate': '20',
+    'currency': 'EUR',
+    'product_id': '1'
+}
+
+
+class UsageRatingTestCase(TestCase):
+
+    tags = ('usage-rating',)
+
+    def setUp(self):
+        self._db = MagicMock()
+        usage_rating.get_database_connection = MagicMock(return_value=self._db)
+        usage_rating.UsageClient = MagicMock()
+        usage_rating._rating_worker = MagicMock()
+        usage_rating.ObjectId = MagicMock(return_value='claim')
+
+        self._now = datetime(2016, 1, 20, 13, 12, 39)
+        usage_rating.datetime = MagicMock()
+        usage_rating.datetime.utcnow.return_value = self._now
+        spool.datetime = MagicMock()
+        spool.datetime.utcnow.return_value = self._now
+
+        usage_rating.settings.USAGE_RATING_CLAIM_TIMEOUT = 600
+        usage_rating.settings.USAGE_RATING_MAX_ATTEMPTS = 3
+        usage_rating.settings.USAGE_RATING_RETRY_DELAY = 60
+        usage_rating.settings.USAGE_RATING_RETRY_MAX_DELAY = 3600
+
+        # Run the ratings in the current thread
+        usage_rating.get_thread_pool = MagicMock()
+        usage_rating.get_thread_pool().map.side_effect = lambda func, docs: [func(doc) for doc in docs]
+
+    def tearDown(self):
+        reload(spool)
+        reload(usage_rating)
+
+    def test_rate_usage_sync(self):
+        usage_rating.settings.USAGE_RATING_ASYNC = False
+        self._db.wstore_usage_rating.insert_many.side_effect = lambda docs: [doc.update({'_id': 1}) for doc in docs]
+
+        failed = usage_rating.rate_usage_documents([RATING])
+
+        self.assertEquals(0, failed)
+
+        # Synchronous ratings are claimed by the current process
+        self._db.wstore_usage_rating.insert_many.assert_called_once_with([{
+            '_id': 1,
+            'rating': RATING,
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt': self._now,
+            'claim': 'claim',
+            'claimed_at': self._now,
+            'error': None
+        }])
+        usage_rating.UsageClient().rate_usage.assert_called_once_with(**RATING)
+        self._db.wstore_usage_rating.delete_one.assert_called_once_with({'_id': 1})
+        usage_rating._rating_worker.notify.assert_not_called()
+
+    def test_rate_usage_async(self):
+        usage_rating.settings.USAGE_RATING_ASYNC = True
+
+        self.assertEquals(None, usage_rating.rate_usage_documents([RATING]))
+
+        self._db.wstore_usage_rating.insert_many.assert_called_once_with([{
+            'rating': RATING,
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt': self._now,
+            'claim': None,
+            'claimed_at': None,
+            'error': None
+        }])
+        usage_rating._rating_worker.notify.assert_called_once_with()
+        usage_rating.UsageClient().rate_usage.assert_not_called()
+
+    def test_rate_usage_no_ratings(self):
+        self.assertEquals(0, usage_rating.rate_usage_documents([]))
+        self._db.wstore_usage_rating.insert_many.assert_not_called()
+
+    @parameterized.expand([
+        ('retry', 0, 'pending', 60),
+        ('backoff', 1, 'pending', 120),
+        ('max_attempts', 2, 'failed', 240)
+    ])
+    def test_rate_usage_failed(self, name, attempts, state, delay):
+        usage_rating.UsageClient().rate_usage.side_effect = Exception('Error')
+
+        self.assertFalse(usage_rating._rate_document({'_id': 1, 'rating': RATING, 'attempts': attempts}))
+
+        self._db.wstore_usage_rating.delete_one.assert_not_called()
+        self._db.wstore_usage_rating.update_one.assert_called_once_with({'_id': 1}, {
+            '$set': {
+                'state': state,
+                'attempts': attempts + 1,
+                'next_attempt': self._now + timedelta(seconds=delay),
+                'claim': None,
+                'claimed_at': None,
+                'error': 'Error'
+            }
+        })
+
+    def test_rate_pending_usage(self):
+        docs = [{'_id': 1, 'rating': RATING, 'attempts': 1}]
+        usage_rating._spool.claim_batch = MagicMock(side_effect=[docs, []])
+        self._db.wstore_usage_rating.find_one.return_value = None
+
+        self.assertEquals(None, usage_rating.rate_pending_usage())
+
+        self.assertEquals([
+            call(self._db, self._now, usage_rating.BATCH_SIZE),
+            call(self._db, self._now, usage_rating.BATCH_SIZE)
+        ], usage_rating._spool.claim_batch.call_args_list)
+        usage_rating.UsageClient().rate_usage.assert_called_once_with(**RATING)
+        self._db.wstore_usage_rating.delete_one.assert_called_once_with({'_id': 1})
+
+    def test_retry_failed_ratings(self):
+        self._db.wstore_usage_rating.update_many.return_value.modified_count = 2
+
+        self.assertEquals(2, usage_rating.retry_failed_ratings())
+
+        self._db.wstore_usage_rating.update_many.assert_called_once_with({'state': 'failed'}, {
+            '$set': {
+                'state': 'pending',
+                'attempts': 0,
+                'next_attempt': self._now
+            }
+        })
+
+
 class SDRCollectionTestCase(TestCase):
 
     tags = ('sdr',)
@@ -463,4 +742,110 @@ class SDRCollectionTestCase(TestCase):
                 self._manager_inst.update_usage.assert_called_once_with()
             else:
                 views.UsageClient().update_usage_state.assert_called_once_with('1', 'Rejected')
-                self.assertEquals(0, self._manager_inst.update_usage.call_count)
\ No newline at end of file
+                self.assertEquals(0, self._manager_inst.update_usage.call_count)
+
+
+class SDRBatchCollectionTestCase(TestCase):
+
+    tags = ('sdr',)
+
+    def setUp(self):
+        views.SDRBatchManager = MagicMock()
+        self._manager_inst = views.SDRBatchManager.return_value
+
+        views.UsageClient = MagicMock()
+        views.get_thread_pool = MagicMock()
+        views.get_thread_pool.return_value.map.side_effect = map
+
+        self.request = MagicMock()
+        self.request.user.is_anonymous.return_value = False
+        self.request.META.get.return_value = 'application/json'
+        self.request.GET.get.return_value = None
+
+    def tearDown(self):
+        reload(views)
+
+    def _create_batch(self, data):
+        self.request.body = json.dumps(data)
+
+        collection = views.ServiceRecordBatchCollection(permitted_methods=('POST',))
+        return collection.create(self.request)
+
+    def test_feed_sdr_batch(self):
+        sdrs = [deepcopy(BASIC_SDR) for i in range(4)]
+        for i, sdr in enumerate(sdrs):
+            sdr['id'] = unicode(i + 1)
+
+        self._manager_inst.validate_batch.return_value = [
+            None, ValueError('Value error'), None, PermissionDenied('Permission denied')]
+
+        response = self._create_batch(sdrs)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals({
+            'accepted': 2,
+            'rejected': [{
+                'id': '2',
+                'status': 422,
+                'error': 'Value error'
+            }, {
+                'id': '4',
+                'status': 403,
+                'error': 'Permission denied'
+            }],
+            'failed_updates': []
+        }, json.loads(response.content))
+
+        self._manager_inst.validate_batch.assert_called_once_with(sdrs)
+        self.assertEquals([
+            call('1', 'Guided'),
+            call('2', 'Rejected'),
+            call('3', 'Guided'),
+            call('4', 'Rejected')
+        ], views.UsageClient().update_usage_state.call_args_list)
+        self._manager_inst.update_usage.assert_called_once_with()
+
+    def test_feed_sdr_batch_state_error(self):
+        sdrs = [deepcopy(BASIC_SDR) for i in range(2)]
+        for i, sdr in enumerate(sdrs):
+            sdr['id'] = unicode(i + 1)
+
+        self._manager_inst.validate_batch.return_value = [None, None]
+
+        # The orders must be saved when the usage states are updated
+        def update_state(usage_id, state):
+            self._manager_inst.update_usage.assert_called_once_with()
+            if usage_id == '2':
+                raise HTTPError('Usage API error')
+
+        views.UsageClient().update_usage_state.side_effect = update_state
+
+        response = self._create_batch(sdrs)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals({
+            'accepted': 2,
+            'rejected': [],
+            'failed_updates': [{
+                'id': '2',
+                'state': 'Guided',
+                'error': 'Usage API error'
+            }]
+        }, json.loads(response.content))
+        self.assertEquals(2, views.UsageClient().update_usage_state.call_count)
+
+    @parameterized.expand([
+        ('not_list', {'id': '1'}, 'The request must contain a list of SDR documents including their id'),
+        ('missing_id', [{'status': 'Received'}], 'The request must contain a list of SDR documents including their id'),
+        ('too_many', [{'id': '1'}, {'id': '2'}], 'The number of SDR documents exceeds the max batch size of 1')
+    ])
+    @override_settings(SDR_BATCH_SIZE=1)
+    def test_feed_sdr_batch_invalid(self, name, data, msg):
+        response = self._create_batch(data)
+
+        self.assertEquals(422, response.status_code)
+        self.assertEquals({
+            'result': 'error',
+            'error': msg
+        }, json.loads(response.content))
+        self.assertEquals(0, self._manager_inst.validate_batch.call_count)
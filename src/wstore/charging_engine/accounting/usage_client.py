@@ -21,12 +21,13 @@
 
 from __future__ import unicode_literals
 
-import requests
+from urllib import urlencode
 from urlparse import urljoin, urlparse
 
 from django.conf import settings
 
 from wstore.charging_engine.accounting.errors import UsageError
+from wstore.store_commons import http_client
 
 
 class UsageClient(object):
@@ -57,7 +58,7 @@ class UsageClient(object):
             'Host': urlparse(settings.SITE).netloc
         }
 
-        r = requests.post(url, headers=headers, json=usage_item)
+        r = http_client.post(url, headers=headers, json=usage_item)
         r.raise_for_status()
 
         return r.json()
@@ -92,40 +93,70 @@ class UsageClient(object):
         path = 'api/usageManagement/v2/usageSpecification/' + spec_id
         url = urljoin(self._usage_api, path)
 
-        r = requests.delete(url)
+        r = http_client.delete(url)
         r.raise_for_status()
 
+    def _get_usage_pages(self, url, query, product_id):
+        offset = 0
+        page_size = settings.USAGE_PAGE_SIZE
+        prev_ids = None
+
+        while True:
+            page_query = query + [('offset', offset), ('limit', page_size)]
+            r = http_client.get(url + '?' + urlencode(page_query), headers={
+                'Accept': 'application/json'
+            })
+
+            r.raise_for_status()
+
+            raw_usage = r.json()
+
+            # If the API ignores the pagination params the same page is returned forever
+            page_ids = [usage_doc.get('id') for usage_doc in raw_usage]
+            if len(page_ids) and page_ids == prev_ids:
+                break
+
+            for usage_doc in raw_usage:
+                # Filter only the usage belonging to the specified product
+                if self._belongs_to_product(usage_doc, product_id):
+                    yield usage_doc
+
+            if len(raw_usage) < page_size:
+                break
+
+            prev_ids = page_ids
+            offset += page_size
+
     def get_customer_usage(self, customer, product_id, state=None):
         """
-        Retrieves the usage made by a customer filtered by service and status
+        Retrieves the usage made by a customer filtered by service and status. The usage
+        is downloaded in pages, so the documents are yielded as they are retrieved
         :param customer: username of the customer
         :param product_id: id of the acquired product being used
         :param state: state of the usage to be retrieved
-        :return: List of customer usages
+        :return: Generator of customer usages
         """
         # Get customer usage filtered by state
         path = 'api/usageManagement/v2/usage'
-        url = urljoin(self._usage_api, path) + '?relatedParty.id=' + customer
+        url = urljoin(self._usage_api, path)
+        query = [('relatedParty.id', customer.encode('utf-8'))]
 
         if state is not None:
             self._validate_state(state)
-            url += '&status=' + state
-
-        r = requests.get(url, headers={
-            'Accept': 'application/json'
-        })
+            query.append(('status', state))
 
-        r.raise_for_status()
+        # Filter by product in the usage API if supported, the filter is
+        # validated also locally since the API may ignore it
+        if settings.USAGE_PRODUCT_FILTER:
+            query.append(('usageCharacteristic.value', unicode(product_id).encode('utf-8')))
 
-        raw_usage = r.json()
-        # Filter only the usage belonging to the specified product
-        return [usage_doc for usage_doc in raw_usage if self._belongs_to_product(usage_doc, product_id)]
+        return self._get_usage_pages(url, query, product_id)
 
     def _patch_usage(self, usage_id, patch):
         path = 'api/usageManagement/v2/usage/' + unicode(usage_id)
         url = urljoin(self._usage_api, path)
 
-        r = requests.patch(url, json=patch)
+        r = http_client.patch(url, json=patch)
         r.raise_for_status()
 
     def update_usage_state(self, usage_id, state):
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from bson import ObjectId
+from datetime import datetime
+
+from django.conf import settings
+
+from wstore.charging_engine.accounting.usage_client import UsageClient
+from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.spool import Spool
+from wstore.store_commons.worker import ProcessWorker, get_thread_pool
+
+BATCH_SIZE = 500
+
+_spool = Spool('wstore_usage_rating', 'USAGE_RATING')
+
+
+def _rate_document(doc):
+    db = get_database_connection()
+
+    try:
+        UsageClient().rate_usage(**doc['rating'])
+    except Exception as e:
+        # Keep the rating with the error, so it is resumed later
+        _spool.schedule_retry(db, doc, error=unicode(e))
+        return False
+
+    db.wstore_usage_rating.delete_one({'_id': doc['_id']})
+    return True
+
+
+def _rate_documents(docs):
+    return get_thread_pool('usage_rating', 'USAGE_RATING_WORKERS').map(_rate_document, docs)
+
+
+def rate_usage_documents(ratings):
+    """
+    Rates the usage documents of a charge. The ratings are persisted before
+    being sent to the usage API, so failed ratings are resumed later
+    :param ratings: List of dicts with the arguments of UsageClient.rate_usage
+    :return: Number of ratings failed if processed synchronously, None otherwise
+    """
+    if not len(ratings):
+        return 0
+
+    fields = {'error': None}
+    rating_async = settings.USAGE_RATING_ASYNC
+
+    # Synchronous ratings are claimed by the current process, so the worker does not
+    # rate them unless the claim expires because the process has been interrupted
+    if not rating_async:
+        fields['claim'] = ObjectId()
+        fields['claimed_at'] = datetime.utcnow()
+
+    docs = [_spool.build_entry(dict(fields, rating=rating)) for rating in ratings]
+
+    db = get_database_connection()
+    db.wstore_usage_rating.insert_many(docs)
+
+    if rating_async:
+        _rating_worker.notify()
+        return None
+
+    return len([rated for rated in _rate_documents(docs) if not rated])
+
+
+def rate_pending_usage():
+    """
+    Rates the usage documents whose rating is pending or has failed
+    :return: The date of the next scheduled retry or None if there is not any
+    """
+    db = get_database_connection()
+
+    # Rated documents are removed and failed ones rescheduled, so every batch is different
+    docs = _spool.claim_batch(db, datetime.utcnow(), BATCH_SIZE)
+    while len(docs):
+        _rate_documents(docs)
+        docs = _spool.claim_batch(db, datetime.utcnow(), BATCH_SIZE)
+
+    return _spool.get_next_attempt(db)
+
+
+def retry_failed_ratings():
+    """
+    Schedules again the ratings which have reached the max number of attempts
+    :return: Number of ratings scheduled
+    """
+    return _spool.retry_failed(get_database_connection())
+
+
+def ensure_rating_index():
+    _spool.ensure_index(get_database_connection())
+
+
+_rating_worker = ProcessWorker(rate_pending_usage, 'USAGE_RATING_POLL', setup=ensure_rating_index)
@@ -22,14 +22,27 @@ from __future__ import unicode_literals
 
 import json
 
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
 
-from wstore.charging_engine.accounting.sdr_manager import SDRManager
+from wstore.charging_engine.accounting.sdr_manager import SDRManager, SDRBatchManager
 from wstore.charging_engine.accounting.usage_client import UsageClient
 from wstore.ordering.models import Order
 from wstore.asset_manager.resource_plugins.decorators import on_usage_refreshed
 from wstore.store_commons.resource import Resource
 from wstore.store_commons.utils.http import build_response, supported_request_mime_types
+from wstore.store_commons.worker import get_thread_pool
+
+
+def _get_error_info(error):
+    if isinstance(error, PermissionDenied):
+        return 403, unicode(error)
+
+    if isinstance(error, ValueError):
+        return 422, unicode(error)
+
+    return 500, 'The SDR document could not be processed due to an unexpected error'
 
 
 class ServiceRecordCollection(Resource):
@@ -71,6 +84,68 @@ class ServiceRecordCollection(Resource):
         return response
 
 
+class ServiceRecordBatchCollection(Resource):
+
+    # This method is used to load a list of SDR documents, which are
+    # validated together and update the related orders at once
+    @supported_request_mime_types(('application/json',))
+    def create(self, request):
+        try:
+            data = json.loads(request.body)
+        except:
+            return build_response(request, 400, 'The request does not contain a valid JSON object')
+
+        if not isinstance(data, list) or not all([isinstance(sdr, dict) and 'id' in sdr for sdr in data]):
+            return build_response(request, 422, 'The request must contain a list of SDR documents including their id')
+
+        if len(data) > settings.SDR_BATCH_SIZE:
+            return build_response(
+                request, 422, 'The number of SDR documents exceeds the max batch size of ' + unicode(settings.SDR_BATCH_SIZE))
+
+        sdr_manager = SDRBatchManager()
+        errors = sdr_manager.validate_batch(data)
+
+        states = []
+        rejected = []
+        for sdr, error in zip(data, errors):
+            if error is None:
+                states.append((sdr['id'], 'Guided'))
+            else:
+                code, msg = _get_error_info(error)
+                states.append((sdr['id'], 'Rejected'))
+                rejected.append({
+                    'id': sdr['id'],
+                    'status': code,
+                    'error': msg
+                })
+
+        # The orders are saved before updating the usage documents, so the state of
+        # the usage documents is never ahead of the accounting of the orders
+        sdr_manager.update_usage()
+
+        # Update usage documents state, failed updates are reported instead of failing the whole batch
+        usage_client = UsageClient()
+
+        def update_state(state):
+            try:
+                usage_client.update_usage_state(*state)
+            except Exception as e:
+                return {
+                    'id': state[0],
+                    'state': state[1],
+                    'error': unicode(e)
+                }
+
+        pool = get_thread_pool('sdr_batch', 'SDR_BATCH_WORKERS')
+        failed_updates = [error for error in pool.map(update_state, states) if error is not None]
+
+        return HttpResponse(json.dumps({
+            'accepted': len(data) - len(rejected),
+            'rejected': rejected,
+            'failed_updates': failed_updates
+        }), status=200, mimetype='application/json; charset=utf-8')
+
+
 class SDRRefreshCollection(Resource):
 
     @supported_request_mime_types(('application/json',))
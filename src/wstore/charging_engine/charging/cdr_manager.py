@@ -25,7 +25,7 @@ from decimal import Decimal
 
 from django.conf import settings
 
-from wstore.rss_adaptor.rss_adaptor import RSSAdaptorThread
+from wstore.rss_adaptor.cdr_outbox import enqueue_cdrs
 from wstore.store_commons.database import get_database_connection
 
 
@@ -57,18 +57,33 @@ class CDRManager(object):
             'order': order.order_id + ' ' + contract.item_id
         }
 
-    def _generate_cdr_part(self, part, event, description):
+    def _reserve_correlation_numbers(self, n_cdrs):
         # Create connection for raw database access
         db = get_database_connection()
 
-        # Take and increment the correlation number using
-        # the mongoDB atomic access in order to avoid race
-        # problems
-        corr_number = db.wstore_organization.find_and_modify(
+        # Take and increment the correlation number by the number of CDRs
+        # using the mongoDB atomic access in order to avoid race problems,
+        # the CDRs use the contiguous block of numbers starting at the returned one
+        return db.wstore_organization.find_and_modify(
             query={'_id': ObjectId(self._offering.owner_organization.pk)},
-            update={'$inc': {'correlation_number': 1}}
+            update={'$inc': {'correlation_number': n_cdrs}}
         )['correlation_number']
 
+    def _generate_cdrs(self, parts):
+        cdrs = []
+
+        if not len(parts):
+            return cdrs
+
+        corr_number = self._reserve_correlation_numbers(len(parts))
+
+        for part, event, description in parts:
+            cdrs.append(self._generate_cdr_part(part, event, description, corr_number))
+            corr_number += 1
+
+        return cdrs
+
+    def _generate_cdr_part(self, part, event, description, corr_number):
         cdr_part = {
             'correlation': unicode(corr_number),
             'cost_value': unicode(part['value']),
@@ -82,7 +97,7 @@ class CDRManager(object):
 
     def generate_cdr(self, applied_parts, time_stamp):
 
-        cdrs = []
+        parts = []
 
         self._cdr_info['time_stamp'] = time_stamp
         self._cdr_info['type'] = 'C'
@@ -93,7 +108,7 @@ class CDRManager(object):
             # A cdr is generated for every price part
             for part in applied_parts['single_payment']:
                 description = 'One time payment: ' + unicode(part['value']) + ' ' + self._cdr_info['cost_currency']
-                cdrs.append(self._generate_cdr_part(part, 'One time payment event', description))
+                parts.append((part, 'One time payment event', description))
 
         if 'subscription' in applied_parts:
 
@@ -102,7 +117,7 @@ class CDRManager(object):
                 description = 'Recurring payment: ' + unicode(part['value']) + ' ' + self._cdr_info['cost_currency'] \
                               + ' ' + part['unit']
 
-                cdrs.append(self._generate_cdr_part(part, 'Recurring payment event', description))
+                parts.append((part, 'Recurring payment event', description))
 
         if 'accounting' in applied_parts:
 
@@ -119,11 +134,12 @@ class CDRManager(object):
                     use += int(sdr['value'])
                     description = 'Fee per ' + part['model']['unit'] + ', Consumption: ' + unicode(use)
 
-                cdrs.append(self._generate_cdr_part(use_part, 'Pay per use event', description))
+                parts.append((use_part, 'Pay per use event', description))
+
+        cdrs = self._generate_cdrs(parts)
 
         # Send the created CDRs to the Revenue Sharing System
-        r = RSSAdaptorThread(cdrs)
-        r.start()
+        enqueue_cdrs(cdrs)
 
     def refund_cdrs(self, price, duty_free, time_stamp):
         self._cdr_info['time_stamp'] = time_stamp
@@ -136,8 +152,7 @@ class CDRManager(object):
         }
 
         description = 'Refund event: ' + unicode(price) + ' ' + self._cdr_info['cost_currency']
-        cdrs = [self._generate_cdr_part(aggregated_part, 'Refund event', description)]
+        cdrs = self._generate_cdrs([(aggregated_part, 'Refund event', description)])
 
         # Send the created CDRs to the Revenue Sharing System
-        r = RSSAdaptorThread(cdrs)
-        r.start()
+        enqueue_cdrs(cdrs)
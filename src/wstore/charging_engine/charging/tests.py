@@ -85,7 +85,7 @@ class CDRGenerationTestCase(TestCase):
 
     def setUp(self):
         # Create Mocks
-        cdr_manager.RSSAdaptorThread = MagicMock()
+        cdr_manager.enqueue_cdrs = MagicMock()
 
         self._conn = MagicMock()
         cdr_manager.get_database_connection = MagicMock()
@@ -163,8 +163,36 @@ class CDRGenerationTestCase(TestCase):
             update={'$inc': {'correlation_number': 1}}
         )
 
-        cdr_manager.RSSAdaptorThread.assert_called_once_with(exp_cdrs)
-        cdr_manager.RSSAdaptorThread().start.assert_called_once_with()
+        cdr_manager.enqueue_cdrs.assert_called_once_with(exp_cdrs)
+
+    def test_cdr_correlation_block(self):
+        self._conn.wstore_organization.find_and_modify.side_effect = [{'correlation_number': 7}]
+
+        cdr_m = cdr_manager.CDRManager(self._order, self._contract)
+        cdr_m.generate_cdr({
+            'single_payment': [{
+                'value': Decimal('12'),
+                'duty_free': Decimal('10')
+            }],
+            'subscription': [{
+                'value': Decimal('12'),
+                'unit': 'monthly',
+                'duty_free': Decimal('10')
+            }, {
+                'value': Decimal('6'),
+                'unit': 'weekly',
+                'duty_free': Decimal('5')
+            }]
+        }, '2015-10-21 06:13:26.661650')
+
+        # A single block of correlation numbers is reserved for all the CDRs
+        self._conn.wstore_organization.find_and_modify.assert_called_once_with(
+            query={'_id': ObjectId('61004aba5e05acc115f022f0')},
+            update={'$inc': {'correlation_number': 3}}
+        )
+
+        cdrs = cdr_manager.enqueue_cdrs.call_args[0][0]
+        self.assertEquals(['7', '8', '9'], [cdr['correlation'] for cdr in cdrs])
 
     def test_refund_cdr_generation(self):
         exp_cdr = [{
@@ -192,8 +220,7 @@ class CDRGenerationTestCase(TestCase):
             update={'$inc': {'correlation_number': 1}}
         )
 
-        cdr_manager.RSSAdaptorThread.assert_called_once_with(exp_cdr)
-        cdr_manager.RSSAdaptorThread().start.assert_called_once_with()
+        cdr_manager.enqueue_cdrs.assert_called_once_with(exp_cdr)
 
 
 TIMESTAMP = datetime(2016, 06, 21, 10, 0, 0)
@@ -266,33 +293,19 @@ class BillingClientTestCase(TestCase):
         site = 'http://extpath.com:8080/'
         billing_client.settings.SITE = site
 
-        billing_client.Request = MagicMock()
-        billing_client.Session = MagicMock()
-        session = MagicMock()
-        billing_client.Session.return_value = session
-
-        preped = MagicMock()
-        preped.headers = {}
-        session.prepare_request.return_value = preped
+        billing_client.http_client = MagicMock()
 
         # Call the method to test
         client = billing_client.BillingClient()
         client.create_charge(charge, '1', start_date=start_date, end_date=end_date)
 
         # Validate calls
-        billing_client.Request.assert_called_once_with(
-            'POST',
+        billing_client.http_client.post.assert_called_once_with(
             'http://billing.api.com/api/billingManagement/v2/appliedCustomerBillingCharge',
-            json=exp_body
-        )
-
-        billing_client.Session.assert_called_once_with()
-        session.prepare_request.assert_called_once_with(billing_client.Request())
-
-        self.assertEquals(
-            'extpath.com:8080',
-            preped.headers['Host']
+            json=exp_body,
+            headers={
+                'Host': 'extpath.com:8080'
+            }
         )
 
-        session.send.assert_called_once_with(preped)
-        session.send().raise_for_status.assert_called_once_with()
+        billing_client.http_client.post().raise_for_status.assert_called_once_with()
@@ -21,24 +21,25 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
-import threading
 import importlib
 from bson import ObjectId
 from datetime import datetime, timedelta
 
 from django.conf import settings
+from wstore.asset_manager.entitlement_index import grant_entitlements
 from wstore.charging_engine.accounting.sdr_manager import SDRManager
 from wstore.charging_engine.accounting.usage_client import UsageClient
+from wstore.charging_engine.accounting.usage_rating import rate_usage_documents
 
 from wstore.charging_engine.price_resolver import PriceResolver
 from wstore.charging_engine.charging.cdr_manager import CDRManager
 from wstore.charging_engine.charging.billing_client import BillingClient
 from wstore.charging_engine.invoice_builder import InvoiceBuilder
+from wstore.charging_engine.payment_timeout import get_payment_deadline, schedule_payment_timeout
 from wstore.ordering.errors import OrderingError
-from wstore.ordering.models import Order, Charge, Payment
-from wstore.ordering.ordering_client import OrderingClient
-from wstore.store_commons.database import get_database_connection
+from wstore.ordering.models import Charge, Payment
 from wstore.admin.users.notification_handler import NotificationsHandler
+from wstore.store_commons.database import get_database_connection
 from wstore.store_commons.utils.units import recurring_periods
 
 
@@ -58,52 +59,6 @@ class ChargingEngine:
             'usage': self._end_use_charge
         }
 
-    def _initial_charge_timeout(self, order):
-        ordering_client = OrderingClient()
-        raw_order = ordering_client.get_order(order.order_id)
-
-        # Setting all the items as Failed, set the whole order as failed
-        # ordering_client.update_state(raw_order, 'Failed')
-        ordering_client.update_items_state(raw_order, 'Failed')
-
-        order.delete()
-
-    def _renew_charge_timeout(self, order):
-        order.state = 'paid'
-        order.pending_payment = None
-
-        order.save()
-
-    def _timeout_handler(self):
-
-        db = get_database_connection()
-
-        # Uses an atomic operation to get and set the _lock value in the purchase
-        # document
-        pre_value = db.wstore_order.find_one_and_update(
-            {'_id': ObjectId(self._order.pk)},
-            {'$set': {'_lock': True}}
-        )
-
-        # If _lock not exists or is set to false means that this function has
-        # acquired the resource
-        if '_lock' not in pre_value or not pre_value['_lock']:
-
-            # Only rollback if the state is pending
-            if pre_value['state'] == 'pending':
-                order = Order.objects.get(pk=self._order.pk)
-                timeout_processors = {
-                    'initial': self._initial_charge_timeout,
-                    'recurring': self._renew_charge_timeout,
-                    'usage': self._renew_charge_timeout
-                }
-                timeout_processors[self._concept](order)
-
-            db.wstore_order.find_one_and_update(
-                {'_id': ObjectId(self._order.pk)},
-                {'$set': {'_lock': False}}
-            )
-
     def _charge_client(self, transactions):
 
         # Load payment client
@@ -118,10 +73,6 @@ class ChargingEngine:
         client.start_redirection_payment(transactions)
         checkout_url = client.get_checkout_url()
 
-        # Set timeout for PayPal transaction to 5 minutes
-        t = threading.Timer(300, self._timeout_handler)
-        t.start()
-
         return checkout_url
 
     def _calculate_renovation_date(self, unit):
@@ -171,20 +122,22 @@ class ChargingEngine:
 
     def _end_use_charge(self, contract, transaction):
         # Change applied usage documents SDR Guided to Rated
-        usage_client = UsageClient()
+        ratings = []
 
         for sdr_info in transaction['applied_accounting']:
             for sdr in sdr_info['accounting']:
 
-                usage_client.rate_usage(
-                    sdr['usage_id'],
-                    unicode(contract.last_charge),
-                    sdr['duty_free'],
-                    sdr['price'],
-                    sdr_info['model']['tax_rate'],
-                    transaction['currency'],
-                    contract.product_id
-                )
+                ratings.append({
+                    'usage_id': sdr['usage_id'],
+                    'timestamp': unicode(contract.last_charge),
+                    'duty_free': sdr['duty_free'],
+                    'price': sdr['price'],
+                    'rate': sdr_info['model']['tax_rate'],
+                    'currency': transaction['currency'],
+                    'product_id': contract.product_id
+                })
+
+        rate_usage_documents(ratings)
 
         transaction['related_model']['accounting'] = transaction['applied_accounting']
 
@@ -206,6 +159,23 @@ class ChargingEngine:
         except:
             pass
 
+    def _clear_failed_invoices(self, failed):
+        db = get_database_connection()
+
+        # Only the invoice field of the charges is updated, since the order may have been modified meanwhile
+        for i, contract in enumerate(self._order.contracts):
+            for j, charge in enumerate(contract.charges):
+                if charge.invoice in failed:
+                    charge.invoice = ''
+                    db.wstore_order.update_one(
+                        {'_id': ObjectId(self._order.pk)}, {'$set': {'contracts.{}.charges.{}.invoice'.format(i, j): ''}})
+
+    def _invoices_ready(self, concept, transactions, failed):
+        if len(failed):
+            self._clear_failed_invoices(failed)
+
+        self._send_notification(concept, transactions)
+
     def end_charging(self, transactions, free_contracts, concept):
         """
         Process the second step of a payment once the customer has approved the charge
@@ -221,14 +191,19 @@ class ChargingEngine:
         time_stamp = datetime.utcnow()
 
         self._order.pending_payment = None
+        self._order.payment_deadline = None
 
         invoice_builder = InvoiceBuilder(self._order)
         billing_client = BillingClient() if concept != 'initial' else None
 
+        acquired = []
         for transaction in transactions:
             contract = self._order.get_item_contract(transaction['item'])
             contract.last_charge = time_stamp
 
+            if concept == 'initial':
+                acquired.append(contract)
+
             valid_from, valid_to = self.end_processors[concept](contract, transaction)
 
             # If the customer has been charged create the CDR
@@ -252,6 +227,7 @@ class ChargingEngine:
                 invoice=invoice_path
             )
             contract.charges.append(charge)
+            contract.update_next_deadline(self._order.date)
 
             # Send the charge to the billing API to allow user accesses
             if concept != 'initial':
@@ -259,11 +235,23 @@ class ChargingEngine:
                 billing_client.create_charge(charge, contract.product_id, start_date=valid_from, end_date=valid_to)
 
         for free in free_contracts:
+            # The free contracts of a pending payment are copies, so the contract of the order is updated.
+            # Contracts only priced by usage are not charged now, but their usage payment is scheduled
+            contract = self._order.get_item_contract(free.item_id)
+            contract.update_next_deadline(self._order.date)
+            acquired.append(contract)
+
             self._order.owner_organization.acquired_offerings.append(free.offering.pk)
 
         self._order.owner_organization.save()
         self._order.save()
-        self._send_notification(concept, transactions)
+
+        # Allow the customer to download the acquired assets
+        if len(acquired):
+            grant_entitlements(self._order, acquired)
+
+        # The invoices are attached to the notifications, so they are sent once the invoices exist
+        invoice_builder.when_ready(lambda failed: self._invoices_ready(concept, transactions, failed))
 
     def _save_pending_charge(self, transactions, free_contracts=[]):
         pending_payment = Payment(
@@ -273,16 +261,25 @@ class ChargingEngine:
         )
 
         self._order.pending_payment = pending_payment
+
+        # Set timeout for PayPal transaction, the deadline is persisted in the order
+        # so it is served by the timeout worker even if the process is restarted
+        self._order.payment_deadline = get_payment_deadline()
         self._order.save()
 
-    def _append_transaction(self, transactions, contract, related_model, accounting=None):
+        schedule_payment_timeout()
+
+    def _append_transaction(self, transactions, contract, related_model):
         # Call the price resolver
-        price, duty_free = self._price_resolver.resolve_price(related_model, accounting)
+        price, duty_free = self._price_resolver.resolve_price(related_model)
 
         if 'alteration' in related_model and not self._price_resolver.is_altered():
             del related_model['alteration']
 
-        transaction = {
+        transactions.append(self._build_transaction(contract, related_model, price, duty_free))
+
+    def _build_transaction(self, contract, related_model, price, duty_free):
+        return {
             'price': price,
             'duty_free': duty_free,
             'description': contract.offering.description,
@@ -291,12 +288,6 @@ class ChargingEngine:
             'item': contract.item_id
         }
 
-        # Get the applied accounting info is needed
-        if accounting is not None:
-            transaction['applied_accounting'] = self._price_resolver.get_applied_sdr()
-
-        transactions.append(transaction)
-
     def _process_initial_charge(self, contracts):
         """
         Resolves initial charges, which can include single payments or the initial payment of a subscription
@@ -394,6 +385,7 @@ class ChargingEngine:
         sdr_manager = SDRManager()
         sdrs = []
 
+        # Usage documents are consumed as they are downloaded, only the SDR values are kept
         for usage_document in usage:
             sdr_values = sdr_manager.get_sdr_values(usage_document)
             sdr_values.update({'usage_id': usage_document['id']})
@@ -408,7 +400,7 @@ class ChargingEngine:
         """
         self._order.state = 'pending'
 
-        transactions = []
+        usage_contracts = []
         usage_client = UsageClient()
         for contract in contracts:
             if 'pay_per_use' not in contract.pricing_model:
@@ -426,12 +418,20 @@ class ChargingEngine:
                 related_model['alteration'] = contract.pricing_model['alteration']
 
             if len(accounting) > 0:
-                self._append_transaction(
-                    transactions,
-                    contract,
-                    related_model,
-                    accounting=accounting
-                )
+                usage_contracts.append((contract, related_model, accounting))
+
+        # Price all the usage of the order in a single call to the price resolver
+        prices = self._price_resolver.resolve_prices(
+            [(usage_model, usage_accounting) for _, usage_model, usage_accounting in usage_contracts])
+
+        transactions = []
+        for (contract, related_model, accounting), price in zip(usage_contracts, prices):
+            if 'alteration' in related_model and not price['altered']:
+                del related_model['alteration']
+
+            transaction = self._build_transaction(contract, related_model, price['price'], price['duty_free'])
+            transaction['applied_accounting'] = price['applied_sdrs']
+            transactions.append(transaction)
 
         return self._execute_renovation_transactions(transactions, 'There is not usage payments to renovate')
 
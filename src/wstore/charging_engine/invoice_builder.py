@@ -22,7 +22,10 @@ from __future__ import unicode_literals
 
 import os
 import codecs
+import shutil
 import subprocess
+import tempfile
+import threading
 from copy import deepcopy
 from datetime import datetime
 from decimal import Decimal
@@ -30,11 +33,68 @@ from decimal import Decimal
 from django.template import loader, Context
 from django.conf import settings
 
+from wstore.charging_engine.invoice_storage import get_invoice_storage, reserve_invoice, release_invoice, \
+    store_invoice
+from wstore.store_commons.worker import get_thread_pool
+
+
+TEMPLATES = {
+    'initial': 'contracting/bill_template_initial.html',
+    'recurring': 'contracting/bill_template_renovation.html',
+    'usage': 'contracting/bill_template_use.html'
+}
+
+_templates = {}
+
+
+def _get_template(type_):
+    # Templates are loaded and compiled once per process
+    if type_ not in _templates:
+        _templates[type_] = loader.get_template(TEMPLATES[type_])
+
+    return _templates[type_]
+
+
+def _convert_invoice(job_dir, key):
+    """
+    Compiles the HTML invoice of a job and stores the PDF with the reserved key,
+    the job directory is removed in any case
+    """
+    try:
+        raw_invoice_path = os.path.join(job_dir, 'invoice.html')
+        pdf_path = os.path.join(job_dir, 'invoice.pdf')
+
+        code = subprocess.call([settings.BASEDIR + '/create_invoice.sh', raw_invoice_path, pdf_path])
+
+        if code != 0 or not os.path.exists(pdf_path):
+            raise IOError('The PDF invoice could not be generated')
+
+        store_invoice(pdf_path, key)
+
+    except:
+        # Reserved keys of failed invoices are released
+        release_invoice(key)
+        raise
+
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def _try_convert_invoice(job_dir, key):
+    # Failures of background conversions are reported to the builder instead of being raised
+    try:
+        _convert_invoice(job_dir, key)
+    except Exception:
+        return False
+
+    return True
+
 
 class InvoiceBuilder(object):
 
     def __init__(self, order):
         self._order = order
+        self._conversions = []
         self._template_processors = {
             'initial': self._get_initial_parts,
             'recurring': self._get_renovation_parts,
@@ -74,9 +134,7 @@ class InvoiceBuilder(object):
         self._process_subscription_parts(applied_parts, parts)
         self._process_alteration_parts(applied_parts, parts)
 
-        # Get the bill template
-        bill_template = loader.get_template('contracting/bill_template_initial.html')
-        return parts, bill_template
+        return parts
 
     def _process_usage_component(self, applied_parts, parts, comp_name, part_name, part_sub):
         # if comp_name in applied_parts and len(applied_parts[comp_name]) > 0:
@@ -112,9 +170,7 @@ class InvoiceBuilder(object):
         self._process_subscription_parts(applied_parts, parts)
         self._process_alteration_parts(applied_parts, parts)
 
-        # Get the bill template
-        bill_template = loader.get_template('contracting/bill_template_renovation.html')
-        return parts, bill_template
+        return parts
 
     def _get_use_parts(self, transaction):
         applied_parts = transaction['applied_accounting']
@@ -128,9 +184,7 @@ class InvoiceBuilder(object):
         self._process_usage_parts(applied_parts, parts)
         self._process_alteration_parts(applied_parts, parts)
 
-        # Get the bill template
-        bill_template = loader.get_template('contracting/bill_template_use.html')
-        return parts, bill_template
+        return parts
 
     def _fill_alts_context(self, context, parts):
         compare_table = {'eq': '=', 'lt': '<', 'gt': '>', 'le': '<=', 'ge': '>='}
@@ -189,15 +243,6 @@ class InvoiceBuilder(object):
         else:
             context['deduction'] = False
 
-    def _avoid_existing_name(self, name, ix):
-        new_name = name + '_' + unicode(ix) + '.pdf'
-        path = os.path.join(settings.BILL_ROOT, new_name)
-
-        if os.path.exists(path):
-            path, new_name = self._avoid_existing_name(name, ix + 1)
-
-        return path, new_name
-
     def generate_invoice(self, contract, transaction, type_):
         """
         Create a PDF invoice based on the price components used to charge the user
@@ -205,8 +250,8 @@ class InvoiceBuilder(object):
         :param type_: Type of the charge, initial, renovation, pay-per-use
         """
 
-        # Get invoice context parts and invoice template
-        parts, bill_template = self._template_processors[type_](transaction)
+        # Get invoice context parts
+        parts = self._template_processors[type_](transaction)
 
         tax = self._order.tax_address
         customer_profile = self._order.customer.userprofile
@@ -247,25 +292,49 @@ class InvoiceBuilder(object):
         self._context_processors[type_](context, parts)
 
         # Render the invoice template
-        bill_code = bill_template.render(Context(context))
+        bill_code = _get_template(type_).render(Context(context))
 
-        # Create the bill code file
-        invoice_id = self._order.pk + '_' + contract.item_id + '_' + date
-        raw_invoice_path = os.path.join(settings.BILL_ROOT, invoice_id + '.html')
+        # Create the bill code file in a directory owned by the job
+        job_dir = tempfile.mkdtemp(prefix='invoice-')
 
-        f = codecs.open(raw_invoice_path, 'wb', 'utf-8')
-        f.write(bill_code)
-        f.close()
+        try:
+            f = codecs.open(os.path.join(job_dir, 'invoice.html'), 'wb', 'utf-8')
+            f.write(bill_code)
+            f.close()
 
-        invoice_path, invoice_name = self._avoid_existing_name(invoice_id, 0)
+            key = reserve_invoice(self._order.pk, contract.item_id, date)
+        except:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise
 
         # Compile the bill file
-        subprocess.call([settings.BASEDIR + '/create_invoice.sh', raw_invoice_path, invoice_path])
+        url = get_invoice_storage().get_url(key)
 
-        # Remove temporal files
-        for file_ in os.listdir(settings.BILL_ROOT):
+        # Each worker thread runs a PDF conversion process, so the pool bounds the running conversions
+        pool = get_thread_pool('invoices', 'INVOICE_WORKERS')
 
-            if not file_.endswith('.pdf'):
-                os.remove(os.path.join(settings.BILL_ROOT, file_))
+        if settings.INVOICE_ASYNC:
+            # The returned URL is valid once the conversion finishes, see when_ready
+            self._conversions.append((url, pool.apply_async(_try_convert_invoice, (job_dir, key))))
+        else:
+            pool.apply(_convert_invoice, (job_dir, key))
 
-        return os.path.join(settings.MEDIA_URL, 'bills/' + invoice_name)
+        return url
+
+    def when_ready(self, callback):
+        """
+        Calls the given callback once the generated invoices have been converted, the conversions
+        running in background are waited by a separate thread
+        :param callback: Callable receiving the list of URLs of the invoices which could not be generated
+        """
+        conversions, self._conversions = self._conversions, []
+
+        def wait_conversions():
+            callback([url for url, result in conversions if not result.get()])
+
+        if not len(conversions):
+            callback([])
+        else:
+            thread = threading.Thread(target=wait_conversions)
+            thread.daemon = True
+            thread.start()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import importlib
+import os
+import shutil
+from datetime import datetime
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+from django.conf import settings
+
+from wstore.store_commons.database import get_database_connection
+
+PENDING = 'pending'
+READY = 'ready'
+
+
+class InvoiceStorage(object):
+    """
+    Interface of the backends storing the PDF invoices. Invoices are identified by
+    a relative key, which is also used to build the URL where they are served
+    """
+
+    def save(self, local_path, key):
+        """
+        Stores the given file as the invoice identified by key, the local file is consumed
+        """
+        raise NotImplementedError()
+
+    def get_url(self, key):
+        return os.path.join(settings.MEDIA_URL, 'bills/' + key)
+
+
+class LocalInvoiceStorage(InvoiceStorage):
+    """
+    Stores the invoices under BILL_ROOT using the directories included in the key
+    """
+
+    def _get_path(self, key):
+        return os.path.join(settings.BILL_ROOT, key)
+
+    def save(self, local_path, key):
+        path = self._get_path(key)
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            # The shard directory may have been created by a concurrent invoice
+            if e.errno != errno.EEXIST:
+                raise
+
+        shutil.move(local_path, path)
+
+
+_storage = None
+_index_ready = False
+
+
+def get_invoice_storage():
+    """
+    Returns the storage backend configured in INVOICE_STORAGE
+    """
+    global _storage
+
+    if _storage is None:
+        module, class_name = settings.INVOICE_STORAGE.rsplit('.', 1)
+        _storage = getattr(importlib.import_module(module), class_name)()
+
+    return _storage
+
+
+def get_invoice_key(order_id, item_id, date, ix):
+    """
+    Builds the key of an invoice, invoices are sharded by month and by a hash of the order
+    :param date: Date of the invoice in YYYY-MM-DD format
+    :param ix: Number of the invoice among the ones of the same item and date
+    """
+    year, month = date.split('-')[:2]
+    shard = hashlib.sha1(order_id.encode('utf-8')).hexdigest()[:2]
+    name = '{}_{}_{}_{}.pdf'.format(order_id, item_id, date, ix)
+
+    return '/'.join([year, month, shard, name])
+
+
+def reserve_invoice(order_id, item_id, date):
+    """
+    Registers a new invoice in the index, the unique key of the index entry
+    ensures that concurrent invoices do not get the same key
+    :return: The key of the invoice
+    """
+    # The index is created by the first reservation of the process
+    if not _index_ready:
+        ensure_invoice_index()
+
+    db = get_database_connection()
+    query = {'order': order_id, 'item': item_id, 'date': date}
+
+    ix = db.wstore_invoices.find(query).count()
+    while True:
+        key = get_invoice_key(order_id, item_id, date, ix)
+        doc = {
+            '_id': key,
+            'state': PENDING,
+            'created': datetime.utcnow()
+        }
+        doc.update(query)
+
+        try:
+            db.wstore_invoices.insert_one(doc)
+        except DuplicateKeyError:
+            ix += 1
+        else:
+            return key
+
+
+def store_invoice(local_path, key):
+    """
+    Saves the generated PDF in the storage backend and marks the invoice as ready
+    """
+    get_invoice_storage().save(local_path, key)
+
+    db = get_database_connection()
+    db.wstore_invoices.update_one({'_id': key}, {'$set': {'state': READY}})
+
+
+def release_invoice(key):
+    db = get_database_connection()
+    db.wstore_invoices.delete_one({'_id': key, 'state': PENDING})
+
+
+def ensure_invoice_index():
+    global _index_ready
+
+    db = get_database_connection()
+    db.wstore_invoices.create_index([('order', ASCENDING), ('item', ASCENDING), ('date', ASCENDING)])
+    _index_ready = True
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+import random
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wstore.charging_engine.accounting.sdr_manager import SDRManager
+
+
+DEFAULT_DOCUMENTS = 100000
+ROUNDS = 3
+
+
+def _legacy_get_datetime(raw_time):
+    # Date parsing used before the precompiled parser, kept as the baseline of the benchmark
+    if '+' in raw_time:
+        time_ = raw_time.split('+')[0] + '.0'
+    else:
+        sp_time = raw_time.split('.')
+        time_ = sp_time[0] + '.' + sp_time[1][:3]
+
+    try:
+        return datetime.strptime(time_, '%Y-%m-%dT%H:%M:%S.%f')
+    except ValueError:
+        return datetime.strptime(time_, '%Y-%m-%d %H:%M:%S.%f')
+
+
+def _legacy_get_sdr_values(sdr):
+    expected_fields = ['orderid', 'productid', 'correlationnumber', 'unit', 'value']
+    values = {}
+
+    for usage_value in sdr['usageCharacteristic']:
+        if usage_value['name'].lower() in expected_fields:
+            if usage_value['name'].lower() not in values:
+                values[usage_value['name'].lower()] = usage_value['value']
+            else:
+                raise ValueError('Only a value is supported for characteristic ' + usage_value['name'])
+
+    if len(values) != len(expected_fields):
+        raise ValueError('Missing mandatory characteristics, must be: orderId, productId, correlationNumber, unit, value')
+
+    return values
+
+
+def build_usage_documents(size, seed=0):
+    """
+    Builds usage documents as returned by the usage API, using the different date
+    formats accepted by the SDR API and some non mandatory characteristics
+    :param size: Number of documents
+    :return: List of usage documents
+    """
+    rnd = random.Random(seed)
+    date_formats = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S+01:00']
+    start = datetime(2017, 1, 1)
+
+    documents = []
+    for i in range(size):
+        date = start + timedelta(seconds=i, microseconds=rnd.randint(0, 999999))
+        characteristics = [
+            {'name': 'orderId', 'value': unicode(rnd.randint(1, 1000))},
+            {'name': 'productId', 'value': unicode(rnd.randint(1, 5000))},
+            {'name': 'correlationNumber', 'value': unicode(i)},
+            {'name': 'unit', 'value': rnd.choice(['call', 'megabyte', 'hour'])},
+            {'name': 'value', 'value': unicode(rnd.randint(1, 100))}
+        ]
+
+        if rnd.random() < 0.3:
+            characteristics.insert(rnd.randint(0, 5), {'name': 'region', 'value': 'eu-west'})
+
+        documents.append({
+            'id': unicode(i),
+            'href': 'http://localhost:8080/DSUsageManagement/api/usageManagement/v2/usage/' + unicode(i),
+            'date': date.strftime(rnd.choice(date_formats)),
+            'status': 'Guided',
+            'type': 'event',
+            'usageCharacteristic': characteristics,
+            'relatedParty': [{'role': 'customer', 'id': 'customer' + unicode(rnd.randint(1, 200))}],
+            'usageSpecification': {'href': 'http://localhost:8080/usageSpecification/1', 'name': 'spec'}
+        })
+
+    return documents
+
+
+class Command(BaseCommand):
+
+    help = 'Measures the throughput of the SDR decoding: benchmark_sdr [documents]'
+
+    def _measure(self, documents, get_values, get_datetime):
+        best = None
+        for i in range(ROUNDS):
+            start = time.time()
+            for document in documents:
+                get_values(document)
+                get_datetime(document['date'])
+
+            elapsed = time.time() - start
+            best = elapsed if best is None or elapsed < best else best
+
+        return len(documents) / best if best else float('inf')
+
+    def handle(self, *args, **options):
+        """
+        Decodes a set of generated usage documents with the current SDR parser and
+        with the previous implementation, printing the documents decoded per second
+        """
+        try:
+            size = int(args[0]) if len(args) else DEFAULT_DOCUMENTS
+        except ValueError:
+            raise CommandError('The number of documents must be an integer')
+
+        documents = build_usage_documents(size)
+        sdr_manager = SDRManager()
+
+        # Both implementations must produce the same results
+        for document in documents[:1000]:
+            if sdr_manager.get_sdr_values(document) != _legacy_get_sdr_values(document) or \
+                    sdr_manager._get_datetime(document['date']) != _legacy_get_datetime(document['date']):
+                raise CommandError('The decoded SDR {} does not match the previous implementation'.format(document['id']))
+
+        legacy = self._measure(documents, _legacy_get_sdr_values, _legacy_get_datetime)
+        current = self._measure(documents, sdr_manager.get_sdr_values, sdr_manager._get_datetime)
+
+        self.stdout.write('Decoded {} usage documents, best of {} rounds\n'.format(size, ROUNDS))
+        self.stdout.write('Previous parser: {:.0f} documents/s\n'.format(legacy))
+        self.stdout.write('Current parser: {:.0f} documents/s ({:.1f}x)\n'.format(current, current / legacy))
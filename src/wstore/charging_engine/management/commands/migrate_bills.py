@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import os
+import re
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from wstore.charging_engine.invoice_storage import ensure_invoice_index, get_invoice_key, get_invoice_storage, READY
+from wstore.ordering.models import Order
+from wstore.store_commons.database import get_database_connection
+
+
+BILL_NAME = re.compile(r'^(?P<order>[^_]+)_(?P<item>.+)_(?P<date>\d{4}-\d{2}-\d{2})_(?P<ix>\d+)\.pdf$')
+
+
+class Command(BaseCommand):
+
+    def _migrate_bill(self, db, storage, name, bill):
+        key = get_invoice_key(bill['order'], bill['item'], bill['date'], bill['ix'])
+
+        storage.save(os.path.join(settings.BILL_ROOT, name), key)
+        db.wstore_invoices.update_one({'_id': key}, {
+            '$set': {
+                'order': bill['order'],
+                'item': bill['item'],
+                'date': bill['date'],
+                'state': READY,
+                'created': datetime.utcnow()
+            }
+        }, upsert=True)
+
+        return storage.get_url(key)
+
+    def _update_charges(self, order_id, urls):
+        try:
+            order = Order.objects.get(pk=order_id)
+        except Order.DoesNotExist:
+            return
+
+        for contract in order.contracts:
+            for charge in contract.charges:
+                charge.invoice = urls.get(charge.invoice, charge.invoice)
+
+        order.save()
+
+    def handle(self, *args, **options):
+        """
+        Moves the bills stored in the flat BILL_ROOT directory to the configured
+        invoice storage, registering them in the invoice index and updating the
+        invoice URLs of the charges
+        """
+        ensure_invoice_index()
+
+        db = get_database_connection()
+        storage = get_invoice_storage()
+
+        old_url = os.path.join(settings.MEDIA_URL, 'bills/')
+
+        bills = {}
+        skipped = 0
+        for name in os.listdir(settings.BILL_ROOT):
+            match = BILL_NAME.match(name)
+
+            if match is None or not os.path.isfile(os.path.join(settings.BILL_ROOT, name)):
+                skipped += 1
+                continue
+
+            bill = match.groupdict()
+            bills.setdefault(bill['order'], []).append((name, bill))
+
+        # Bills are migrated by order, so the charges are updated as soon as their bills are moved
+        for order_id, order_bills in bills.items():
+            urls = {}
+            for name, bill_info in order_bills:
+                urls[old_url + name] = self._migrate_bill(db, storage, name, bill_info)
+
+            self._update_charges(order_id, urls)
+
+        self.stdout.write('{} bills have been migrated, {} files have been skipped\n'.format(
+            sum([len(order_bills) for order_bills in bills.values()]), skipped))
@@ -20,79 +20,261 @@
 
 from __future__ import unicode_literals
 
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+from bson import ObjectId
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 
 from wstore.ordering.models import Order
 from wstore.admin.users.notification_handler import NotificationsHandler
 from wstore.ordering.inventory_client import InventoryClient
 from wstore.asset_manager.resource_plugins.decorators import on_product_suspended
+from wstore.store_commons.database import get_database_connection
+
+# Contracts whose deadline is closer than this number of days are processed
+DUE_DAYS = 7
+
+
+def ensure_deadline_index():
+    db = get_database_connection()
+    db.wstore_order.create_index('contracts.next_deadline', sparse=True)
+
+
+def split_key_ranges(ids, workers):
+    """
+    Splits a sorted list of ids in contiguous key ranges of similar size
+    :return: List of tuples with the first and last id of each range
+    """
+    size = -(-len(ids) // workers)
+    return [(ids[i], ids[min(i + size, len(ids)) - 1]) for i in range(0, len(ids), size)]
+
+
+class RunReport(object):
+    """
+    Thread safe summary of the actions executed by the daemon
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._failed = {}
+        self.failures = []
+
+    def record(self, action, elapsed_ms, order, contract, error=None):
+        with self._lock:
+            self._latencies.setdefault(action, []).append(elapsed_ms)
+            self._failed.setdefault(action, 0)
+
+            if error is not None:
+                self._failed[action] += 1
+                self.failures.append({
+                    'action': action,
+                    'order': order.order_id,
+                    'product': contract.product_id,
+                    'error': unicode(error)
+                })
+
+    def _percentile(self, values, percentile):
+        # Nearest rank percentile
+        ordered = sorted(values)
+        return ordered[max(0, int(math.ceil(percentile / 100.0 * len(ordered))) - 1)]
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'actions': dict([(action, {
+                    'count': len(latencies),
+                    'failed': self._failed[action],
+                    'p50_ms': self._percentile(latencies, 50),
+                    'p95_ms': self._percentile(latencies, 95)
+                }) for action, latencies in self._latencies.items()]),
+                'failures': list(self.failures)
+            }
 
 
 class Command(BaseCommand):
 
-    def _check_renovation_date(self, renovation_date, order, contract):
+    def _suspend_access(self, order, contract):
+        on_product_suspended(order, contract)
+
+    def _notify_payment_required(self, order, contract):
+        NotificationsHandler().send_payment_required_notification(order, contract)
+
+    def _suspend_product(self, order, contract):
+        InventoryClient().suspend_product(contract.product_id)
+
+    def _notify_near_expiration(self, order, contract, days):
+        NotificationsHandler().send_near_expiration_notification(order, contract, days)
+
+    def _get_renovation_actions(self, renovation_date):
         now = datetime.utcnow()
 
         timed = renovation_date - now
 
-        if timed.days < 7:
-            handler = NotificationsHandler()
+        actions = []
+        if timed.days < 0:
+            # Suspend the access to the service, notify that the subscription
+            # has finished and set the product as suspended
+            actions = [
+                ('suspend_access', self._suspend_access, ()),
+                ('payment_required_notification', self._notify_payment_required, ()),
+                ('suspend_product', self._suspend_product, ())
+            ]
 
-            if timed.days < 0:
-                # Suspend the access to the service
-                on_product_suspended(order, contract)
+        elif timed.days < DUE_DAYS:
+            # There is less than a week remaining
+            actions = [('near_expiration_notification', self._notify_near_expiration, (timed.days,))]
 
-                # Notify that the subscription has finished
-                handler.send_payment_required_notification(order, contract)
+        return actions
 
-                # Set the product as suspended
-                client = InventoryClient()
-                client.suspend_product(contract.product_id)
+    def _get_usage_renovation_date(self, order, contract):
+        # Search last usage charge
+        last_charge = None
+        for charge in reversed(contract.charges):
+            if charge.concept == 'usage':
+                last_charge = charge.date
+                break
 
-            else:
-                # There is less than a week remaining
-                handler.send_near_expiration_notification(order, contract, timed.days)
+        # No use charge has been applied yet
+        if last_charge is None:
+            last_charge = order.date
 
-    def _process_subscription_item(self, order, contract, item):
-        try:
-            self._check_renovation_date(item['renovation_date'], order, contract)
-        except:
-            pass
+        # Usage payments are renovated every 30 days
+        return last_charge + timedelta(days=30)
+
+    def _get_work_items(self, order):
+        work_items = []
+
+        for contract in order.contracts:
+            if contract.terminated:
+                continue
+
+            renovation_dates = []
+            if 'pay_per_use' in contract.pricing_model:
+                renovation_dates.append(self._get_usage_renovation_date(order, contract))
+
+            if 'subscription' in contract.pricing_model:
+                renovation_dates.extend([
+                    item['renovation_date'] for item in contract.pricing_model['subscription'] if 'renovation_date' in item
+                ])
 
-    def _process_usage_item(self, order, contract):
+            for renovation_date in renovation_dates:
+                actions = self._get_renovation_actions(renovation_date)
+
+                if len(actions):
+                    work_items.append((order, contract, actions))
+
+        return work_items
+
+    def _run_action(self, action, order, contract):
+        name, method, args = action
+        start = time.time()
+        error = None
+
+        for attempt in range(settings.PENDING_CHARGES_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(settings.PENDING_CHARGES_RETRY_DELAY * 2 ** (attempt - 1))
+
+            try:
+                method(order, contract, *args)
+                error = None
+                break
+            except Exception as e:
+                error = e
+
+        self._report.record(name, (time.time() - start) * 1000, order, contract, error=error)
+        return error is None
+
+    def _process_work_item(self, work_item):
+        order, contract, actions = work_item
+
+        # The actions of a contract are dependent, so they are executed in order
+        # and the rest are skipped if one of them fails
+        for action in actions:
+            if not self._run_action(action, order, contract):
+                break
+
+    def _get_due_query(self):
+        return {
+            'contracts': {
+                '$elemMatch': {
+                    'next_deadline': {'$lt': datetime.utcnow() + timedelta(days=DUE_DAYS)},
+                    'terminated': False
+                }
+            }
+        }
+
+    def _process_orders(self, query):
+        db = get_database_connection()
+
+        # Only the due orders are loaded, using the index of the contracts deadline
+        order_ids = [unicode(doc['_id']) for doc in db.wstore_order.find(query, {'_id': True})]
+
+        work_items = []
+        for order in Order.objects.filter(pk__in=order_ids):
+            work_items.extend(self._get_work_items(order))
+
+        self._report = RunReport()
+
+        pool = ThreadPool(settings.PENDING_CHARGES_THREADS)
         try:
-            # Search last usage charge
-            last_charge = None
-            for charge in reversed(contract.charges):
-                if charge.concept == 'usage':
-                    last_charge = charge.date
-                    break
-
-            # No use charge has been applied yet
-            if last_charge is None:
-                last_charge = order.date
-
-            # Usage payments are renovated every 30 days
-            self._check_renovation_date(last_charge + timedelta(days=30), order, contract)
-        except:
-            pass
+            pool.map(self._process_work_item, work_items)
+        finally:
+            pool.close()
+            pool.join()
+
+        report = self._report.to_dict()
+        report['work_items'] = len(work_items)
+        self.stdout.write(json.dumps(report, sort_keys=True) + '\n')
+
+    def _launch_workers(self, query, workers):
+        db = get_database_connection()
+        ids = [unicode(doc['_id']) for doc in db.wstore_order.find(query, {'_id': True}).sort('_id', 1)]
+
+        if not len(ids):
+            return
+
+        manage = os.path.join(settings.BASEDIR, 'manage.py')
+        processes = [
+            subprocess.Popen([sys.executable, manage, 'pending_charges_daemon', 'range', first, last])
+            for first, last in split_key_ranges(ids, workers)
+        ]
+
+        for process in processes:
+            process.wait()
 
     def handle(self, *args, **options):
         """
         Periodic task in charge of checking recurring and usage payments dates
-        in order to notify customers and suspend services if needed
+        in order to notify customers and suspend services if needed. Usage:
+            pending_charges_daemon [workers]
+            pending_charges_daemon range <first_order_id> <last_order_id>
         :return:
         """
+        ensure_deadline_index()
+        query = self._get_due_query()
+
+        if len(args) == 3 and args[0] == 'range':
+            # Worker process, only the orders of the key range are processed
+            query['_id'] = {'$gte': ObjectId(args[1]), '$lte': ObjectId(args[2])}
+            self._process_orders(query)
+            return
+
+        if len(args) > 1:
+            raise CommandError('Usage: pending_charges_daemon [workers] | range <first_order_id> <last_order_id>')
 
-        # Check contracts
-        for order in Order.objects.all():
-            for contract in order.contracts:
-                if 'pay_per_use' in contract.pricing_model and not contract.terminated:
-                        self._process_usage_item(order, contract)
+        workers = int(args[0]) if len(args) else settings.PENDING_CHARGES_WORKERS
 
-                if 'subscription' in contract.pricing_model and not contract.terminated:
-                    # Validate renovation date
-                    for item in contract.pricing_model['subscription']:
-                        self._process_subscription_item(order, contract, item)
+        if workers > 1:
+            self._launch_workers(query, workers)
+        else:
+            self._process_orders(query)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from wstore.charging_engine.accounting.usage_rating import ensure_rating_index, rate_pending_usage, retry_failed_ratings
+
+
+class Command(BaseCommand):
+
+    def handle(self, *args, **options):
+        """
+        Periodic task in charge of resuming the rating of charged usage
+        documents which has failed or has been interrupted. Use the retry
+        argument to schedule again the ratings which have reached the max attempts
+        """
+        ensure_rating_index()
+
+        if 'retry' in args:
+            retry_failed_ratings()
+
+        rate_pending_usage()
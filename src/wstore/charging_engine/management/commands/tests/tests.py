@@ -20,13 +20,18 @@
 
 from __future__ import unicode_literals
 
+import json
+import os
+from bson import ObjectId
 from datetime import datetime
 
 from mock import MagicMock, call
+from nose_parameterized import parameterized
 
 from django.test import TestCase
+from django.test.utils import override_settings
 
-from wstore.charging_engine.management.commands import pending_charges_daemon
+from wstore.charging_engine.management.commands import migrate_bills, pending_charges_daemon
 
 
 class ChargesDaemonTestCase(TestCase):
@@ -38,16 +43,26 @@ class ChargesDaemonTestCase(TestCase):
         pending_charges_daemon.datetime = MagicMock()
         pending_charges_daemon.datetime.utcnow.return_value = datetime(2016, 02, 8)
 
-        # Mock inventory client
+        # Mock inventory client, child mocks are created before being used by the worker threads
         pending_charges_daemon.InventoryClient = MagicMock()
+        pending_charges_daemon.InventoryClient.return_value.suspend_product = MagicMock()
 
         # Mock notifications handler
         pending_charges_daemon.NotificationsHandler = MagicMock()
+        handler = pending_charges_daemon.NotificationsHandler.return_value
+        handler.send_payment_required_notification = MagicMock()
+        handler.send_near_expiration_notification = MagicMock()
 
         # Mock orders
         pending_charges_daemon.Order = MagicMock()
 
+        pending_charges_daemon.get_database_connection = MagicMock()
+        self._db = pending_charges_daemon.get_database_connection.return_value
+        self._db.wstore_order.find.return_value = [{'_id': ObjectId('5a1d5cb2e6ea3b5b5a4e1b01')}]
+
         pending_charges_daemon.on_product_suspended = MagicMock()
+        pending_charges_daemon.time = MagicMock()
+        pending_charges_daemon.time.time.return_value = 0
 
     def _build_contract(self, pricing, id_):
         contract = MagicMock()
@@ -87,13 +102,25 @@ class ChargesDaemonTestCase(TestCase):
 
         order = MagicMock()
         order.contracts = [contract1] + contracts
-        pending_charges_daemon.Order.objects.all.return_value = [order]
+        pending_charges_daemon.Order.objects.filter.return_value = [order]
 
         # Execute commands
         command = pending_charges_daemon.Command()
+        command.stdout = MagicMock()
         command.handle()
 
         # Validate calls
+        self._db.wstore_order.create_index.assert_called_once_with('contracts.next_deadline', sparse=True)
+        self._db.wstore_order.find.assert_called_once_with({
+            'contracts': {
+                '$elemMatch': {
+                    'next_deadline': {'$lt': datetime(2016, 02, 15)},
+                    'terminated': False
+                }
+            }
+        }, {'_id': True})
+        pending_charges_daemon.Order.objects.filter.assert_called_once_with(pk__in=['5a1d5cb2e6ea3b5b5a4e1b01'])
+
         self.assertEquals([call(), call()], pending_charges_daemon.NotificationsHandler.call_args_list)
 
         pending_charges_daemon.NotificationsHandler().send_payment_required_notification.assert_called_once_with(order, contracts[2])
@@ -104,6 +131,15 @@ class ChargesDaemonTestCase(TestCase):
 
         pending_charges_daemon.on_product_suspended.assert_called_once_with(order, contracts[2])
 
+        # Check run report
+        report = json.loads(command.stdout.write.call_args[0][0])
+        self.assertEquals(2, report['work_items'])
+        self.assertEquals([], report['failures'])
+        self.assertEquals(sorted([
+            'suspend_access', 'payment_required_notification', 'suspend_product', 'near_expiration_notification'
+        ]), sorted(report['actions'].keys()))
+        self.assertEquals(1, report['actions']['suspend_product']['count'])
+
     def test_subscription_renovation(self):
 
         # Not expired
@@ -130,3 +166,166 @@ class ChargesDaemonTestCase(TestCase):
 
         self._test_charging_daemon([contract1, contract2, contract3])
 
+    def test_worker_range(self):
+        command = pending_charges_daemon.Command()
+        command.stdout = MagicMock()
+        command.handle('range', '5a1d5cb2e6ea3b5b5a4e1b01', '5a1d5cb2e6ea3b5b5a4e1b09')
+
+        query = self._db.wstore_order.find.call_args[0][0]
+        self.assertEquals({
+            '$gte': ObjectId('5a1d5cb2e6ea3b5b5a4e1b01'),
+            '$lte': ObjectId('5a1d5cb2e6ea3b5b5a4e1b09')
+        }, query['_id'])
+
+    @override_settings(BASEDIR='/home/wstore')
+    def test_launch_workers(self):
+        pending_charges_daemon.subprocess = MagicMock()
+        self._db.wstore_order.find.return_value = MagicMock()
+        self._db.wstore_order.find.return_value.sort.return_value = [
+            {'_id': '1'}, {'_id': '2'}, {'_id': '3'}, {'_id': '4'}, {'_id': '5'}
+        ]
+
+        command = pending_charges_daemon.Command()
+        command.handle('2')
+
+        self._db.wstore_order.find().sort.assert_called_once_with('_id', 1)
+        exe = pending_charges_daemon.sys.executable
+        self.assertEquals([
+            call([exe, '/home/wstore/manage.py', 'pending_charges_daemon', 'range', '1', '3']),
+            call([exe, '/home/wstore/manage.py', 'pending_charges_daemon', 'range', '4', '5'])
+        ], pending_charges_daemon.subprocess.Popen.call_args_list)
+
+        self.assertEquals(2, pending_charges_daemon.subprocess.Popen().wait.call_count)
+        pending_charges_daemon.Order.objects.filter.assert_not_called()
+
+    @parameterized.expand([
+        ('single', ['1'], 3, [('1', '1')]),
+        ('even', ['1', '2', '3', '4'], 2, [('1', '2'), ('3', '4')]),
+        ('uneven', ['1', '2', '3', '4', '5'], 3, [('1', '2'), ('3', '4'), ('5', '5')])
+    ])
+    def test_split_key_ranges(self, name, ids, workers, expected):
+        self.assertEquals(expected, pending_charges_daemon.split_key_ranges(ids, workers))
+
+    @override_settings(PENDING_CHARGES_ATTEMPTS=3, PENDING_CHARGES_RETRY_DELAY=1)
+    def test_action_retries(self):
+        contract1 = self._build_subscription_contract(datetime(2016, 01, 31), '1')
+        contract2 = self._build_subscription_contract(datetime(2016, 01, 31), '2')
+
+        order = MagicMock(order_id='10')
+        order.contracts = [contract1, contract2]
+        pending_charges_daemon.Order.objects.filter.return_value = [order]
+
+        # The first contract is suspended at the second attempt, the second one fails
+        suspend_errors = {
+            '1': [Exception('Temporal error')],
+            '2': [Exception('Inventory error')] * 3
+        }
+
+        def suspend_product(product_id):
+            if len(suspend_errors[product_id]):
+                raise suspend_errors[product_id].pop(0)
+
+        pending_charges_daemon.InventoryClient().suspend_product.side_effect = suspend_product
+
+        command = pending_charges_daemon.Command()
+        command.stdout = MagicMock()
+        command.handle()
+
+        report = json.loads(command.stdout.write.call_args[0][0])
+        self.assertEquals([call(1), call(1), call(2)], sorted(pending_charges_daemon.time.sleep.call_args_list))
+        self.assertEquals({
+            'count': 2,
+            'failed': 1,
+            'p50_ms': 0,
+            'p95_ms': 0
+        }, report['actions']['suspend_product'])
+        self.assertEquals([{
+            'action': 'suspend_product',
+            'order': '10',
+            'product': '2',
+            'error': 'Inventory error'
+        }], report['failures'])
+
+    def test_report_percentiles(self):
+        run_report = pending_charges_daemon.RunReport()
+        order = MagicMock()
+        contract = MagicMock()
+
+        for elapsed in range(1, 101):
+            run_report.record('suspend_product', elapsed, order, contract)
+
+        report = run_report.to_dict()
+        self.assertEquals(50, report['actions']['suspend_product']['p50_ms'])
+        self.assertEquals(95, report['actions']['suspend_product']['p95_ms'])
+
+
+@override_settings(BILL_ROOT='/home/test/media/bills', MEDIA_URL='/charging/media/')
+class MigrateBillsTestCase(TestCase):
+
+    tags = ('invoices', )
+
+    def setUp(self):
+        migrate_bills.ensure_invoice_index = MagicMock()
+        migrate_bills.get_database_connection = MagicMock()
+        self._db = migrate_bills.get_database_connection.return_value
+
+        migrate_bills.get_invoice_storage = MagicMock()
+        self._storage = migrate_bills.get_invoice_storage.return_value
+        self._storage.get_url.side_effect = lambda key: '/charging/media/bills/' + key
+
+        migrate_bills.datetime = MagicMock()
+        migrate_bills.datetime.utcnow.return_value = datetime(2016, 6, 6)
+
+        migrate_bills.os = MagicMock()
+        migrate_bills.os.path.join = os.path.join
+        migrate_bills.os.path.isfile.side_effect = lambda path: not path.endswith('2016')
+        migrate_bills.os.listdir.return_value = [
+            '5a1d5cb2e6ea3b5b5a4e1b01_1_2016-06-06_0.pdf',
+            '5a1d5cb2e6ea3b5b5a4e1b01_1_2016-06-06_1.pdf',
+            'invoice.html',
+            '2016'
+        ]
+
+        charge1 = MagicMock(invoice='/charging/media/bills/5a1d5cb2e6ea3b5b5a4e1b01_1_2016-06-06_0.pdf')
+        charge2 = MagicMock(invoice='/charging/media/bills/5a1d5cb2e6ea3b5b5a4e1b01_1_2016-06-06_1.pdf')
+        self._order = MagicMock()
+        self._order.contracts = [MagicMock(charges=[charge1, charge2])]
+
+        migrate_bills.Order = MagicMock()
+        migrate_bills.Order.objects.get.return_value = self._order
+
+    def tearDown(self):
+        reload(migrate_bills)
+
+    def test_migrate_bills(self):
+        command = migrate_bills.Command()
+        command.stdout = MagicMock()
+
+        command.handle()
+
+        migrate_bills.ensure_invoice_index.assert_called_once_with()
+
+        key1 = '2016/06/bf/5a1d5cb2e6ea3b5b5a4e1b01_1_2016-06-06_0.pdf'
+        key2 = '2016/06/bf/5a1d5cb2e6ea3b5b5a4e1b01_1_2016-06-06_1.pdf'
+        self.assertEquals([
+            call('/home/test/media/bills/5a1d5cb2e6ea3b5b5a4e1b01_1_2016-06-06_0.pdf', key1),
+            call('/home/test/media/bills/5a1d5cb2e6ea3b5b5a4e1b01_1_2016-06-06_1.pdf', key2)
+        ], self._storage.save.call_args_list)
+
+        self._db.wstore_invoices.update_one.assert_called_with({'_id': key2}, {
+            '$set': {
+                'order': '5a1d5cb2e6ea3b5b5a4e1b01',
+                'item': '1',
+                'date': '2016-06-06',
+                'state': 'ready',
+                'created': datetime(2016, 6, 6)
+            }
+        }, upsert=True)
+
+        # The charges of the order point to the new locations
+        migrate_bills.Order.objects.get.assert_called_once_with(pk='5a1d5cb2e6ea3b5b5a4e1b01')
+        self.assertEquals(['/charging/media/bills/' + key1, '/charging/media/bills/' + key2],
+                          [charge.invoice for charge in self._order.contracts[0].charges])
+        self._order.save.assert_called_once_with()
+
+        command.stdout.write.assert_called_once_with('2 bills have been migrated, 2 files have been skipped\n')
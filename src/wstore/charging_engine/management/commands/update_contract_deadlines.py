@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from wstore.charging_engine.management.commands.pending_charges_daemon import ensure_deadline_index
+from wstore.ordering.models import Order
+
+
+class Command(BaseCommand):
+
+    def handle(self, *args, **options):
+        """
+        Calculates the next deadline of the contracts of the existing orders,
+        needed by the pending charges daemon to find the due contracts
+        """
+        ensure_deadline_index()
+
+        updated = 0
+        for order in Order.objects.all():
+            for contract in order.contracts:
+                contract.update_next_deadline(order.date)
+
+            order.save()
+            updated += 1
+
+        self.stdout.write('The deadlines of {} orders have been updated\n'.format(updated))
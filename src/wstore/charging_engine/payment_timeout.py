@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from bson import ObjectId
+from datetime import datetime, timedelta
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+from django.conf import settings
+
+from wstore.ordering.models import Order
+from wstore.ordering.ordering_client import OrderingClient
+from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.worker import ProcessWorker
+
+
+def get_payment_deadline():
+    """
+    Calculates the date when a payment started now has to be considered expired
+    """
+    return datetime.utcnow() + timedelta(seconds=settings.PAYMENT_TIMEOUT)
+
+
+def _initial_charge_timeout(order):
+    ordering_client = OrderingClient()
+    raw_order = ordering_client.get_order(order.order_id)
+
+    # Setting all the items as Failed, set the whole order as failed
+    # ordering_client.update_state(raw_order, 'Failed')
+    ordering_client.update_items_state(raw_order, 'Failed')
+
+    order.delete()
+
+
+def _renew_charge_timeout(order):
+    order.state = 'paid'
+    order.pending_payment = None
+    order.payment_deadline = None
+
+    order.save()
+
+
+def process_payment_timeout(order_id):
+    """
+    Rollbacks the pending payment of an order whose payment deadline has expired
+    :param order_id: Database id of the order
+    """
+    db = get_database_connection()
+
+    # Uses an atomic operation to get and set the _lock value in the purchase
+    # document
+    pre_value = db.wstore_order.find_one_and_update(
+        {'_id': ObjectId(order_id)},
+        {'$set': {'_lock': True}}
+    )
+
+    if pre_value is None:
+        return
+
+    # If _lock not exists or is set to false means that this function has
+    # acquired the resource
+    if '_lock' not in pre_value or not pre_value['_lock']:
+
+        # Only rollback if the state is pending
+        if pre_value['state'] == 'pending':
+            order = Order.objects.get(pk=order_id)
+            timeout_processors = {
+                'initial': _initial_charge_timeout,
+                'recurring': _renew_charge_timeout,
+                'usage': _renew_charge_timeout
+            }
+            timeout_processors[order.pending_payment.concept](order)
+
+        db.wstore_order.find_one_and_update(
+            {'_id': ObjectId(order_id)},
+            {'$set': {'_lock': False, 'payment_deadline': None}}
+        )
+    else:
+        # The payment confirmation is being processed, so it is in charge
+        # of completing or rolling back the order
+        db.wstore_order.update_one(
+            {'_id': ObjectId(order_id), '_lock': True},
+            {'$set': {'payment_deadline': None}}
+        )
+
+
+def process_expired_payments():
+    """
+    Rollbacks all the pending payments whose deadline has expired
+    :return: The closest deadline still pending or None if there is not any
+    """
+    db = get_database_connection()
+    now = datetime.utcnow()
+
+    expired = db.wstore_order.find(
+        {'payment_deadline': {'$lte': now}},
+        {'_id': True}
+    ).sort('payment_deadline', ASCENDING)
+
+    for order_doc in expired:
+        try:
+            process_payment_timeout(unicode(order_doc['_id']))
+        except:
+            pass
+
+    next_order = db.wstore_order.find_one(
+        {'payment_deadline': {'$gt': now}},
+        {'payment_deadline': True},
+        sort=[('payment_deadline', ASCENDING)]
+    )
+
+    return next_order['payment_deadline'] if next_order is not None else None
+
+
+INDEX_OPTIONS_CONFLICT = 85
+
+
+def ensure_timeout_index():
+    db = get_database_connection()
+
+    try:
+        db.wstore_order.create_index('payment_deadline', sparse=True)
+    except OperationFailure as e:
+        if e.code != INDEX_OPTIONS_CONFLICT:
+            raise
+
+        # Previous versions created a non sparse index with the same name
+        db.wstore_order.drop_index('payment_deadline_1')
+        db.wstore_order.create_index('payment_deadline', sparse=True)
+
+
+_timeout_worker = ProcessWorker(process_expired_payments, 'PAYMENT_TIMEOUT_POLL', setup=ensure_timeout_index)
+
+
+def schedule_payment_timeout():
+    """
+    Notifies the timeout worker that a new payment deadline has been stored
+    """
+    _timeout_worker.notify()
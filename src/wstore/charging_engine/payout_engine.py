@@ -36,8 +36,7 @@ from wstore.charging_engine.models import ReportsPayout, ReportSemiPaid
 from wstore.charging_engine.payment_client.paypal_client import PayPalClient
 from wstore.store_commons.database import get_database_connection
 from wstore.ordering.errors import PayoutError
-
-import requests
+from wstore.store_commons import http_client
 
 
 class PayoutWatcher(threading.Thread):
@@ -69,7 +68,7 @@ class PayoutWatcher(threading.Thread):
 
         url += 'rss/settlement/reports/{}'.format(report)
 
-        response = requests.patch(url, json=data, headers=headers)
+        response = http_client.patch(url, json=data, headers=headers)
 
         if response.status_code != 200:
             print("Error mark as paid report {}: {}".format(report, response.reason))
@@ -223,7 +222,7 @@ class PayoutEngine(object):
 
         url += 'rss/settlement/reports'
 
-        response = requests.get(url, params=data, headers=headers)
+        response = http_client.get(url, params=data, headers=headers)
 
         if response.status_code != 200:
             print("Error retrieving reports: {}".format(response.reason))
@@ -31,6 +31,28 @@ class PriceResolver:
         self._applied_sdrs = []
         self._alteration_applied = False
 
+    def _group_accounting(self, accounting_info):
+        """
+           Groups the SDRs by normalized unit, converting
+           their values to Decimal only once
+       """
+        groups = {}
+
+        for sdr in accounting_info:
+            unit = sdr['unit'].lower()
+
+            if unit not in groups:
+                groups[unit] = {
+                    'sdrs': [],
+                    'total': Decimal('0')
+                }
+
+            value = Decimal(sdr['value'])
+            groups[unit]['sdrs'].append((sdr, value))
+            groups[unit]['total'] += value
+
+        return groups
+
     def _pay_per_use_preprocesing(self, use_models, accounting_info):
         """
            Process pay-per-use payments and call the corresponding
@@ -40,29 +62,32 @@ class PriceResolver:
         price = Decimal('0')
         duty_free = Decimal('0')
 
+        groups = self._group_accounting(accounting_info)
+
         for component in use_models:
             related_accounting = []
 
+            comp_value = Decimal(component['value'])
+            comp_duty_value = Decimal(component['duty_free'])
+
             # Get the related accounting info
             partial_price = Decimal('0')
             partial_duty_free = Decimal('0')
 
-            for sdr in accounting_info:
-                if sdr['unit'].lower() == component['unit'].lower():
-                    sdr_info = {
-                        'usage_id': sdr['usage_id'],
-                        'value': sdr['value']
-                    }
-                    comp_price = (Decimal(sdr['value']) * Decimal(component['value']))
-                    partial_price += comp_price
-                    sdr_info['price'] = unicode(comp_price)
-
-                    comp_duty_free = (Decimal(sdr['value']) * Decimal(component['duty_free']))
-                    partial_duty_free += comp_duty_free
-                    sdr_info['duty_free'] = unicode(comp_duty_free)
+            group = groups.get(component['unit'].lower())
+            if group is not None:
+                # The consumption is aggregated per unit, so the component price is calculated once
+                partial_price += group['total'] * comp_value
+                partial_duty_free += group['total'] * comp_duty_value
 
+                for sdr, value in group['sdrs']:
                     # Save the information of the SDR document which is needed for further precessing
-                    related_accounting.append(sdr_info)
+                    related_accounting.append({
+                        'usage_id': sdr['usage_id'],
+                        'value': sdr['value'],
+                        'price': unicode(value * comp_value),
+                        'duty_free': unicode(value * comp_duty_value)
+                    })
 
             # Include the applied SDRs
             self._applied_sdrs.append({
@@ -165,3 +190,27 @@ class PriceResolver:
         duty_free = duty_free.quantize(Decimal('10') ** -2)
 
         return unicode(price), unicode(duty_free)
+
+    def resolve_prices(self, pricing_models):
+        """
+           Calculates the prices to be charged for a set of
+           pricing models with their accounting info.
+           :param pricing_models: List of tuples (pricing_model, accounting_info)
+           :return: List of dicts with the price, duty_free, applied SDRs,
+           and whether the alteration has been applied for every model
+       """
+        results = []
+
+        for pricing_model, accounting_info in pricing_models:
+            self._applied_sdrs = []
+            self._alteration_applied = False
+
+            price, duty_free = self.resolve_price(pricing_model, accounting_info)
+            results.append({
+                'price': price,
+                'duty_free': duty_free,
+                'applied_sdrs': self._applied_sdrs,
+                'altered': self._alteration_applied
+            })
+
+        return results
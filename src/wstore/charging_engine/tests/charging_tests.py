@@ -33,8 +33,8 @@ from django.test.client import RequestFactory
 
 import wstore.store_commons.utils.http
 from wstore.ordering.errors import OrderingError
-from wstore.ordering.models import Payment
-from wstore.charging_engine import charging_engine
+from wstore.ordering.models import Payment, Contract, Offering
+from wstore.charging_engine import charging_engine, price_resolver
 from wstore.charging_engine import views
 from wstore.store_commons.utils.testing import decorator_mock
 
@@ -67,15 +67,15 @@ class ChargingEngineTestCase(TestCase):
         mock_payment_client(self, charging_engine)
         self._payment_inst.get_checkout_url.return_value = self._paypal_url
 
-        # Mock threading
-        charging_engine.threading = MagicMock()
-
-        self._thread = MagicMock()
-        charging_engine.threading.Timer.return_value = self._thread
+        # Mock payment timeout scheduling
+        self._deadline = datetime(2016, 1, 20, 13, 17, 39)
+        charging_engine.get_payment_deadline = MagicMock(return_value=self._deadline)
+        charging_engine.schedule_payment_timeout = MagicMock()
 
         # Mock invoice builder
         charging_engine.InvoiceBuilder = MagicMock()
         charging_engine.InvoiceBuilder.return_value.generate_invoice.return_value = INVOICE_PATH
+        charging_engine.InvoiceBuilder.return_value.when_ready.side_effect = lambda callback: callback([])
 
         # Mock CDR Manager
         charging_engine.CDRManager = MagicMock()
@@ -93,6 +93,8 @@ class ChargingEngineTestCase(TestCase):
         charging_engine.Charge.return_value = self._charge
 
         charging_engine.BillingClient = MagicMock()
+        charging_engine.rate_usage_documents = MagicMock()
+        charging_engine.grant_entitlements = MagicMock()
 
     def _get_single_payment(self):
         return {
@@ -448,21 +450,6 @@ class ChargingEngineTestCase(TestCase):
                 }],
                 'price': '200.00',
                 'duty_free': '166.60'
-            }, {
-                'model': {
-                    'value': '10.00',
-                    'unit': 'callmin',
-                    'tax_rate': '20.00',
-                    'duty_free': '8.33'
-                },
-                'accounting': [{
-                    'price': '10.00',
-                    'value': '1',
-                    'usage_id': '3',
-                    'duty_free': '8.33'
-                }],
-                'price': '10.00',
-                'duty_free': '8.33'
             }]
         }, {
             'price': '30.00',
@@ -491,26 +478,6 @@ class ChargingEngineTestCase(TestCase):
             },
             'item': '2',
             'applied_accounting': [{
-                'model': {
-                    'value': '10.00',
-                    'unit': 'call',
-                    'tax_rate': '20.00',
-                    'duty_free': '8.33'
-                },
-                'accounting': [{
-                    'usage_id': '1',
-                    'price': '100.00',
-                    'duty_free': '83.30',
-                    'value': '10'
-                }, {
-                    'usage_id': '4',
-                    'price': '100.00',
-                    'duty_free': '83.30',
-                    'value': '10'
-                }],
-                'price': '200.00',
-                'duty_free': '166.60'
-            }, {
                 'model': {
                     'value': '10.00',
                     'unit': 'callmin',
@@ -729,9 +696,9 @@ class ChargingEngineTestCase(TestCase):
         self._payment_class.assert_called_once_with(self._order)
         self._payment_inst.start_redirection_payment.assert_called_once_with(transactions)
 
-        # Check timer call
-        charging_engine.threading.Timer.assert_called_once_with(300, charging._timeout_handler)
-        self._thread.start.assert_called_once_with()
+        # Check timeout scheduling
+        self.assertEquals(self._deadline, self._order.payment_deadline)
+        charging_engine.schedule_payment_timeout.assert_called_once_with()
 
         # Check payment saving
         self.assertEquals(Payment(
@@ -777,6 +744,48 @@ class ChargingEngineTestCase(TestCase):
         self.assertEquals(None, self._order.pending_payment)
         self._order.save.assert_called_once_with()
 
+    def _get_usage_contract(self):
+        return Contract(
+            item_id='1',
+            offering=Offering(pk='11111', description='Offering description'),
+            pricing_model=self._get_pay_use()
+        )
+
+    def _check_usage_deadline(self, contract):
+        # Contracts only priced by usage are not charged when acquired, but their usage payment is scheduled
+        self.assertEquals(datetime(2016, 2, 19, 13, 12, 39), contract.next_deadline)
+        self._order.get_item_contract.assert_called_once_with('1')
+
+        self.assertEquals(['11111'], self._order.owner_organization.acquired_offerings)
+        charging_engine.grant_entitlements.assert_called_once_with(self._order, [contract])
+
+    def test_usage_initial_charge(self):
+        contract = self._get_usage_contract()
+        self._order.contracts = [contract]
+        self._order.date = datetime(2016, 1, 20, 13, 12, 39)
+        self._order.get_item_contract.return_value = contract
+
+        charging = charging_engine.ChargingEngine(self._order)
+        redirect_url = charging.resolve_charging()
+
+        self.assertTrue(redirect_url is None)
+        self.assertEquals('paid', self._order.state)
+        self.assertEquals(0, charging_engine.InvoiceBuilder().generate_invoice.call_count)
+
+        self._check_usage_deadline(contract)
+
+    def test_end_payment_usage_free_contract(self):
+        # The free contracts of a pending payment are copies of the order ones
+        contract = self._get_usage_contract()
+        self._order.contracts = [contract]
+        self._order.date = datetime(2016, 1, 20, 13, 12, 39)
+        self._order.get_item_contract.return_value = contract
+
+        charging = charging_engine.ChargingEngine(self._order)
+        charging.end_charging([], [self._get_usage_contract()], 'initial')
+
+        self._check_usage_deadline(contract)
+
     def _validate_subscription_calls(self):
 
         self.assertEquals({
@@ -793,9 +802,13 @@ class ChargingEngineTestCase(TestCase):
     def _validate_end_initial_payment(self, transactions):
         self.assertEquals([
             call('1'),
-            call('2')
+            call('2'),
+            call('3')
         ], self._order.get_item_contract.call_args_list)
 
+        # The deadline of the free contract is updated
+        self._order.contracts[2].update_next_deadline.assert_called_once_with(self._order.date)
+
         self.assertEquals(['111111', '222222', '333333'], self._order.owner_organization.acquired_offerings)
         self.assertEquals([
             call(),
@@ -959,12 +972,18 @@ class ChargingEngineTestCase(TestCase):
              validate_sub('10.00', '10.00', 1, {'type': 'discount', 'period': 'one time', 'value': {'value': '1.00', 'duty_free': '1.00'}})], map(lambda x: x.pricing_model, self._order.contracts))
 
     def _validate_end_usage_payment(self, transactions):
-        self.assertEquals([
-            call('1', unicode(datetime(2016, 1, 20, 13, 12, 39)), '83.30', '100.00', '20.00', 'EUR', self._order.contracts[0].product_id),
-            call('3', unicode(datetime(2016, 1, 20, 13, 12, 39)), '83.30', '100.00', '20.00', 'EUR', self._order.contracts[0].product_id)
-        ],
-            charging_engine.UsageClient().rate_usage.call_args_list
-        )
+        def rating(usage_id):
+            return {
+                'usage_id': usage_id,
+                'timestamp': unicode(datetime(2016, 1, 20, 13, 12, 39)),
+                'duty_free': '83.30',
+                'price': '100.00',
+                'rate': '20.00',
+                'currency': 'EUR',
+                'product_id': self._order.contracts[0].product_id
+            }
+
+        charging_engine.rate_usage_documents.assert_called_once_with([rating('1'), rating('3')])
 
         charging_engine.BillingClient.assert_called_once_with()
         charging_engine.BillingClient().create_charge.assert_called_once_with(
@@ -995,6 +1014,46 @@ class ChargingEngineTestCase(TestCase):
             call()
         ], self._order.save.call_args_list)
 
+        # The assets of the acquired contracts can be downloaded
+        acquired = free_contracts
+        if name == 'initial':
+            acquired = [contract for contract in self._order.contracts if contract not in free_contracts] + free_contracts
+
+        if len(acquired):
+            charging_engine.grant_entitlements.assert_called_once_with(self._order, acquired)
+        else:
+            self.assertEquals(0, charging_engine.grant_entitlements.call_count)
+
+    def test_end_payment_failed_invoice(self):
+        self._order.state = 'pending'
+        self._order.pk = '5669a7e5e5d00a2a2b0b8a3c'
+        transactions, free_contracts = self._set_initial_contracts()
+
+        charging_engine.get_database_connection = MagicMock()
+        db = charging_engine.get_database_connection.return_value
+
+        # The notification is sent once the invoices have been converted, reporting the failed ones
+        callbacks = []
+        charging_engine.InvoiceBuilder.return_value.when_ready.side_effect = callbacks.append
+
+        charging = charging_engine.ChargingEngine(self._order)
+        charging.end_charging(transactions, free_contracts, 'initial')
+
+        self.assertEquals(0, charging_engine.NotificationsHandler.call_count)
+
+        failed_charge = MagicMock(invoice='/charging/media/bills/failed.pdf')
+        valid_charge = MagicMock(invoice=INVOICE_PATH)
+        self._order.contracts[1].charges = [valid_charge, failed_charge]
+        callbacks[0](['/charging/media/bills/failed.pdf'])
+
+        # The URL of the failed invoice is removed from the charges
+        self.assertEquals('', failed_charge.invoice)
+        self.assertEquals(INVOICE_PATH, valid_charge.invoice)
+        db.wstore_order.update_one.assert_called_once_with(
+            {'_id': charging_engine.ObjectId(self._order.pk)}, {'$set': {'contracts.1.charges.1.invoice': ''}})
+
+        charging_engine.NotificationsHandler().send_acquired_notification.assert_called_once_with(self._order)
+
     def test_invalid_concept(self):
 
         charging = charging_engine.ChargingEngine(self._order)
@@ -1008,6 +1067,79 @@ class ChargingEngineTestCase(TestCase):
         self.assertFalse(error is None)
         self.assertEquals('Invalid charge type, must be initial, recurring, or usage', unicode(e))
 
+
+USAGE_MODEL = {
+    'pay_per_use': [{
+        'value': '2.00',
+        'unit': 'call',
+        'duty_free': '1.50'
+    }, {
+        'value': '1.00',
+        'unit': 'GB',
+        'duty_free': '0.80'
+    }]
+}
+
+
+class PriceResolverTestCase(TestCase):
+
+    tags = ('charging-engine', 'price-resolver')
+
+    def test_resolve_prices(self):
+        resolver = price_resolver.PriceResolver()
+
+        results = resolver.resolve_prices([(USAGE_MODEL, [
+            {'usage_id': '1', 'unit': 'Call', 'value': '3'},
+            {'usage_id': '2', 'unit': 'gb', 'value': '1.5'},
+            {'usage_id': '3', 'unit': 'call', 'value': '2'}
+        ]), ({
+            'single_payment': [{
+                'value': '12.00',
+                'duty_free': '10.00'
+            }],
+            'alteration': {
+                'type': 'discount',
+                'value': '10.00'
+            }
+        }, None)])
+
+        self.assertEquals([{
+            'price': '11.50',
+            'duty_free': '8.70',
+            'applied_sdrs': [{
+                'model': USAGE_MODEL['pay_per_use'][0],
+                'accounting': [{
+                    'usage_id': '1',
+                    'value': '3',
+                    'price': '6.00',
+                    'duty_free': '4.50'
+                }, {
+                    'usage_id': '3',
+                    'value': '2',
+                    'price': '4.00',
+                    'duty_free': '3.00'
+                }],
+                'price': '10.00',
+                'duty_free': '7.50'
+            }, {
+                'model': USAGE_MODEL['pay_per_use'][1],
+                'accounting': [{
+                    'usage_id': '2',
+                    'value': '1.5',
+                    'price': '1.500',
+                    'duty_free': '1.200'
+                }],
+                'price': '1.500',
+                'duty_free': '1.200'
+            }],
+            'altered': False
+        }, {
+            'price': '10.80',
+            'duty_free': '9.00',
+            'applied_sdrs': [],
+            'altered': True
+        }], results)
+
 BASIC_PAYPAL = {
     'reference': '111111111111111111111111',
     'payerId': 'payer',
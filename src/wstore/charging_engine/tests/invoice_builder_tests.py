@@ -20,10 +20,12 @@
 
 from __future__ import unicode_literals
 
+import os
 from mock import MagicMock
 from nose_parameterized import parameterized
 
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from wstore.charging_engine import invoice_builder
 
@@ -39,9 +41,12 @@ OFFERING_VERSION = '1.0'
 OWNER_NAME = 'owner-user'
 
 BASEDIR = '/home/test'
-BILL_ROOT = '/home/test/media/invoices'
+JOB_DIR = '/tmp/invoice-1'
 MEDIA_URL = '/charging/media/'
 
+INVOICE_KEY = '2016/06/3f/1111_2_2016-06-06_2.pdf'
+INVOICE_URL = MEDIA_URL + 'bills/' + INVOICE_KEY
+
 TAX = {
     'street': 'street',
     'postal': '12345',
@@ -312,7 +317,6 @@ class InvoiceBuilderTestCase(TestCase):
         invoice_builder.loader.get_template.return_value = self._template
 
         invoice_builder.Context = MagicMock()
-        invoice_builder.settings.BILL_ROOT = BILL_ROOT
         invoice_builder.settings.BASEDIR = BASEDIR
         invoice_builder.settings.MEDIA_URL = MEDIA_URL
 
@@ -320,13 +324,34 @@ class InvoiceBuilderTestCase(TestCase):
         self._file_handler = MagicMock()
         invoice_builder.codecs.open.return_value = self._file_handler
 
-        invoice_builder.os.path.exists = MagicMock()
-        invoice_builder.os.path.exists.side_effect = [True, True, False]
-        invoice_builder.os.listdir = MagicMock()
-        invoice_builder.os.listdir.return_value = ['file1.pdf', 'file1.html']
-        invoice_builder.os.remove = MagicMock()
+        invoice_builder.tempfile = MagicMock()
+        invoice_builder.tempfile.mkdtemp.return_value = JOB_DIR
+        invoice_builder.shutil = MagicMock()
+
+        invoice_builder.os = MagicMock()
+        invoice_builder.os.path.join = os.path.join
+        invoice_builder.os.path.exists.return_value = True
+
+        invoice_builder.reserve_invoice = MagicMock(return_value=INVOICE_KEY)
+        invoice_builder.store_invoice = MagicMock()
+        invoice_builder.release_invoice = MagicMock()
+        invoice_builder.get_invoice_storage = MagicMock()
+        invoice_builder.get_invoice_storage.return_value.get_url.return_value = INVOICE_URL
 
         invoice_builder.subprocess = MagicMock()
+        invoice_builder.subprocess.call.return_value = 0
+
+        # PDF conversions are run in the calling thread
+        invoice_builder.get_thread_pool = MagicMock()
+        self._pool = invoice_builder.get_thread_pool.return_value
+        self._pool.apply.side_effect = lambda func, args: func(*args)
+
+    def tearDown(self):
+        reload(invoice_builder)
+
+    def _generate_invoice(self, concept='initial', transaction=SINGLE_PAYMENT_TRANS):
+        builder = invoice_builder.InvoiceBuilder(self._order)
+        return builder.generate_invoice(self._contract, transaction, concept)
 
     @parameterized.expand([
         ('initial_one_time', 'initial', SINGLE_PAYMENT_TRANS, SINGLE_PAYMENT_CONTEXT),
@@ -345,32 +370,99 @@ class InvoiceBuilderTestCase(TestCase):
             'usage': 'contracting/bill_template_use.html'
         }
 
-        builder = invoice_builder.InvoiceBuilder(self._order)
-
-        invoice_path = builder.generate_invoice(self._contract, transaction, concept)
+        invoice_path = self._generate_invoice(concept, transaction)
 
         # Validate Path
-        invoice_name = "{}_{}_{}_2.pdf".format(self._order.pk, self._contract.item_id, TIMESTAMP.split()[0])
-
-        exp_path = MEDIA_URL + 'bills/' + invoice_name
-        html_path = BILL_ROOT + '/' + invoice_name.replace('_2.pdf', '.html')
-
-        self.assertEquals(exp_path, invoice_path)
+        self.assertEquals(INVOICE_URL, invoice_path)
 
         # Validate calls
         invoice_builder.loader.get_template.assert_called_once_with(templates[concept])
         invoice_builder.Context.assert_called_once_with(exp_context)
         self._template.render.assert_called_once_with(invoice_builder.Context())
 
-        invoice_builder.codecs.open.assert_called_once_with(html_path, 'wb', 'utf-8')
+        invoice_builder.tempfile.mkdtemp.assert_called_once_with(prefix='invoice-')
+        invoice_builder.codecs.open.assert_called_once_with(JOB_DIR + '/invoice.html', 'wb', 'utf-8')
         self._file_handler.write.assert_called_once_with(TEMPLATE)
         self._file_handler.close.assert_called_once_with()
 
+        invoice_builder.reserve_invoice.assert_called_once_with(
+            self._order.pk, self._contract.item_id, TIMESTAMP.split()[0])
+        invoice_builder.get_invoice_storage.return_value.get_url.assert_called_once_with(INVOICE_KEY)
+
         invoice_builder.subprocess.call.assert_called_once_with([
             BASEDIR + '/create_invoice.sh',
-            html_path,
-            BILL_ROOT + '/' + invoice_name
+            JOB_DIR + '/invoice.html',
+            JOB_DIR + '/invoice.pdf'
         ])
 
-        invoice_builder.os.listdir.assert_called_once_with(BILL_ROOT)
-        invoice_builder.os.remove.assert_called_once_with(BILL_ROOT + '/file1.html')
+        invoice_builder.store_invoice.assert_called_once_with(JOB_DIR + '/invoice.pdf', INVOICE_KEY)
+        invoice_builder.shutil.rmtree.assert_called_once_with(JOB_DIR, ignore_errors=True)
+
+    def test_invoice_templates_cached(self):
+        self._generate_invoice()
+        self._generate_invoice()
+
+        invoice_builder.loader.get_template.assert_called_once_with('contracting/bill_template_initial.html')
+        self.assertEquals(2, self._template.render.call_count)
+
+    @override_settings(INVOICE_ASYNC=True)
+    def test_invoice_generation_async(self):
+        invoice_path = self._generate_invoice()
+
+        self.assertEquals(INVOICE_URL, invoice_path)
+
+        # The conversion is left to the pool
+        self.assertEquals(0, self._pool.apply.call_count)
+        self._pool.apply_async.assert_called_once_with(
+            invoice_builder._try_convert_invoice, (JOB_DIR, INVOICE_KEY))
+        self.assertEquals(0, invoice_builder.subprocess.call.call_count)
+
+    def test_when_ready_no_conversions(self):
+        callback = MagicMock()
+
+        builder = invoice_builder.InvoiceBuilder(self._order)
+        builder.generate_invoice(self._contract, SINGLE_PAYMENT_TRANS, 'initial')
+        builder.when_ready(callback)
+
+        # Synchronous invoices already exist, so the callback is called in the calling thread
+        callback.assert_called_once_with([])
+
+    @override_settings(INVOICE_ASYNC=True)
+    def test_when_ready_async(self):
+        invoice_builder.get_invoice_storage.return_value.get_url.side_effect = ['/charging/media/bills/1.pdf', '/charging/media/bills/2.pdf']
+        self._pool.apply_async.side_effect = [MagicMock(get=MagicMock(return_value=True)), MagicMock(get=MagicMock(return_value=False))]
+
+        invoice_builder.threading = MagicMock()
+        callback = MagicMock()
+
+        builder = invoice_builder.InvoiceBuilder(self._order)
+        builder.generate_invoice(self._contract, SINGLE_PAYMENT_TRANS, 'initial')
+        builder.generate_invoice(self._contract, SINGLE_PAYMENT_TRANS, 'initial')
+        builder.when_ready(callback)
+
+        # The conversions are waited in a separate thread
+        self.assertEquals(0, callback.call_count)
+        self.assertTrue(invoice_builder.threading.Thread.return_value.daemon)
+        invoice_builder.threading.Thread.return_value.start.assert_called_once_with()
+
+        invoice_builder.threading.Thread.call_args[1]['target']()
+        callback.assert_called_once_with(['/charging/media/bills/2.pdf'])
+
+    def test_try_convert_invoice(self):
+        invoice_builder.subprocess.call.side_effect = [0, 1]
+
+        self.assertTrue(invoice_builder._try_convert_invoice(JOB_DIR, INVOICE_KEY))
+        self.assertFalse(invoice_builder._try_convert_invoice(JOB_DIR, INVOICE_KEY))
+
+        invoice_builder.release_invoice.assert_called_once_with(INVOICE_KEY)
+
+    def test_invoice_conversion_error(self):
+        invoice_builder.subprocess.call.return_value = 1
+
+        with self.assertRaises(IOError):
+            self._generate_invoice()
+
+        # The reserved key and the job directory are released
+        invoice_builder.release_invoice.assert_called_once_with(INVOICE_KEY)
+        invoice_builder.shutil.rmtree.assert_called_once_with(JOB_DIR, ignore_errors=True)
+        self.assertEquals(0, invoice_builder.store_invoice.call_count)
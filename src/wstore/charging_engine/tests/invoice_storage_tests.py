@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+import errno
+import os
+from datetime import datetime
+from mock import MagicMock
+from pymongo.errors import DuplicateKeyError
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from wstore.charging_engine import invoice_storage
+
+
+ORDER_ID = '5a1d5cb2e6ea3b5b5a4e1b01'
+BILL_ROOT = '/home/test/media/bills'
+INVOICE_KEY = '2016/06/bf/5a1d5cb2e6ea3b5b5a4e1b01_1_2016-06-06_0.pdf'
+
+
+@override_settings(BILL_ROOT=BILL_ROOT, MEDIA_URL='/charging/media/')
+class InvoiceStorageTestCase(TestCase):
+
+    tags = ('invoices', )
+
+    def setUp(self):
+        invoice_storage.get_database_connection = MagicMock()
+        self._db = invoice_storage.get_database_connection.return_value
+
+        invoice_storage.datetime = MagicMock()
+        invoice_storage.datetime.utcnow.return_value = datetime(2016, 6, 6)
+
+    def tearDown(self):
+        reload(invoice_storage)
+
+    def test_invoice_key(self):
+        key = invoice_storage.get_invoice_key(ORDER_ID, '1', '2016-06-06', 0)
+        self.assertEquals(INVOICE_KEY, key)
+
+    def test_reserve_invoice(self):
+        self._db.wstore_invoices.find.return_value.count.return_value = 1
+        self._db.wstore_invoices.insert_one.side_effect = [DuplicateKeyError('duplicated'), None]
+
+        key = invoice_storage.reserve_invoice(ORDER_ID, '1', '2016-06-06')
+
+        # The reservation starts at the number of existing invoices and skips the taken keys
+        self.assertEquals(INVOICE_KEY.replace('_0.pdf', '_2.pdf'), key)
+        self._db.wstore_invoices.find.assert_called_once_with({
+            'order': ORDER_ID,
+            'item': '1',
+            'date': '2016-06-06'
+        })
+        self._db.wstore_invoices.insert_one.assert_called_with({
+            '_id': key,
+            'order': ORDER_ID,
+            'item': '1',
+            'date': '2016-06-06',
+            'state': invoice_storage.PENDING,
+            'created': datetime(2016, 6, 6)
+        })
+
+    def test_reserve_invoice_index(self):
+        self._db.wstore_invoices.find.return_value.count.return_value = 0
+
+        invoice_storage.reserve_invoice(ORDER_ID, '1', '2016-06-06')
+        invoice_storage.reserve_invoice(ORDER_ID, '2', '2016-06-06')
+
+        # The index is only created by the first reservation
+        self._db.wstore_invoices.create_index.assert_called_once_with([('order', 1), ('item', 1), ('date', 1)])
+
+    @override_settings(INVOICE_STORAGE='wstore.charging_engine.invoice_storage.LocalInvoiceStorage')
+    def test_store_invoice(self):
+        invoice_storage.os = MagicMock()
+        invoice_storage.os.path.join = os.path.join
+        invoice_storage.os.path.dirname.return_value = BILL_ROOT + '/2016/06/bf'
+        invoice_storage.os.makedirs.side_effect = OSError(errno.EEXIST, 'File exists')
+        invoice_storage.shutil = MagicMock()
+
+        invoice_storage.store_invoice('/tmp/invoice-1/invoice.pdf', INVOICE_KEY)
+
+        invoice_storage.os.makedirs.assert_called_once_with(BILL_ROOT + '/2016/06/bf')
+        invoice_storage.shutil.move.assert_called_once_with('/tmp/invoice-1/invoice.pdf', BILL_ROOT + '/' + INVOICE_KEY)
+        self._db.wstore_invoices.update_one.assert_called_once_with(
+            {'_id': INVOICE_KEY}, {'$set': {'state': invoice_storage.READY}})
+
+        url = invoice_storage.get_invoice_storage().get_url(INVOICE_KEY)
+        self.assertEquals('/charging/media/bills/' + INVOICE_KEY, url)
+
+    def test_release_invoice(self):
+        invoice_storage.release_invoice(INVOICE_KEY)
+
+        self._db.wstore_invoices.delete_one.assert_called_once_with({
+            '_id': INVOICE_KEY,
+            'state': invoice_storage.PENDING
+        })
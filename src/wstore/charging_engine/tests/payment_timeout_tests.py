@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+from bson import ObjectId
+from datetime import datetime
+from mock import MagicMock, call
+from nose_parameterized import parameterized
+from pymongo.errors import OperationFailure
+
+from django.test import TestCase
+
+from wstore.charging_engine import payment_timeout
+
+ORDER_ID = '111111111111111111111111'
+
+
+class PaymentTimeoutTestCase(TestCase):
+
+    tags = ('charging-engine', 'payment-timeout')
+
+    def setUp(self):
+        self._db = MagicMock()
+        payment_timeout.get_database_connection = MagicMock(return_value=self._db)
+
+        self._order = MagicMock()
+        self._order.order_id = '1'
+        payment_timeout.Order = MagicMock()
+        payment_timeout.Order.objects.get.return_value = self._order
+
+        payment_timeout.OrderingClient = MagicMock()
+
+        self._now = datetime(2016, 1, 20, 13, 12, 39)
+        payment_timeout.datetime = MagicMock()
+        payment_timeout.datetime.utcnow.return_value = self._now
+
+    def tearDown(self):
+        reload(payment_timeout)
+
+    def _check_unlocked(self):
+        self.assertEquals([
+            call({'_id': ObjectId(ORDER_ID)}, {'$set': {'_lock': True}}),
+            call({'_id': ObjectId(ORDER_ID)}, {'$set': {'_lock': False, 'payment_deadline': None}})
+        ], self._db.wstore_order.find_one_and_update.call_args_list)
+
+    def test_initial_timeout(self):
+        self._db.wstore_order.find_one_and_update.return_value = {'state': 'pending'}
+        self._order.pending_payment.concept = 'initial'
+
+        payment_timeout.process_payment_timeout(ORDER_ID)
+
+        payment_timeout.Order.objects.get.assert_called_once_with(pk=ORDER_ID)
+        client = payment_timeout.OrderingClient()
+        client.get_order.assert_called_once_with('1')
+        client.update_items_state.assert_called_once_with(client.get_order(), 'Failed')
+        self._order.delete.assert_called_once_with()
+
+        self._check_unlocked()
+
+    @parameterized.expand([
+        ('recurring', ),
+        ('usage', )
+    ])
+    def test_renovation_timeout(self, concept):
+        self._db.wstore_order.find_one_and_update.return_value = {'_lock': False, 'state': 'pending'}
+        self._order.pending_payment.concept = concept
+
+        payment_timeout.process_payment_timeout(ORDER_ID)
+
+        self.assertEquals('paid', self._order.state)
+        self.assertEquals(None, self._order.pending_payment)
+        self.assertEquals(None, self._order.payment_deadline)
+        self._order.save.assert_called_once_with()
+        self._order.delete.assert_not_called()
+
+        self._check_unlocked()
+
+    def test_timeout_not_pending(self):
+        self._db.wstore_order.find_one_and_update.return_value = {'_lock': False, 'state': 'paid'}
+
+        payment_timeout.process_payment_timeout(ORDER_ID)
+
+        payment_timeout.Order.objects.get.assert_not_called()
+        self._check_unlocked()
+
+    def test_timeout_locked(self):
+        self._db.wstore_order.find_one_and_update.return_value = {'_lock': True, 'state': 'pending'}
+
+        payment_timeout.process_payment_timeout(ORDER_ID)
+
+        payment_timeout.Order.objects.get.assert_not_called()
+        self._db.wstore_order.find_one_and_update.assert_called_once_with(
+            {'_id': ObjectId(ORDER_ID)}, {'$set': {'_lock': True}})
+
+        self._db.wstore_order.update_one.assert_called_once_with(
+            {'_id': ObjectId(ORDER_ID), '_lock': True}, {'$set': {'payment_deadline': None}})
+
+    @parameterized.expand([
+        ('next_deadline', {'payment_deadline': datetime(2016, 1, 20, 13, 15, 0)}, datetime(2016, 1, 20, 13, 15, 0)),
+        ('no_deadline', None, None)
+    ])
+    def test_process_expired(self, name, next_order, expected):
+        self._db.wstore_order.find.return_value.sort.return_value = [
+            {'_id': ObjectId(ORDER_ID)},
+            {'_id': ObjectId('222222222222222222222222')}
+        ]
+        self._db.wstore_order.find_one.return_value = next_order
+
+        payment_timeout.process_payment_timeout = MagicMock(side_effect=[Exception('Unexpected'), None])
+        deadline = payment_timeout.process_expired_payments()
+
+        self.assertEquals(expected, deadline)
+
+        self._db.wstore_order.find.assert_called_once_with(
+            {'payment_deadline': {'$lte': self._now}}, {'_id': True})
+        self._db.wstore_order.find.return_value.sort.assert_called_once_with('payment_deadline', 1)
+        self.assertEquals([
+            call(ORDER_ID),
+            call('222222222222222222222222')
+        ], payment_timeout.process_payment_timeout.call_args_list)
+
+    def test_ensure_timeout_index(self):
+        payment_timeout.ensure_timeout_index()
+
+        self._db.wstore_order.create_index.assert_called_once_with('payment_deadline', sparse=True)
+        self.assertEquals(0, self._db.wstore_order.drop_index.call_count)
+
+    def test_ensure_timeout_index_conflict(self):
+        self._db.wstore_order.create_index.side_effect = [OperationFailure('Index options conflict', code=85), None]
+
+        payment_timeout.ensure_timeout_index()
+
+        # The old non sparse index is replaced
+        self._db.wstore_order.drop_index.assert_called_once_with('payment_deadline_1')
+        self.assertEquals([
+            call('payment_deadline', sparse=True),
+            call('payment_deadline', sparse=True)
+        ], self._db.wstore_order.create_index.call_args_list)
@@ -108,7 +108,7 @@ def RSSUrl():
 def setUp():
     # Libraries
     payout_engine.threading = MagicMock()
-    payout_engine.requests = MagicMock()
+    payout_engine.http_client = MagicMock()
     payout_engine.Payout = MagicMock()
 
     # Models
@@ -132,16 +132,16 @@ class PayoutWatcherTestCase(TestCase):
 
     def test_mark_as_paid(self):
         watcher = payout_engine.PayoutWatcher([], [])
-        payout_engine.requests.patch().status_code = 200
-        payout_engine.requests.patch().json.return_value = [{'test': 'case'}]
+        payout_engine.http_client.patch().status_code = 200
+        payout_engine.http_client.patch().json.return_value = [{'test': 'case'}]
 
-        payout_engine.requests.patch.reset_mock()
+        payout_engine.http_client.patch.reset_mock()
 
         result = watcher._mark_as_paid("report1")
 
         url = "{}/rss/settlement/reports/{}".format(RSSUrl(), "report1")
 
-        payout_engine.requests.patch.assert_called_once_with(
+        payout_engine.http_client.patch.assert_called_once_with(
             url,
             json=[{'op': 'replace', 'path': '/paid', 'value': True}],
             headers={
@@ -150,22 +150,22 @@ class PayoutWatcherTestCase(TestCase):
                 'X-Roles': 'provider',
                 'X-Email': settings.WSTOREMAIL})
 
-        payout_engine.requests.patch().json.assert_called_once_with()
+        payout_engine.http_client.patch().json.assert_called_once_with()
 
         assert result == [{'test': 'case'}]
 
     def test_mark_as_paid_error(self):
         watcher = payout_engine.PayoutWatcher([], [])
-        payout_engine.requests.patch().status_code = 404
-        payout_engine.requests.patch().json.return_value = [{'test': 'case'}]
+        payout_engine.http_client.patch().status_code = 404
+        payout_engine.http_client.patch().json.return_value = [{'test': 'case'}]
 
-        payout_engine.requests.patch.reset_mock()
+        payout_engine.http_client.patch.reset_mock()
 
         result = watcher._mark_as_paid("report1")
 
         url = "{}/rss/settlement/reports/{}".format(RSSUrl(), "report1")
 
-        payout_engine.requests.patch.assert_called_once_with(
+        payout_engine.http_client.patch.assert_called_once_with(
             url,
             json=[{'op': 'replace', 'path': '/paid', 'value': True}],
             headers={
@@ -174,7 +174,7 @@ class PayoutWatcherTestCase(TestCase):
                 'X-Roles': 'provider',
                 'X-Email': settings.WSTOREMAIL})
 
-        payout_engine.requests.patch().json.assert_not_called()
+        payout_engine.http_client.patch().json.assert_not_called()
 
         assert result == []
 
@@ -456,16 +456,16 @@ class PayoutEngineTestCase(TestCase):
 
     def test_get_reports_not_paid(self):
         engine = payout_engine.PayoutEngine()
-        payout_engine.requests.get().status_code = 200
-        payout_engine.requests.get().json.return_value = [{'test': 'case'}]
+        payout_engine.http_client.get().status_code = 200
+        payout_engine.http_client.get().json.return_value = [{'test': 'case'}]
 
-        payout_engine.requests.get.reset_mock()
+        payout_engine.http_client.get.reset_mock()
 
         result = engine._get_reports()
 
         url = "{}/rss/settlement/reports".format(RSSUrl())
 
-        payout_engine.requests.get.assert_called_once_with(
+        payout_engine.http_client.get.assert_called_once_with(
             url,
             params={'aggregatorId': None, 'providerId': None, 'productClass': None, 'onlyPaid': "true"},
             headers={
@@ -474,7 +474,7 @@ class PayoutEngineTestCase(TestCase):
                 'X-Roles': 'provider',
                 'X-Email': settings.WSTOREMAIL})
 
-        payout_engine.requests.get().json.assert_called_once_with()
+        payout_engine.http_client.get().json.assert_called_once_with()
 
         assert result == [{'test': 'case'}]
 
@@ -155,6 +155,7 @@ class PayPalConfirmation(Resource):
                 else:
                     order.state = 'paid'
                     order.pending_payment = None
+                    order.payment_deadline = None
                     order.save()
 
             expl = ' due to an unexpected error'
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from wstore.asset_manager.blob_store import collect_garbage, ensure_blob_index
+
+
+class Command(BaseCommand):
+
+    def handle(self, *args, **options):
+        """
+        Removes the stored blobs which are no longer referenced by any asset file
+        """
+        ensure_blob_index()
+        count = collect_garbage()
+
+        self.stdout.write('{} blobs have been removed\n'.format(count))
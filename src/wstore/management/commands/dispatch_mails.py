@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from django.core.management.base import BaseCommand
+
+from wstore.admin.users.mail_queue import dispatch_mails, ensure_spool_index, retry_failed_mails
+
+
+class Command(BaseCommand):
+    def handle(self, *args, **kargs):
+        """
+        Send the pending emails of the spool, including those left by stopped processes.
+        Use the retry argument to schedule again the emails which have reached the max attempts
+        """
+        ensure_spool_index()
+
+        if 'retry' in args:
+            retry_failed_mails()
+
+        dispatch_mails()
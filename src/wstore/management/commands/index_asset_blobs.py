@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from wstore.asset_manager.blob_store import ensure_blob_index, store_asset_file
+from wstore.asset_manager.file_upload import get_file_digest
+from wstore.models import Resource
+
+
+class Command(BaseCommand):
+
+    def _store_file(self, version):
+        if not version.resource_path or version.content_hash is not None:
+            return False
+
+        file_path = os.path.join(settings.BASEDIR, version.resource_path)
+        if not os.path.isfile(file_path):
+            return False
+
+        version.content_hash = get_file_digest(file_path)
+        store_asset_file(version.content_hash, file_path)
+        return True
+
+    def handle(self, *args, **options):
+        """
+        Moves the files of the existing assets and their previous versions to the blob
+        store, so the files with the same content are stored only once
+        """
+        ensure_blob_index()
+
+        count = 0
+        for resource in Resource.objects.all():
+            stored = [self._store_file(version) for version in [resource] + list(resource.old_versions)]
+
+            if any(stored):
+                resource.save()
+                count += stored.count(True)
+
+        self.stdout.write('{} asset files have been stored\n'.format(count))
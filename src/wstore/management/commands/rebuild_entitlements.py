@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from wstore.asset_manager.entitlement_index import ensure_entitlement_index, rebuild_entitlements
+from wstore.ordering.models import Order
+
+
+class Command(BaseCommand):
+
+    def handle(self, *args, **options):
+        """
+        Builds the index of the assets each organization is allowed to download
+        from the existing orders, replacing the current content of the index
+        """
+        ensure_entitlement_index()
+        count = rebuild_entitlements(Order.objects.all())
+
+        self.stdout.write('{} entitlements have been indexed\n'.format(count))
@@ -21,48 +21,55 @@
 from bson import ObjectId
 from datetime import datetime
 
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import BaseCommand
 
-
-from wstore.rss_adaptor.rss_adaptor import RSSAdaptor
+from wstore.rss_adaptor.cdr_outbox import dispatch_cdrs, enqueue_cdrs, ensure_outbox_index, retry_failed_cdrs
 from wstore.store_commons.database import get_database_connection
 from wstore.models import Context, Organization
 
 
 class Command(BaseCommand):
-    def handle(self, *args, **kargs):
-        """
-        Launch failed cdrs
-        """
+
+    def _migrate_failed_cdrs(self):
+        # CDRs failed before using the outbox had their correlation numbers released
         contexts = Context.objects.all()
-        if len(contexts) < 1:
-            raise CommandError("No context")
+        if len(contexts) < 1 or not len(contexts[0].failed_cdrs):
+            return
 
         context = contexts[0]
         cdrs = context.failed_cdrs
         context.failed_cdrs = []
         context.save()
 
-        if len(cdrs) == 0:
-            print("No failed cdrs to send")
-            exit(0)
-
         db = get_database_connection()
         time_stamp = datetime.utcnow().isoformat() + 'Z'
 
+        providers = {}
         for cdr in cdrs:
-            # Modify time_stamp
-            cdr['time_stamp'] = time_stamp
+            providers.setdefault(cdr['provider'], []).append(cdr)
 
-            # Modify correlation number
-            org = Organization.objects.get(name=cdr['provider'])
-
-            new_org = db.wstore_organization.find_and_modify(
+        for provider, provider_cdrs in providers.items():
+            # Reserve a new block of correlation numbers for the provider CDRs
+            org = Organization.objects.get(name=provider)
+            corr_number = db.wstore_organization.find_and_modify(
                 query={'_id': ObjectId(org.pk)},
-                update={'$inc': {'correlation_number': 1}}
-            )
+                update={'$inc': {'correlation_number': len(provider_cdrs)}}
+            )['correlation_number']
+
+            for cdr in provider_cdrs:
+                cdr['time_stamp'] = time_stamp
+                cdr['correlation'] = unicode(corr_number)
+                corr_number += 1
+
+        enqueue_cdrs(cdrs)
 
-            cdr['correlation'] = new_org['correlation_number']
+    def handle(self, *args, **kargs):
+        """
+        Launch failed cdrs, scheduling again the CDRs of the outbox which
+        have reached the max number of attempts
+        """
+        ensure_outbox_index()
+        self._migrate_failed_cdrs()
 
-        r = RSSAdaptor()
-        r.send_cdr(cdrs)
+        retry_failed_cdrs()
+        dispatch_cdrs()
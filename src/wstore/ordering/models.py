@@ -20,6 +20,8 @@
 
 from __future__ import unicode_literals
 
+from datetime import timedelta
+
 from django.db import models
 from django.contrib.auth.models import User
 from djangotoolbox.fields import DictField, EmbeddedModelField, ListField
@@ -70,6 +72,33 @@ class Contract(models.Model):
 
     terminated = models.BooleanField(default=False)
 
+    # Date of the next subscription renovation or usage payment, used to find the due contracts
+    next_deadline = models.DateTimeField(blank=True, null=True)
+
+    def update_next_deadline(self, order_date):
+        self.next_deadline = None
+        if self.terminated:
+            return
+
+        deadlines = []
+        if 'subscription' in self.pricing_model:
+            deadlines.extend([
+                item['renovation_date'] for item in self.pricing_model['subscription'] if 'renovation_date' in item
+            ])
+
+        if 'pay_per_use' in self.pricing_model:
+            # Usage payments are renovated every 30 days since the last usage charge
+            last_charge = order_date
+            for charge in reversed(self.charges):
+                if charge.concept == 'usage':
+                    last_charge = charge.date
+                    break
+
+            deadlines.append(last_charge + timedelta(days=30))
+
+        if len(deadlines):
+            self.next_deadline = min(deadlines)
+
 
 class Payment(models.Model):
     transactions = ListField()
@@ -93,6 +122,9 @@ class Order(models.Model):
 
     # Pending payment info used in asynchronous charges
     pending_payment = EmbeddedModelField(Payment, null=True, blank=True)
+    # Date when the pending payment expires if not confirmed by the customer,
+    # its sparse index is created by the payment timeout worker
+    payment_deadline = models.DateTimeField(null=True, blank=True)
 
     def get_item_contract(self, item_id):
         # Search related contract
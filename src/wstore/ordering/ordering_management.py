@@ -21,9 +21,10 @@
 from __future__ import unicode_literals
 
 import re
-import requests
+import sys
 from decimal import Decimal
 from datetime import datetime
+from functools import partial
 from urlparse import urlparse
 
 from django.conf import settings
@@ -34,7 +35,24 @@ from wstore.charging_engine.charging_engine import ChargingEngine
 from wstore.ordering.errors import OrderingError
 from wstore.ordering.models import Order, Contract, Offering
 from wstore.asset_manager.product_validator import ProductValidator
+from wstore.asset_manager.bundle_resolver import get_bundle_resolver
+from wstore.asset_manager.entitlement_index import revoke_entitlements
 from wstore.asset_manager.resource_plugins.decorators import on_product_suspended
+from wstore.store_commons import http_client
+from wstore.store_commons.download_cache import DownloadCache
+from wstore.store_commons.worker import get_thread_pool
+
+# Catalog entities are invalidated by the catalog validators when a provider modifies them
+_catalog_cache = DownloadCache('CATALOG_CACHE_TTL', 'CATALOG_CACHE_SIZE')
+_account_cache = DownloadCache('ACCOUNT_CACHE_TTL', 'ACCOUNT_CACHE_SIZE')
+
+
+def _run_task(task):
+    # Errors are returned instead of raised, so they can be reported in a deterministic order
+    try:
+        return task(), None
+    except Exception:
+        return None, sys.exc_info()
 
 
 class OrderingManager:
@@ -43,13 +61,16 @@ class OrderingManager:
         self._customer = None
         self._validator = ProductValidator()
 
-    def _download(self, url, element, item_id):
-        r = requests.get(url, verify=settings.VERIFY_REQUESTS)
+    def _download(self, url, element, item_id, version=None):
+        def download(headers):
+            return http_client.get(url, headers=headers, verify=settings.VERIFY_REQUESTS)
+
+        document = _catalog_cache.get((url, version), download)
 
-        if r.status_code != 200:
+        if document is None:
             raise OrderingError('The ' + element + ' specified in order item ' + item_id + ' does not exists')
 
-        return r.json()
+        return document
 
     def _get_offering(self, item):
 
@@ -58,16 +79,18 @@ class OrderingManager:
         off = urlparse(item['productOffering']['href'])
 
         offering_url = '{}://{}{}'.format(site.scheme, site.netloc, off.path)
-        offering_info = self._download(offering_url, 'product offering', item['id'])
+        offering_info = self._download(
+            offering_url, 'product offering', item['id'], version=item['productOffering'].get('version'))
 
         offering_id = offering_info['id']
 
         # Check if the offering has been already loaded in the system
-        if len(Offering.objects.filter(off_id=offering_id)) > 0:
-            offering = Offering.objects.get(off_id=offering_id)
+        offerings = Offering.objects.filter(off_id=offering_id)
+        if len(offerings) > 0:
+            offering = offerings[0]
 
             # If the offering defines a digital product, check if the customer already owns it
-            included_offerings = [Offering.objects.get(pk=off_pk) for off_pk in offering.bundled_offerings]
+            included_offerings = get_bundle_resolver().get_offerings(offering.bundled_offerings)
             included_offerings.append(offering)
 
             # def owned_digital(off):
@@ -237,12 +260,17 @@ class OrderingManager:
             if not self._customer.userprofile.current_organization.private:
                 headers['x-organization'] = self._customer.userprofile.current_organization.name
 
-            r = requests.get(url, headers=headers, verify=settings.VERIFY_REQUESTS)
+            def download(extra_headers):
+                extra_headers.update(headers)
+                return http_client.get(url, headers=extra_headers, verify=settings.VERIFY_REQUESTS)
 
-            if r.status_code != 200:
+            # Accounts are only accessible with the customer credentials, so they are part of the key
+            document = _account_cache.get((url, headers['Authorization'], headers.get('x-organization')), download)
+
+            if document is None:
                 raise OrderingError('There was an error at the time of retrieving the Billing Address')
 
-            return r.json()
+            return document
 
         site = urlparse(settings.SITE)
 
@@ -272,7 +300,20 @@ class OrderingManager:
 
     def _process_add_items(self, items, order_id, description):
 
-        new_contracts = [self._build_contract(item) for item in items]
+        # Contracts and billing address are downloaded concurrently, no model is created
+        # until all of them have been resolved, so there is nothing to rollback on failure
+        tasks = [partial(self._build_contract, item) for item in items]
+        tasks.append(partial(self._get_billing_address, items))
+
+        results = get_thread_pool('ordering', 'ORDERING_WORKERS').map(_run_task, tasks)
+
+        # Raise the error of the first failed task following the order of the items
+        for result, exc_info in results:
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+        new_contracts = [result for result, exc_info in results[:-1]]
+        tax_address = results[-1][0]
 
         current_org = self._customer.userprofile.current_organization
         order = Order.objects.create(
@@ -281,7 +322,7 @@ class OrderingManager:
             owner_organization=current_org,
             date=datetime.utcnow(),
             state='pending',
-            tax_address=self._get_billing_address(items),
+            tax_address=tax_address,
             contracts=new_contracts,
             description=description
         )
@@ -357,8 +398,10 @@ class OrderingManager:
 
             # Suspend the access to the service
             on_product_suspended(order, contract)
+            revoke_entitlements(order, contract)
 
             contract.terminated = True
+            contract.next_deadline = None
             order.save()
 
             # Terminate product in the inventory
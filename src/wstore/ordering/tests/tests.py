@@ -33,12 +33,15 @@ from django.test.utils import override_settings
 
 from wstore.models import Organization
 from wstore.ordering.errors import OrderingError
-from wstore.ordering.models import Order, Offering, Contract
+from wstore.ordering.models import Charge, Order, Offering, Contract
 
 from wstore.ordering.tests.test_data import *
 from wstore.ordering import ordering_client, ordering_management, inventory_client
 
 
+OFFERING_PATH = '/DSProductCatalog/api/catalogManagement/v2/productOffering/20:(2.0)'
+
+
 @override_settings(SITE='http://extpath.com:8080/')
 class OrderingManagementTestCase(TestCase):
 
@@ -59,6 +62,7 @@ class OrderingManagementTestCase(TestCase):
         self._order_inst.bundled_offerings = []
         ordering_management.Offering.objects.filter.return_value = []
         ordering_management.Offering.objects.create.return_value = self._offering_inst
+        ordering_management.get_bundle_resolver = MagicMock()
 
         # Mock Contract model
         ordering_management.Contract = MagicMock()
@@ -71,12 +75,27 @@ class OrderingManagementTestCase(TestCase):
         self._charging_inst.resolve_charging.return_value = 'http://redirectionurl.com/'
         ordering_management.ChargingEngine.return_value = self._charging_inst
 
-        # Mock requests
-        ordering_management.requests = MagicMock()
-        self._response = MagicMock()
-        self._response.status_code = 200
-        self._response.json.side_effect = [OFFERING, BILLING_ACCOUNT, CUSTOMER_ACCOUNT, CUSTOMER]
-        ordering_management.requests.get.return_value = self._response
+        # Mock requests, the downloads are made concurrently so responses depend on the URL
+        self._documents = {
+            OFFERING_PATH: OFFERING,
+            urlparse(BILLING_ACCOUNT_HREF).path: BILLING_ACCOUNT,
+            urlparse(BILLING_ACCOUNT['customerAccount']['href']).path: CUSTOMER_ACCOUNT,
+            urlparse(CUSTOMER_ACCOUNT['customer']['href']).path: CUSTOMER
+        }
+        self._status_codes = {}
+
+        def get(url, **kwargs):
+            path = urlparse(url).path
+            response = MagicMock()
+            response.status_code = self._status_codes.get(path, 200)
+            response.json.return_value = self._documents.get(path)
+            return response
+
+        ordering_management.http_client = MagicMock()
+        ordering_management.http_client.get.side_effect = get
+
+        ordering_management._catalog_cache.clear()
+        ordering_management._account_cache.clear()
 
         # Mock organization model
         self._org_inst = MagicMock()
@@ -117,7 +136,8 @@ class OrderingManagementTestCase(TestCase):
 
     def _check_offering_retrieving_call(self):
         ordering_management.Offering.objects.filter.assert_called_once_with(off_id="5")
-        ordering_management.Offering.objects.get.assert_called_once_with(off_id="5")
+        ordering_management.get_bundle_resolver().get_offerings.assert_called_once_with(
+            self._offering_inst.bundled_offerings)
 
     def _basic_add_checker(self):
         # Check offering creation
@@ -245,12 +265,7 @@ class OrderingManagementTestCase(TestCase):
         })
 
     def _invalid_billing(self):
-        valid_response = MagicMock()
-        valid_response.status_code = 200
-        valid_response.json.side_effect = [OFFERING]
-        invalid_response = MagicMock()
-        invalid_response.status_code = 400
-        ordering_management.requests.get.side_effect = [valid_response, invalid_response]
+        self._status_codes[urlparse(BILLING_ACCOUNT_HREF).path] = 400
 
     def _non_digital_offering(self):
         self._validator_inst.parse_characteristics.return_value = (None, None, None)
@@ -258,20 +273,13 @@ class OrderingManagementTestCase(TestCase):
     def _no_offering_description(self):
         new_off = deepcopy(OFFERING)
         del(new_off['description'])
-        self._response.json.side_effect = [new_off, BILLING_ACCOUNT, CUSTOMER_ACCOUNT, CUSTOMER]
+        self._documents[OFFERING_PATH] = new_off
 
     def _missing_offering(self):
-        self._response.status_code = 404
+        self._status_codes[OFFERING_PATH] = 404
 
     def _missing_product(self):
-        def get(url):
-            result = self._response
-            if url == "http://producturl.com/":
-                result = MagicMock()
-                result.status_code = 404
-            return result
-
-        ordering_management.requests.get = get
+        self._status_codes[urlparse(OFFERING['productSpecification']['href']).path] = 404
 
     def _already_owned(self):
         self._offering_inst.pk = '11111'
@@ -298,7 +306,7 @@ class OrderingManagementTestCase(TestCase):
     def _missing_postal(self):
         new_cust = deepcopy(CUSTOMER)
         new_cust['contactMedium'] = []
-        self._response.json.side_effect = [OFFERING, BILLING_ACCOUNT, CUSTOMER_ACCOUNT, new_cust]
+        self._documents[urlparse(CUSTOMER_ACCOUNT['customer']['href']).path] = new_cust
 
     @parameterized.expand([
         #('basic_add', BASIC_ORDER, BASIC_PRICING, _basic_add_checker),
@@ -349,16 +357,17 @@ class OrderingManagementTestCase(TestCase):
             ordering_management.ChargingEngine.assert_called_once_with(self._order_inst)
 
             # Check offering and product downloads
-            self.assertEquals(4, ordering_management.requests.get.call_count)
+            self.assertEquals(4, ordering_management.http_client.get.call_count)
 
             headers = {'Authorization': 'Bearer ' + self._customer.userprofile.access_token}
             exp_url = 'http://extpath.com:8080{}'
-            self.assertEquals([
-                call(exp_url.format('/DSProductCatalog/api/catalogManagement/v2/productOffering/20:(2.0)')),
-                call(exp_url.format(urlparse(BILLING_ACCOUNT_HREF).path), headers=headers),
-                call(exp_url.format(urlparse(BILLING_ACCOUNT['customerAccount']['href']).path), headers=headers),
-                call(exp_url.format(urlparse(CUSTOMER_ACCOUNT['customer']['href']).path), headers=headers)
-            ], ordering_management.requests.get.call_args_list)
+            verify = ordering_management.settings.VERIFY_REQUESTS
+            self.assertItemsEqual([
+                call(exp_url.format(OFFERING_PATH), headers={}, verify=verify),
+                call(exp_url.format(urlparse(BILLING_ACCOUNT_HREF).path), headers=headers, verify=verify),
+                call(exp_url.format(urlparse(BILLING_ACCOUNT['customerAccount']['href']).path), headers=headers, verify=verify),
+                call(exp_url.format(urlparse(CUSTOMER_ACCOUNT['customer']['href']).path), headers=headers, verify=verify)
+            ], ordering_management.http_client.get.call_args_list)
 
             contact_medium = CUSTOMER['contactMedium'][0]['medium']
 
@@ -384,6 +393,30 @@ class OrderingManagementTestCase(TestCase):
         else:
             self.assertEquals(err_msg, unicode(error))
 
+    def test_add_items_error_order(self):
+        # The error of the first failed item is reported whatever the task finishing first
+        errors = {
+            '1': None,
+            '2': OrderingError('Item 2 error'),
+            '3': OrderingError('Item 3 error')
+        }
+
+        def build_contract(item):
+            if errors[item['id']] is not None:
+                raise errors[item['id']]
+            return self._contract_inst
+
+        ordering_manager = ordering_management.OrderingManager()
+        ordering_manager._customer = self._customer
+        ordering_manager._build_contract = build_contract
+        ordering_manager._get_billing_address = MagicMock(side_effect=OrderingError('Billing error'))
+
+        with self.assertRaises(OrderingError) as cm:
+            ordering_manager._process_add_items([{'id': '1'}, {'id': '2'}, {'id': '3'}], '12', '')
+
+        self.assertEquals('OrderingError: Item 2 error', unicode(cm.exception))
+        self.assertEquals(0, ordering_management.Order.objects.create.call_count)
+
     BASIC_MODIFY = {
         'state': 'Acknowledged',
         'orderItem': [{
@@ -501,15 +534,15 @@ class OrderingClientTestCase(TestCase):
         ordering_client.settings.LOCAL_SITE = 'http://testdomain.com'
 
         # Mock requests
-        ordering_client.requests = MagicMock()
+        ordering_client.http_client = MagicMock()
         self._response = MagicMock()
         self._response.status_code = 200
         self._response.json.return_value = {
             'id': '1'
         }
-        ordering_client.requests.post.return_value = self._response
-        ordering_client.requests.patch.return_value = self._response
-        ordering_client.requests.get.return_value = self._response
+        ordering_client.http_client.post.return_value = self._response
+        ordering_client.http_client.patch.return_value = self._response
+        ordering_client.http_client.get.return_value = self._response
 
     def test_ordering_subscription(self):
         client = ordering_client.OrderingClient()
@@ -517,7 +550,7 @@ class OrderingClientTestCase(TestCase):
         client.create_ordering_subscription()
 
         # Check calls
-        ordering_client.requests.post.assert_called_once_with('http://localhost:8080/DSProductOrdering/productOrdering/v2/hub', {
+        ordering_client.http_client.post.assert_called_once_with('http://localhost:8080/DSProductOrdering/productOrdering/v2/hub', {
             'callback': 'http://testdomain.com/charging/api/orderManagement/orders'
         })
 
@@ -572,7 +605,7 @@ class OrderingClientTestCase(TestCase):
         }
         client.update_items_state(order, 'InProgress', items)
 
-        ordering_client.requests.patch.assert_called_once_with(
+        ordering_client.http_client.patch.assert_called_once_with(
             'http://localhost:8080/DSProductOrdering/api/productOrdering/v2/productOrder/20',
             json=expected)
 
@@ -588,7 +621,7 @@ class OrderingClientTestCase(TestCase):
 
         client.update_state(order, new_state)
 
-        ordering_client.requests.patch.assert_called_once_with(
+        ordering_client.http_client.patch.assert_called_once_with(
             'http://localhost:8080/DSProductOrdering/api/productOrdering/v2/productOrder/' + order['id'],
             json={'state': new_state})
 
@@ -603,7 +636,7 @@ class OrderingClientTestCase(TestCase):
             'id': '1'
         }, response)
 
-        ordering_client.requests.get.assert_called_once_with(
+        ordering_client.http_client.get.assert_called_once_with(
             'http://localhost:8080/DSProductOrdering/api/productOrdering/v2/productOrder/1'
         )
         self._response.raise_for_status.assert_called_once_with()
@@ -686,6 +719,26 @@ class OrderTestCase(TestCase):
         self.assertFalse(error is None)
         self.assertEquals('OrderingError: Invalid product id', unicode(e))
 
+    @parameterized.expand([
+        ('no_deadline', {'single_payment': []}, [], None),
+        ('subscription', {'subscription': [{
+            'renovation_date': datetime(2016, 3, 1)
+        }, {
+            'renovation_date': datetime(2016, 2, 10)
+        }]}, [], datetime(2016, 2, 10)),
+        ('usage_not_charged', {'pay_per_use': []}, [], datetime(2016, 1, 31)),
+        ('usage', {'pay_per_use': []}, [
+            Charge(concept='initial', date=datetime(2016, 1, 5)),
+            Charge(concept='usage', date=datetime(2016, 1, 20))
+        ], datetime(2016, 2, 19)),
+        ('terminated', {'pay_per_use': []}, [], None, True)
+    ])
+    def test_update_next_deadline(self, name, pricing, charges, exp_deadline, terminated=False):
+        contract = Contract(pricing_model=pricing, charges=charges, terminated=terminated)
+        contract.update_next_deadline(datetime(2016, 1, 1))
+
+        self.assertEquals(exp_deadline, contract.next_deadline)
+
 
 @override_settings(
     INVENTORY='http://localhost:8080/DSProductInventory'
@@ -696,11 +749,11 @@ class InventoryClientTestCase(TestCase):
 
     def setUp(self):
         # Mock requests
-        inventory_client.requests = MagicMock()
+        inventory_client.http_client = MagicMock()
         self.response = MagicMock()
         self.response.status_code = 201
-        inventory_client.requests.post.return_value = self.response
-        inventory_client.requests.get.return_value = self.response
+        inventory_client.http_client.post.return_value = self.response
+        inventory_client.http_client.get.return_value = self.response
 
         inventory_client.settings.LOCAL_SITE = 'http://localhost:8004/'
 
@@ -727,17 +780,17 @@ class InventoryClientTestCase(TestCase):
         client = inventory_client.InventoryClient()
         client.create_inventory_subscription()
 
-        inventory_client.requests.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/hub')
+        inventory_client.http_client.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/hub')
 
         if created:
-            inventory_client.requests.post.assert_called_once_with(
+            inventory_client.http_client.post.assert_called_once_with(
                 'http://localhost:8080/DSProductInventory/api/productInventory/v2/hub',
                 json={
                     'callback': 'http://localhost:8004/charging/api/orderManagement/products'
                 }
             )
         else:
-            self.assertEquals(0, inventory_client.requests.post.call_count)
+            self.assertEquals(0, inventory_client.http_client.post.call_count)
 
     def test_create_subscription_error(self):
         self.response.json.return_value = []
@@ -760,20 +813,20 @@ class InventoryClientTestCase(TestCase):
         client = inventory_client.InventoryClient()
         client.activate_product('1')
 
-        inventory_client.requests.patch.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1', json={
+        inventory_client.http_client.patch.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1', json={
             'status': 'Active',
             'startDate': '2016-01-22T04:10:25.176751Z'
         })
-        inventory_client.requests.patch().raise_for_status.assert_called_once_with()
+        inventory_client.http_client.patch().raise_for_status.assert_called_once_with()
 
     def test_suspend_product(self):
         client = inventory_client.InventoryClient()
         client.suspend_product('1')
 
-        inventory_client.requests.patch.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1', json={
+        inventory_client.http_client.patch.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1', json={
             'status': 'Suspended'
         })
-        inventory_client.requests.patch().raise_for_status.assert_called_once_with()
+        inventory_client.http_client.patch().raise_for_status.assert_called_once_with()
 
     def test_terminate_product(self):
         client = inventory_client.InventoryClient()
@@ -788,16 +841,16 @@ class InventoryClientTestCase(TestCase):
                 'status': 'Terminated',
                 'terminationDate': '2016-01-22T04:10:25.176751Z'
             })
-        ], inventory_client.requests.patch.call_args_list)
+        ], inventory_client.http_client.patch.call_args_list)
 
-        self.assertEquals([call(), call()], inventory_client.requests.patch().raise_for_status.call_args_list)
+        self.assertEquals([call(), call()], inventory_client.http_client.patch().raise_for_status.call_args_list)
 
     def test_get_product(self):
         client = inventory_client.InventoryClient()
         client.get_product('1')
 
-        inventory_client.requests.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1')
-        inventory_client.requests.get().raise_for_status.assert_called_once_with()
+        inventory_client.http_client.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1')
+        inventory_client.http_client.get().raise_for_status.assert_called_once_with()
 
     @parameterized.expand([
         ('all', {}, ''),
@@ -807,7 +860,7 @@ class InventoryClientTestCase(TestCase):
         client = inventory_client.InventoryClient()
         products = client.get_products(query=query)
 
-        inventory_client.requests.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product' + qs)
-        inventory_client.requests.get().raise_for_status.assert_called_once_with()
+        inventory_client.http_client.get.assert_called_once_with('http://localhost:8080/DSProductInventory/api/productInventory/v2/product' + qs)
+        inventory_client.http_client.get().raise_for_status.assert_called_once_with()
 
-        self.assertEquals(inventory_client.requests.get().json(), products)
+        self.assertEquals(inventory_client.http_client.get().json(), products)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from django.conf import settings
+
+from wstore.rss_adaptor.rss_adaptor import RSSAdaptor
+from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.spool import Spool
+from wstore.store_commons.worker import ProcessWorker, get_thread_pool
+
+_spool = Spool('wstore_cdr_outbox', 'CDR')
+
+
+def enqueue_cdrs(cdrs):
+    """
+    Stores CDRs in the outbox so they are sent to the RSS by the dispatcher.
+    The CDRs keep their correlation numbers, so they can be safely resent
+    :param cdrs: List of CDRs to be sent
+    """
+    if not len(cdrs):
+        return
+
+    db = get_database_connection()
+    db.wstore_cdr_outbox.insert_many([_spool.build_entry({'cdr': cdr}) for cdr in cdrs])
+
+    _dispatcher.notify()
+
+
+def _send_batch(docs):
+    db = get_database_connection()
+
+    try:
+        sent = RSSAdaptor().send_cdr([doc['cdr'] for doc in docs])
+    except:
+        # The RSS could not be reached, so the whole batch is retried
+        for doc in docs:
+            _spool.schedule_retry(db, doc)
+        return
+
+    if sent:
+        db.wstore_cdr_outbox.delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+        return
+
+    if len(docs) > 1:
+        # The RSS rejects the whole batch when any of its CDRs is invalid, so the batch
+        # is bisected in order to only count the failed attempt to the rejected CDRs
+        half = len(docs) // 2
+        _send_batch(docs[:half])
+        _send_batch(docs[half:])
+        return
+
+    _spool.schedule_retry(db, docs[0])
+
+
+def dispatch_cdrs():
+    """
+    Sends all the CDRs of the outbox ready to be sent, coalescing them in batches
+    :return: The date of the next scheduled retry or None if there is not any
+    """
+    db = get_database_connection()
+    limit = settings.CDR_BATCH_SIZE * settings.CDR_DISPATCHER_WORKERS
+
+    docs = _spool.claim_batch(db, datetime.utcnow(), limit)
+    while len(docs):
+        batches = [docs[i:i + settings.CDR_BATCH_SIZE] for i in range(0, len(docs), settings.CDR_BATCH_SIZE)]
+        get_thread_pool('cdr_dispatcher', 'CDR_DISPATCHER_WORKERS').map(_send_batch, batches)
+
+        docs = _spool.claim_batch(db, datetime.utcnow(), limit)
+
+    return _spool.get_next_attempt(db)
+
+
+def retry_failed_cdrs():
+    """
+    Schedules again the CDRs which have reached the max number of attempts
+    :return: Number of CDRs scheduled
+    """
+    return _spool.retry_failed(get_database_connection())
+
+
+def ensure_outbox_index():
+    _spool.ensure_index(get_database_connection())
+
+
+_dispatcher = ProcessWorker(dispatch_cdrs, 'CDR_DISPATCHER_POLL', setup=ensure_outbox_index)
@@ -20,30 +20,19 @@
 
 from __future__ import unicode_literals
 
-import requests
-import threading
-from bson import ObjectId
-
 from django.conf import settings
 
-from wstore.store_commons.database import get_database_connection
-from wstore.models import Context, Organization
-
-
-class RSSAdaptorThread(threading.Thread):
-
-    def __init__(self, cdr_info):
-        threading.Thread.__init__(self)
-        self.cdr = cdr_info
-
-    def run(self):
-        r = RSSAdaptor()
-        r.send_cdr(self.cdr)
+from wstore.store_commons import http_client
 
 
 class RSSAdaptor:
 
     def send_cdr(self, cdr_info):
+        """
+        Sends a batch of CDRs to the Revenue Sharing System
+        :param cdr_info: List of CDRs to be sent
+        :return: True if the RSS has accepted the CDRs, False otherwise
+        """
         # Build CDRs
         data = []
         for cdr in cdr_info:
@@ -79,18 +68,6 @@ class RSSAdaptor:
             'X-Email': settings.WSTOREMAIL
         }
 
-        response = requests.post(url, json=data, headers=headers)
-
-        if response.status_code != 201:
-            db = get_database_connection()
-            # Restore correlation numbers
-            for cdr in cdr_info:
-                org = Organization.objects.get(name=cdr['provider'])
-                db.wstore_organization.find_and_modify(
-                    query={'_id': ObjectId(org.pk)},
-                    update={'$inc': {'correlation_number': -1}}
-                )['correlation_number']
+        response = http_client.post(url, json=data, headers=headers)
 
-            context = Context.objects.all()[0]
-            context.failed_cdrs.extend(cdr_info)
-            context.save()
+        return response.status_code == 201
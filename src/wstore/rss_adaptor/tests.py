@@ -20,9 +20,8 @@
 
 from __future__ import unicode_literals
 
-from bson import ObjectId
-
 from copy import deepcopy
+from datetime import datetime, timedelta
 from mock import MagicMock
 from mock import call
 from nose_parameterized import parameterized
@@ -30,7 +29,8 @@ from nose_parameterized import parameterized
 from django.test import TestCase
 from django.conf import settings
 
-from wstore.rss_adaptor import rss_adaptor, rss_manager, model_manager
+from wstore.rss_adaptor import cdr_outbox, rss_adaptor, rss_manager, model_manager
+from wstore.store_commons import spool
 
 
 class RSSAdaptorTestCase(TestCase):
@@ -42,15 +42,9 @@ class RSSAdaptorTestCase(TestCase):
         settings.RSS = 'http://testhost.com/rssHost/'
         settings.STORE_NAME = 'wstore'
 
-        rss_adaptor.requests = MagicMock()
+        rss_adaptor.http_client = MagicMock()
         self._response = MagicMock()
-        rss_adaptor.requests.post.return_value = self._response
-
-        # Mocks for fail responses
-        rss_adaptor.get_database_connection = MagicMock()
-        rss_adaptor.Organization = MagicMock()
-        rss_adaptor.Organization.objects.get().pk = b"111111111111"
-        rss_adaptor.Context = MagicMock()
+        rss_adaptor.http_client.post.return_value = self._response
 
     def test_rss_client(self):
         # Create mocks
@@ -58,7 +52,7 @@ class RSSAdaptorTestCase(TestCase):
 
         rss_ad = rss_adaptor.RSSAdaptor()
 
-        rss_ad.send_cdr([{
+        sent = rss_ad.send_cdr([{
             'provider': 'test_provider',
             'correlation': '2',
             'order': '1234567890',
@@ -74,7 +68,7 @@ class RSSAdaptorTestCase(TestCase):
             'type': 'C'
         }])
 
-        rss_adaptor.requests.post.assert_called_once_with(
+        rss_adaptor.http_client.post.assert_called_once_with(
             'http://testhost.com/rssHost/rss/cdrs', json=[{
                 'cdrSource': 'testmail@mail.com',
                 'productClass': 'SaaS',
@@ -98,8 +92,7 @@ class RSSAdaptorTestCase(TestCase):
                 'X-Email': 'testmail@mail.com'
             })
 
-        rss_adaptor.get_database_connection.assert_not_called()
-        rss_adaptor.Context.objects.all.assert_not_called()
+        self.assertTrue(sent)
 
     def test_rss_remote_error(self):
         # Create Mocks
@@ -123,15 +116,152 @@ class RSSAdaptorTestCase(TestCase):
         cdrs = [cdr, cdr]
 
         rss_ad = rss_adaptor.RSSAdaptor()
-        rss_ad.send_cdr(cdrs)
-
-        # Decrement correlation number for every cdr
-        calls = call(query={'_id': ObjectId(b"111111111111")}, update={'$inc': {'correlation_number': -1}})
-        rss_adaptor.get_database_connection().wstore_organization.find_and_modify.assert_has_calls([calls, calls], any_order=True)
-        # Save the failed cdrs
-        rss_adaptor.Context.objects.all.assert_called_once_with()
-        rss_adaptor.Context.objects.all()[0].failed_cdrs.extend.assert_called_once_with(cdrs)
-        rss_adaptor.Context.objects.all()[0].save.assert_called_once_with()
+        self.assertFalse(rss_ad.send_cdr(cdrs))
+
+
+OUTBOX_CDR = {
+    'provider': 'test_provider',
+    'correlation': '2'
+}
+
+
+class CDROutboxTestCase(TestCase):
+
+    tags = ('rss-adaptor', 'cdr-outbox')
+
+    def setUp(self):
+        self._db = MagicMock()
+        cdr_outbox.get_database_connection = MagicMock(return_value=self._db)
+
+        cdr_outbox.RSSAdaptor = MagicMock()
+        cdr_outbox._dispatcher = MagicMock()
+
+        self._now = datetime(2016, 1, 20, 13, 12, 39)
+        cdr_outbox.datetime = MagicMock()
+        cdr_outbox.datetime.utcnow.return_value = self._now
+        spool.datetime = MagicMock()
+        spool.datetime.utcnow.return_value = self._now
+
+        settings.CDR_BATCH_SIZE = 2
+        settings.CDR_DISPATCHER_WORKERS = 1
+        settings.CDR_CLAIM_TIMEOUT = 300
+        settings.CDR_MAX_ATTEMPTS = 3
+        settings.CDR_RETRY_DELAY = 30
+        settings.CDR_RETRY_MAX_DELAY = 3600
+
+        # Run the batches in the current thread
+        cdr_outbox.get_thread_pool = MagicMock()
+        cdr_outbox.get_thread_pool().map.side_effect = lambda func, batches: [func(batch) for batch in batches]
+
+    def tearDown(self):
+        reload(spool)
+        reload(cdr_outbox)
+
+    def test_enqueue_cdrs(self):
+        cdr_outbox.enqueue_cdrs([OUTBOX_CDR])
+
+        self._db.wstore_cdr_outbox.insert_many.assert_called_once_with([{
+            'cdr': OUTBOX_CDR,
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt': self._now,
+            'claim': None,
+            'claimed_at': None
+        }])
+        cdr_outbox._dispatcher.notify.assert_called_once_with()
+
+    def test_enqueue_no_cdrs(self):
+        cdr_outbox.enqueue_cdrs([])
+
+        self._db.wstore_cdr_outbox.insert_many.assert_not_called()
+        cdr_outbox._dispatcher.notify.assert_not_called()
+
+    def test_dispatch_batches(self):
+        docs = [{'_id': i, 'cdr': dict(OUTBOX_CDR, correlation=unicode(i)), 'attempts': 0} for i in range(3)]
+        cdr_outbox._spool.claim_batch = MagicMock(side_effect=[docs, []])
+        self._db.wstore_cdr_outbox.find_one.return_value = None
+        cdr_outbox.RSSAdaptor().send_cdr.return_value = True
+
+        self.assertEquals(None, cdr_outbox.dispatch_cdrs())
+
+        # CDRs are sent in batches keeping their correlation numbers
+        self.assertEquals([
+            call([docs[0]['cdr'], docs[1]['cdr']]),
+            call([docs[2]['cdr']])
+        ], cdr_outbox.RSSAdaptor().send_cdr.call_args_list)
+
+        self.assertEquals([
+            call({'_id': {'$in': [0, 1]}}),
+            call({'_id': {'$in': [2]}})
+        ], self._db.wstore_cdr_outbox.delete_many.call_args_list)
+
+    @parameterized.expand([
+        ('retry', 0, 'pending', 30),
+        ('backoff', 1, 'pending', 60),
+        ('max_attempts', 2, 'failed', 120)
+    ])
+    def test_dispatch_failure(self, name, attempts, state, delay):
+        docs = [{'_id': 0, 'cdr': OUTBOX_CDR, 'attempts': attempts}]
+        cdr_outbox._spool.claim_batch = MagicMock(side_effect=[docs, []])
+        self._db.wstore_cdr_outbox.find_one.return_value = {'next_attempt': self._now}
+        cdr_outbox.RSSAdaptor().send_cdr.return_value = False
+
+        self.assertEquals(self._now, cdr_outbox.dispatch_cdrs())
+
+        self._db.wstore_cdr_outbox.delete_many.assert_not_called()
+        self._db.wstore_cdr_outbox.update_one.assert_called_once_with({'_id': 0}, {
+            '$set': {
+                'state': state,
+                'attempts': attempts + 1,
+                'next_attempt': self._now + timedelta(seconds=delay),
+                'claim': None,
+                'claimed_at': None
+            }
+        })
+
+
+    def test_dispatch_rejected_cdr(self):
+        docs = [{'_id': i, 'cdr': dict(OUTBOX_CDR, correlation=unicode(i)), 'attempts': 0} for i in range(2)]
+        cdr_outbox._spool.claim_batch = MagicMock(side_effect=[docs, []])
+        self._db.wstore_cdr_outbox.find_one.return_value = {'next_attempt': self._now}
+
+        # The RSS rejects any batch containing the second CDR
+        cdr_outbox.RSSAdaptor().send_cdr.side_effect = lambda cdrs: docs[1]['cdr'] not in cdrs
+
+        self.assertEquals(self._now, cdr_outbox.dispatch_cdrs())
+
+        # The batch is bisected so only the rejected CDR is retried
+        self.assertEquals([
+            call([docs[0]['cdr'], docs[1]['cdr']]),
+            call([docs[0]['cdr']]),
+            call([docs[1]['cdr']])
+        ], cdr_outbox.RSSAdaptor().send_cdr.call_args_list)
+
+        self._db.wstore_cdr_outbox.delete_many.assert_called_once_with({'_id': {'$in': [0]}})
+        self._db.wstore_cdr_outbox.update_one.assert_called_once_with({'_id': 1}, {
+            '$set': {
+                'state': 'pending',
+                'attempts': 1,
+                'next_attempt': self._now + timedelta(seconds=30),
+                'claim': None,
+                'claimed_at': None
+            }
+        })
+
+    def test_dispatch_unreachable_rss(self):
+        docs = [{'_id': i, 'cdr': dict(OUTBOX_CDR, correlation=unicode(i)), 'attempts': 0} for i in range(2)]
+        cdr_outbox._spool.claim_batch = MagicMock(side_effect=[docs, []])
+        self._db.wstore_cdr_outbox.find_one.return_value = {'next_attempt': self._now}
+        cdr_outbox.RSSAdaptor().send_cdr.side_effect = Exception('Connection error')
+
+        self.assertEquals(self._now, cdr_outbox.dispatch_cdrs())
+
+        # The batch is not split when the RSS cannot be reached
+        cdr_outbox.RSSAdaptor().send_cdr.assert_called_once_with([docs[0]['cdr'], docs[1]['cdr']])
+        self._db.wstore_cdr_outbox.delete_many.assert_not_called()
+        self.assertEquals([0, 1], [
+            update[0][0]['_id'] for update in self._db.wstore_cdr_outbox.update_one.call_args_list
+        ])
 
 
 BASIC_MODEL = {
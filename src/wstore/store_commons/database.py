@@ -20,40 +20,89 @@
 
 from __future__ import unicode_literals
 
+import os
+import threading
 from bson import ObjectId
 from pymongo import MongoClient
 
 from django.conf import settings
 
 
-def get_database_connection():
-    """
-    Gets a raw database connection to MongoDB
-    """
-    # Get database info from settings
-    database_info = settings.DATABASES['default']
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = {
+    'checkouts': 0,
+    'clients_created': 0
+}
+
+
+def _build_client(database_info):
+    options = {
+        # Sockets are opened on first use, so the client can be created before forking
+        'connect': False
+    }
+    options.update(getattr(settings, 'DATABASE_CLIENT_OPTIONS', {}))
 
-    client = None
     # Create database connection
     if database_info['HOST'] and database_info['PORT']:
-        client = MongoClient(database_info['HOST'], database_info['PORT'])
+        client = MongoClient(database_info['HOST'], int(database_info['PORT']), **options)
     elif database_info['HOST'] and not database_info['PORT']:
-        client = MongoClient(database_info['HOST'])
+        client = MongoClient(database_info['HOST'], **options)
     elif not database_info['HOST'] and database_info['PORT']:
-        client = MongoClient('localhost', database_info['PORT'])
+        client = MongoClient('localhost', int(database_info['PORT']), **options)
     else:
-        client = MongoClient()
-
-    db_name = database_info['NAME']
-    db = client[db_name]
+        client = MongoClient(**options)
 
-    # Authenticate if needed
+    # Authenticate if needed, credentials are cached by the client and
+    # used for every socket of the pool
     if database_info['USER'] and database_info['PASSWORD']:
-        db.authenticate(database_info['USER'], database_info['PASSWORD'], mechanism='MONGODB-CR')
+        client[database_info['NAME']].authenticate(
+            database_info['USER'], database_info['PASSWORD'], mechanism='MONGODB-CR')
+
+    return client
+
+
+def _get_client(database_info):
+    global _client, _client_pid
+
+    # MongoClient instances are not fork safe, so every process builds its own client
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = _build_client(database_info)
+                _client_pid = os.getpid()
+
+                with _stats_lock:
+                    _stats['clients_created'] += 1
+
+    return _client
+
+
+def get_database_connection():
+    """
+    Gets a raw database connection to MongoDB using the process wide client
+    """
+    # Get database info from settings
+    database_info = settings.DATABASES['default']
+    db = _get_client(database_info)[database_info['NAME']]
+
+    with _stats_lock:
+        _stats['checkouts'] += 1
 
     return db
 
 
+def get_connection_stats():
+    """
+    Returns the number of connection checkouts and the number of created clients
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
 class DocumentLock:
 
     def __init__(self, collection, doc_id, lock_id):
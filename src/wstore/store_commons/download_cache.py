@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from pymongo import ReturnDocument
+
+from django.conf import settings
+
+from wstore.store_commons.database import get_database_connection
+
+
+GENERATION_ID = 'generation'
+
+_caches = []
+
+_stamp_lock = threading.Lock()
+_stamp = {
+    'value': 0,
+    'hold_until': 0,
+    'checked': None
+}
+
+
+def _set_stamp(doc, now):
+    with _stamp_lock:
+        _stamp['value'] = doc['value'] if doc is not None else 0
+        _stamp['hold_until'] = doc.get('hold_until', 0) if doc is not None else 0
+        _stamp['checked'] = now
+
+        return dict(_stamp)
+
+
+def _get_stamp():
+    now = time.time()
+
+    # The generation stamp is only read from the database once per TTL, so
+    # invalidations made by other processes are seen after that time at most
+    with _stamp_lock:
+        if _stamp['checked'] is not None and now - _stamp['checked'] < settings.DOWNLOAD_CACHE_GENERATION_TTL:
+            return dict(_stamp)
+
+    db = get_database_connection()
+    return _set_stamp(db.wstore_download_cache.find_one({'_id': GENERATION_ID}), now)
+
+
+def invalidate_downloads():
+    """
+    Invalidates the downloaded documents cached by all the processes. The generation
+    stamp stored in the database is used to notify the rest of processes.
+    Catalog changes are invalidated before being committed, so downloaded documents
+    are not cached until the hold time of the stamp has passed
+    """
+    now = time.time()
+    db = get_database_connection()
+    stamp = db.wstore_download_cache.find_one_and_update(
+        {'_id': GENERATION_ID},
+        {
+            '$inc': {'value': 1},
+            '$set': {'hold_until': now + settings.DOWNLOAD_CACHE_INVALIDATION_HOLD}
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    _set_stamp(stamp, now)
+
+    for cache in _caches:
+        cache.clear()
+
+
+class DownloadCache(object):
+    """
+    TTL and LRU cache of JSON documents downloaded from the APIs. Expired documents
+    including an ETag are revalidated with a conditional request
+    :param ttl_setting: Name of the setting with the seconds a document is considered fresh
+    :param size_setting: Name of the setting with the max number of cached documents
+    """
+
+    def __init__(self, ttl_setting, size_setting):
+        self._ttl_setting = ttl_setting
+        self._size_setting = size_setting
+
+        self._entries = OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+        _caches.append(self)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get_entry(self, key):
+        stamp = _get_stamp()
+
+        with self._lock:
+            if stamp['value'] != self._generation:
+                self._entries.clear()
+                self._generation = stamp['value']
+
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # Mark the entry as the most recently used
+                self._entries[key] = entry
+
+            return entry, stamp
+
+    def _store(self, key, entry, generation):
+        with self._lock:
+            # The cache may have been invalidated while downloading
+            if generation != self._generation:
+                return
+
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+
+            while len(self._entries) > getattr(settings, self._size_setting):
+                self._entries.popitem(last=False)
+
+    def get(self, key, download):
+        """
+        Returns the cached document, downloading it if it is not cached or it has expired
+        :param key: Tuple identifying the document, including at least its URL
+        :param download: Function that makes the request, receives a dict with extra headers
+        :return: The JSON document or None if it cannot be downloaded
+        """
+        entry, stamp = self._get_entry(key)
+        now = time.time()
+
+        if entry is not None and entry['expires'] > now:
+            self.hits += 1
+            return deepcopy(entry['document'])
+
+        headers = {}
+        if entry is not None and entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+
+        r = download(headers)
+
+        if r.status_code == 304 and entry is not None:
+            self.revalidations += 1
+            document = entry['document']
+            etag = entry['etag']
+
+        elif r.status_code == 200:
+            self.misses += 1
+            document = r.json()
+            etag = r.headers.get('ETag')
+
+        else:
+            return None
+
+        # Documents downloaded while a catalog change may not be committed yet are not cached
+        if now >= stamp['hold_until']:
+            self._store(key, {
+                'document': document,
+                'etag': etag,
+                'expires': now + getattr(settings, self._ttl_setting)
+            }, stamp['value'])
+
+        # Callers get their own copy, so cached documents cannot be modified
+        return deepcopy(document)
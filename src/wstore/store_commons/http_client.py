@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import os
+import re
+import threading
+import time
+import requests
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from urlparse import urlparse
+
+from django.conf import settings
+
+
+# Upper bounds (in milliseconds) of the latency histogram buckets
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_ID_SEGMENT = re.compile(r'^([0-9]+|[0-9a-fA-F]{24}|[0-9a-fA-F-]{32,36})$')
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    Raised when a request is made to a host whose circuit is open
+    due to consecutive failures
+    """
+    pass
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, threshold, reset_timeout):
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            # Half open, a request is allowed to check if the host has recovered
+            if time.time() - self._opened_at >= self._reset_timeout:
+                self._opened_at = time.time()
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self._threshold:
+                self._opened_at = time.time()
+
+    def is_open(self):
+        return self._opened_at is not None
+
+
+class LatencyHistogram(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, elapsed_ms):
+        self.count += 1
+        self.total += elapsed_ms
+
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed_ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total,
+            'buckets': dict(zip([unicode(b) for b in LATENCY_BUCKETS] + ['+Inf'], self.buckets))
+        }
+
+
+class HostClient(object):
+    """
+    Pooled keep-alive session used for all the requests made to a host
+    """
+
+    def __init__(self, host):
+        self.host = host
+
+        retries = Retry(
+            total=settings.HTTP_RETRIES,
+            backoff_factor=settings.HTTP_RETRY_BACKOFF,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_maxsize=settings.HTTP_POOL_SIZE, max_retries=retries)
+
+        self.session = Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.circuit = CircuitBreaker(settings.HTTP_CIRCUIT_THRESHOLD, settings.HTTP_CIRCUIT_RESET)
+
+    def request(self, method, url, **kwargs):
+        if not self.circuit.allow_request():
+            raise CircuitOpenError('The circuit for ' + self.host + ' is open due to consecutive failures')
+
+        kwargs.setdefault('timeout', (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT))
+
+        start = time.time()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self.circuit.record_failure()
+            raise
+        finally:
+            _record_latency(method, url, (time.time() - start) * 1000)
+
+        if response.status_code >= 500:
+            self.circuit.record_failure()
+        else:
+            self.circuit.record_success()
+
+        return response
+
+
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+_latencies = {}
+_latencies_lock = threading.Lock()
+
+
+def _get_endpoint(method, url):
+    parsed_url = urlparse(url)
+
+    # Resource ids are removed from the path to group the requests made to the same endpoint
+    path = '/'.join([':id' if _ID_SEGMENT.match(segment) else segment for segment in parsed_url.path.split('/')])
+    return '{} {}{}'.format(method.upper(), parsed_url.netloc, path)
+
+
+def _record_latency(method, url, elapsed_ms):
+    endpoint = _get_endpoint(method, url)
+
+    with _latencies_lock:
+        if endpoint not in _latencies:
+            _latencies[endpoint] = LatencyHistogram()
+
+        _latencies[endpoint].observe(elapsed_ms)
+
+
+def get_host_client(url):
+    """
+    Returns the pooled client of the host of the given URL, the clients are
+    created once per process
+    """
+    global _clients, _clients_pid
+
+    parsed_url = urlparse(url)
+    host = parsed_url.scheme + '://' + parsed_url.netloc
+
+    with _clients_lock:
+        # Pooled connections cannot be shared with forked processes
+        if _clients_pid != os.getpid():
+            _clients = {}
+            _clients_pid = os.getpid()
+
+        if host not in _clients:
+            _clients[host] = HostClient(host)
+
+        return _clients[host]
+
+
+def request(method, url, **kwargs):
+    return get_host_client(url).request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs):
+    return request('POST', url, data=data, json=json, **kwargs)
+
+
+def put(url, data=None, **kwargs):
+    return request('PUT', url, data=data, **kwargs)
+
+
+def patch(url, data=None, **kwargs):
+    return request('PATCH', url, data=data, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
+
+
+def get_latency_stats():
+    """
+    Returns the latency histograms of the requests made by the process, by endpoint
+    """
+    with _latencies_lock:
+        return dict([(endpoint, histogram.to_dict()) for endpoint, histogram in _latencies.items()])
+
+
+def get_circuit_states():
+    """
+    Returns whether the circuit of every known host is open
+    """
+    with _clients_lock:
+        return dict([(host, client.circuit.is_open()) for host, client in _clients.items()])
@@ -21,6 +21,10 @@
 
 from __future__ import unicode_literals
 
+import threading
+import time
+from collections import OrderedDict
+
 from django.utils.importlib import import_module
 from django.utils.functional import SimpleLazyObject
 from django.utils.http import http_date, parse_http_date_safe
@@ -125,10 +129,109 @@ class URLMiddleware(object):
                 return response
 
 
+class IdentityCache(object):
+    """
+    TTL and LRU cache of the identities whose headers have already been
+    stored in the database, so they are not synchronized on every request
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None or entry['expires'] <= time.time():
+                self.misses += 1
+                return None
+
+            # Mark the entry as the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+
+            return entry['identity']
+
+    def set(self, key, identity):
+        from django.conf import settings
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = {
+                'identity': identity,
+                'expires': time.time() + settings.API_USER_CACHE_TTL
+            }
+
+            while len(self._entries) > settings.API_USER_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+
+_identity_cache = IdentityCache()
+
+
+def _sync_api_user(user_name, nick_name, display_name, email, roles, user_roles, token):
+    from django.conf import settings
+    from wstore.models import Organization, User
+
+    # Check if the user already exist
+    try:
+        user = User.objects.get(username=user_name)
+    except:
+        user = User.objects.create(username=user_name)
+
+    profile = user.userprofile
+    profile_changed = False
+
+    if nick_name == user_name:
+        # Update user info, only saving the fields which have changed
+        is_staff = settings.ADMIN_ROLE.lower() in roles
+        if user.email != email or user.is_staff != is_staff:
+            user.email = email
+            user.is_staff = is_staff
+            user.save()
+
+        if profile.complete_name != display_name or profile.actor_id != nick_name:
+            profile.complete_name = display_name
+            profile.actor_id = nick_name
+            profile_changed = True
+
+    # Get or create current organization
+    private = nick_name == user_name
+    try:
+        org = Organization.objects.get(name=nick_name)
+    except:
+        org = Organization.objects.create(name=nick_name, private=private)
+
+    if org.private != private:
+        org.private = private
+        org.save()
+
+    if profile.access_token != token or profile.current_roles != user_roles or \
+            profile.current_organization_id != org.pk:
+        profile_changed = True
+
+    profile.access_token = token
+    profile.current_roles = user_roles
+    profile.current_organization = org
+
+    if profile_changed:
+        profile.save()
+
+    return user, org
+
+
 def get_api_user(request):
     from django.contrib.auth.models import AnonymousUser
     from django.conf import settings
-    from wstore.models import Organization, User
+    from wstore.models import User
 
     # Get User information from the request
     try:
@@ -144,22 +247,8 @@ def get_api_user(request):
     if len(token_info) != 2 and token_info[0].lower() != 'bearer':
         return AnonymousUser()
 
-    # Check if the user already exist
-    try:
-        user = User.objects.get(username=user_name)
-    except:
-        user = User.objects.create(username=user_name)
+    token = token_info[1]
 
-    if nick_name == user_name:
-        # Update user info
-        user.email = email
-        user.userprofile.complete_name = display_name
-        user.userprofile.actor_id = nick_name
-        user.is_staff = settings.ADMIN_ROLE.lower() in roles
-        user.save()
-
-    user.userprofile.access_token = token_info[1]
-    
     user_roles = []
 
     if settings.PROVIDER_ROLE in roles:
@@ -168,20 +257,32 @@ def get_api_user(request):
     if settings.CUSTOMER_ROLE in roles:
         user_roles.append('customer')
 
-    # Get or create current organization
-    try:
-        org = Organization.objects.get(name=nick_name)
-    except:
-        org = Organization.objects.create(name=nick_name)
-
-    org.private = nick_name == user_name
-    org.save()
-
-    user.userprofile.current_roles = user_roles
-    user.userprofile.current_organization = org
-
-    # change user.userprofile.current_organization
-    user.userprofile.save()
+    key = (user_name, nick_name, display_name, email, tuple(roles), token)
+    identity = _identity_cache.get(key)
+
+    if identity is not None:
+        # The headers have not changed since they were stored, so the user is only read
+        user_pk, org_pk = identity
+        try:
+            user = User.objects.get(pk=user_pk)
+        except:
+            user = None
+
+        if user is not None:
+            # Another request of the user may have selected a different organization, in that
+            # case the one of the headers is stored again as it is read by background tasks
+            profile = user.userprofile
+            if profile.access_token != token or profile.current_roles != user_roles or \
+                    profile.current_organization_id != org_pk:
+                profile.access_token = token
+                profile.current_roles = user_roles
+                profile.current_organization_id = org_pk
+                profile.save()
+
+            return user
+
+    user, org = _sync_api_user(user_name, nick_name, display_name, email, roles, user_roles, token)
+    _identity_cache.set(key, (user.pk, org.pk))
 
     return user
 
@@ -192,6 +293,23 @@ class AuthenticationMiddleware(object):
         request.user = SimpleLazyObject(lambda: get_api_user(request))
 
 
+class BundleResolverMiddleware(object):
+    """
+    Shares the offerings and assets resolved from bundles among all the
+    operations made while processing a request
+    """
+
+    def process_request(self, request):
+        from wstore.asset_manager.bundle_resolver import start_request_scope
+        start_request_scope()
+
+    def process_response(self, request, response):
+        from wstore.asset_manager.bundle_resolver import end_request_scope
+        end_request_scope()
+
+        return response
+
+
 class ConditionalGetMiddleware(object):
     """
     Handles conditional GET operations. If the response has a ETag or
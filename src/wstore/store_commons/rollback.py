@@ -24,6 +24,8 @@ import os
 
 from django.conf import settings
 
+from wstore.asset_manager.blob_store import release_asset_file
+
 
 def downgrade_asset(asset):
     prev_version = asset.old_versions.pop()
@@ -34,8 +36,10 @@ def downgrade_asset(asset):
 
         if os.path.exists(file_path):
             os.remove(file_path)
+            release_asset_file(file_path)
 
     asset.resource_path = prev_version.resource_path
+    asset.content_hash = prev_version.content_hash
     asset.version = prev_version.version
     asset.download_link = prev_version.download_link
     asset.meta_info = prev_version.meta_info
@@ -59,6 +63,7 @@ def rollback(post_action=None):
     def wrap(method):
         def _remove_file(file_):
             os.remove(file_)
+            release_asset_file(file_)
 
         def _remove_model(model):
             model.delete()
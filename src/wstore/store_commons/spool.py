@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from bson import ObjectId
+from datetime import datetime, timedelta
+from pymongo import ASCENDING
+
+from django.conf import settings
+
+PENDING = 'pending'
+FAILED = 'failed'
+
+
+class Spool(object):
+    """
+    Collection of documents delivered in background by a dispatcher. Documents are claimed
+    in batches, so concurrent dispatchers do not deliver them twice, and failed deliveries
+    are retried using an exponential backoff
+    :param collection: Name of the collection storing the documents
+    :param setting_prefix: Prefix of the CLAIM_TIMEOUT, MAX_ATTEMPTS, RETRY_DELAY and RETRY_MAX_DELAY settings
+    """
+
+    def __init__(self, collection, setting_prefix):
+        self._collection = collection
+        self._setting_prefix = setting_prefix
+
+    def _get_setting(self, name):
+        return getattr(settings, self._setting_prefix + '_' + name)
+
+    def _get_collection(self, db):
+        return getattr(db, self._collection)
+
+    def _get_retry_date(self, attempts):
+        delay = min(self._get_setting('RETRY_DELAY') * 2 ** (attempts - 1), self._get_setting('RETRY_MAX_DELAY'))
+        return datetime.utcnow() + timedelta(seconds=delay)
+
+    def build_entry(self, fields):
+        """
+        Builds the document of a new entry of the spool, ready to be delivered
+        :param fields: Fields with the information to be delivered
+        """
+        entry = {
+            'state': PENDING,
+            'attempts': 0,
+            'next_attempt': datetime.utcnow(),
+            'claim': None,
+            'claimed_at': None
+        }
+        entry.update(fields)
+        return entry
+
+    def claim_batch(self, db, now, limit):
+        """
+        Claims the entries ready to be delivered
+        :param limit: Max number of entries to be claimed
+        :return: List with the entries claimed by the caller
+        """
+        collection = self._get_collection(db)
+        claim = ObjectId()
+        lease_limit = now - timedelta(seconds=self._get_setting('CLAIM_TIMEOUT'))
+
+        # Entries claimed by a dispatcher which has not released them in time are considered free
+        ready = collection.find({
+            'state': PENDING,
+            'next_attempt': {'$lte': now},
+            '$or': [{'claim': None}, {'claimed_at': {'$lt': lease_limit}}]
+        }, {'_id': True}).sort('next_attempt', ASCENDING).limit(limit)
+
+        ids = [doc['_id'] for doc in ready]
+        if not len(ids):
+            return []
+
+        collection.update_many({
+            '_id': {'$in': ids},
+            '$or': [{'claim': None}, {'claimed_at': {'$lt': lease_limit}}]
+        }, {
+            '$set': {'claim': claim, 'claimed_at': now}
+        })
+
+        # Only the entries actually claimed by the caller are processed
+        return list(collection.find({'claim': claim}).sort('_id', ASCENDING))
+
+    def schedule_retry(self, db, doc, **fields):
+        """
+        Releases an entry whose delivery has failed, scheduling a new attempt
+        if it has not reached the max number of attempts
+        :param fields: Additional fields to be updated in the entry
+        """
+        attempts = doc['attempts'] + 1
+        update = {
+            'state': FAILED if attempts >= self._get_setting('MAX_ATTEMPTS') else PENDING,
+            'attempts': attempts,
+            'next_attempt': self._get_retry_date(attempts),
+            'claim': None,
+            'claimed_at': None
+        }
+        update.update(fields)
+
+        self._get_collection(db).update_one({'_id': doc['_id']}, {'$set': update})
+
+    def get_next_attempt(self, db):
+        """
+        :return: The date of the next scheduled attempt or None if there is not any
+        """
+        next_doc = self._get_collection(db).find_one(
+            {'state': PENDING, 'claim': None},
+            {'next_attempt': True},
+            sort=[('next_attempt', ASCENDING)]
+        )
+
+        return next_doc['next_attempt'] if next_doc is not None else None
+
+    def retry_failed(self, db):
+        """
+        Schedules again the entries which have reached the max number of attempts
+        :return: Number of entries scheduled
+        """
+        result = self._get_collection(db).update_many({'state': FAILED}, {
+            '$set': {
+                'state': PENDING,
+                'attempts': 0,
+                'next_attempt': datetime.utcnow()
+            }
+        })
+        return result.modified_count
+
+    def ensure_index(self, db):
+        collection = self._get_collection(db)
+        collection.create_index([('state', ASCENDING), ('next_attempt', ASCENDING)])
+        collection.create_index('claim')
@@ -20,21 +20,27 @@
 
 from __future__ import unicode_literals
 
+import os
+import tempfile
 from bson import ObjectId
+from datetime import datetime, timedelta
 from mock import MagicMock, call
 from nose_parameterized import parameterized
 
 from django.contrib.auth.models import AnonymousUser
+from django.test.client import RequestFactory
 from django.test.utils import override_settings
 from django.test import TestCase
+from django.utils.http import http_date
 
-from wstore.store_commons import middleware, rollback, database
+from wstore.store_commons import middleware, rollback, database, http_client, download_cache, spool, worker
+from wstore.store_commons.utils import streaming
 from wstore.store_commons.utils.url import is_valid_url
 
 __test__ = False
 
 
-@override_settings(ADMIN_ROLE='provider', PROVIDER_ROLE='seller', CUSTOMER_ROLE='customer')
+@override_settings(ADMIN_ROLE='provider', PROVIDER_ROLE='seller', CUSTOMER_ROLE='customer', API_USER_CACHE_TTL=30, API_USER_CACHE_SIZE=2)
 class AuthenticationMiddlewareTestCase(TestCase):
 
     tags = ('middleware', )
@@ -64,9 +70,12 @@ class AuthenticationMiddlewareTestCase(TestCase):
 
         wstore.models.Organization = self._org_model
 
+        middleware._identity_cache.clear()
+
     def tearDown(self):
         import wstore.models
         reload(wstore.models)
+        reload(middleware)
 
     def _new_user(self):
         self._user_model.objects.get.side_effect = Exception('Not found')
@@ -146,7 +155,7 @@ class AuthenticationMiddlewareTestCase(TestCase):
         user = middleware.get_api_user(self.request)
 
         self.assertEquals(self._user_inst, user)
-        self._org_model.objects.create.assert_called_once_with(name='000000000000023')
+        self._org_model.objects.create.assert_called_once_with(name='000000000000023', private=False)
 
         self.assertEquals(['customer'], self._user_inst.userprofile.current_roles)
         self.assertEquals(self._org_instance, self._user_inst.userprofile.current_organization)
@@ -155,12 +164,142 @@ class AuthenticationMiddlewareTestCase(TestCase):
         self._org_instance.save.assert_called_once_with()
         self._user_inst.userprofile.save.assert_called_once_with()
 
+    def _set_headers(self):
+        self.request.META['HTTP_X_ROLES'] = 'customer'
+        self.request.META['HTTP_AUTHORIZATION'] = 'Bearer 1234567890abcdf'
+        self.request.META['HTTP_X_EMAIL'] = 'user@email.com'
+
+    def _set_stored_identity(self):
+        self._user_inst.email = 'user@email.com'
+        self._user_inst.is_staff = False
+        self._user_inst.userprofile.complete_name = 'Test user'
+        self._user_inst.userprofile.actor_id = 'test-user'
+        self._user_inst.userprofile.access_token = '1234567890abcdf'
+        self._user_inst.userprofile.current_roles = ['customer']
+        self._user_inst.userprofile.current_organization_id = 'org'
+        self._org_instance.private = True
+
+    def test_get_api_user_unchanged(self):
+        self._set_headers()
+        self._set_stored_identity()
+
+        user = middleware.get_api_user(self.request)
+
+        self.assertEquals(self._user_inst, user)
+
+        # Nothing is written when the stored identity matches the headers
+        self.assertEquals(0, self._user_inst.save.call_count)
+        self.assertEquals(0, self._user_inst.userprofile.save.call_count)
+        self.assertEquals(0, self._org_instance.save.call_count)
+
+    def test_get_api_user_token_changed(self):
+        self._set_headers()
+        self._set_stored_identity()
+        self._user_inst.userprofile.access_token = 'old_token'
+
+        middleware.get_api_user(self.request)
+
+        self.assertEquals('1234567890abcdf', self._user_inst.userprofile.access_token)
+        self._user_inst.userprofile.save.assert_called_once_with()
+        self.assertEquals(0, self._user_inst.save.call_count)
+        self.assertEquals(0, self._org_instance.save.call_count)
+
+    def test_get_api_user_cached(self):
+        self._set_headers()
+        self._set_stored_identity()
+        self._user_inst.pk = 'user'
+
+        middleware.get_api_user(self.request)
+
+        self._user_inst.reset_mock()
+        self._org_instance.reset_mock()
+        self._user_model.objects.get.reset_mock()
+        self._org_model.objects.get.reset_mock()
+
+        user = middleware.get_api_user(self.request)
+
+        # The cached identity is only read
+        self.assertEquals(self._user_inst, user)
+        self._user_model.objects.get.assert_called_once_with(pk='user')
+        self.assertEquals(0, self._org_model.objects.get.call_count)
+
+        self.assertEquals(0, self._user_inst.save.call_count)
+        self.assertEquals(0, self._user_inst.userprofile.save.call_count)
+        self.assertEquals(0, self._org_instance.save.call_count)
+
+        self.assertEquals('1234567890abcdf', user.userprofile.access_token)
+        self.assertEquals(['customer'], user.userprofile.current_roles)
+        self.assertEquals('org', user.userprofile.current_organization_id)
+
+        self.assertEquals(1, middleware._identity_cache.hits)
+
+    def test_get_api_user_cached_org_switched(self):
+        self._set_headers()
+        self._set_stored_identity()
+        self._user_inst.pk = 'user'
+
+        org_y = MagicMock()
+        org_y.pk = 'org_y'
+        org_y.private = False
+        self._org_model.objects.get.side_effect = lambda name: org_y if name == 'org-y' else self._org_instance
+
+        # The user selects the organization Y and then goes back to X while X is still cached
+        middleware.get_api_user(self.request)
+
+        self.request.META['HTTP_X_NICK_NAME'] = 'org-y'
+        middleware.get_api_user(self.request)
+        self.assertEquals(org_y, self._user_inst.userprofile.current_organization)
+        self._user_inst.userprofile.current_organization_id = 'org_y'
+
+        self._user_inst.userprofile.save.reset_mock()
+        self._org_model.objects.get.reset_mock()
+
+        self.request.META['HTTP_X_NICK_NAME'] = 'test-user'
+        user = middleware.get_api_user(self.request)
+
+        # The organization of the cached identity is stored again
+        self.assertEquals(1, middleware._identity_cache.hits)
+        self.assertEquals(0, self._org_model.objects.get.call_count)
+        self.assertEquals('org', user.userprofile.current_organization_id)
+        user.userprofile.save.assert_called_once_with()
+
+    def _expire_cache(self):
+        middleware.time = MagicMock()
+        middleware.time.time.return_value = 10000000000
+
+    def _change_headers(self):
+        self.request.META['HTTP_X_ROLES'] = 'customer,seller'
+
+    @parameterized.expand([
+        ('expired', _expire_cache),
+        ('headers_changed', _change_headers)
+    ])
+    def test_get_api_user_cache_miss(self, name, side_effect):
+        self._set_headers()
+
+        middleware.get_api_user(self.request)
+
+        side_effect(self)
+        self._user_model.objects.get.reset_mock()
+
+        middleware.get_api_user(self.request)
+
+        # The identity is synchronized again
+        self._user_model.objects.get.assert_called_once_with(username='test-user')
+        self.assertEquals(2, self._org_model.objects.get.call_count)
+
 
 @override_settings(BASEDIR='/base/dir')
 class RollbackTestCase(TestCase):
 
     tags = ('rollback', )
 
+    def setUp(self):
+        rollback.release_asset_file = MagicMock()
+
+    def tearDown(self):
+        reload(rollback)
+
     def test_rollback_correct(self):
         called_method = MagicMock()
         called_method.return_value = 'Returned'
@@ -210,6 +349,7 @@ class RollbackTestCase(TestCase):
 
         self.assertTrue(error)
         rollback.os.remove.assert_called_once_with('/home/test/testfile.pdf')
+        rollback.release_asset_file.assert_called_once_with('/home/test/testfile.pdf')
         model.delete.assert_called_once_with()
 
         if has_post:
@@ -227,10 +367,12 @@ class RollbackTestCase(TestCase):
     def _exists_called(self):
         rollback.os.path.exists.assert_called_once_with('/base/dir/new/path')
         self.assertEquals(0, rollback.os.remove.call_count)
+        self.assertEquals(0, rollback.release_asset_file.call_count)
 
     def _remove_called(self):
         rollback.os.path.exists.assert_called_once_with('/base/dir/new/path')
         rollback.os.remove.assert_called_once_with('/base/dir/new/path')
+        rollback.release_asset_file.assert_called_once_with('/base/dir/new/path')
 
     @parameterized.expand([
         ('no_path', '', _exists_not_called),
@@ -249,8 +391,10 @@ class RollbackTestCase(TestCase):
             content_type='new_type',
             version='2.0',
             state='upgrading',
+            content_hash='new_hash',
             old_versions=[MagicMock(
                 resource_path='old/path',
+                content_hash='old_hash',
                 download_link='http://host/old/path',
                 content_type='old_type',
                 version='1.0'
@@ -263,6 +407,7 @@ class RollbackTestCase(TestCase):
         rollback.downgrade_asset_pa(downgrade_object)
 
         self.assertEquals('old/path', asset.resource_path)
+        self.assertEquals('old_hash', asset.content_hash)
         self.assertEquals('http://host/old/path', asset.download_link)
         self.assertEquals('old_type', asset.content_type)
         self.assertEquals('1.0', asset.version)
@@ -285,6 +430,259 @@ class RollbackTestCase(TestCase):
         rollback.downgrade_asset_pa(manager())
 
 
+class DatabaseConnectionTestCase(TestCase):
+    tags = ('database',)
+
+    def setUp(self):
+        reload(database)
+        database.MongoClient = MagicMock()
+        database.os = MagicMock()
+        database.os.getpid.return_value = 1
+
+    def tearDown(self):
+        reload(database)
+
+    @parameterized.expand([
+        ('host_port', 'db_host', '27018', call('db_host', 27018, connect=False, maxPoolSize=10)),
+        ('host', 'db_host', '', call('db_host', connect=False, maxPoolSize=10)),
+        ('port', '', '27018', call('localhost', 27018, connect=False, maxPoolSize=10)),
+        ('default', '', '', call(connect=False, maxPoolSize=10))
+    ])
+    def test_shared_client(self, name, host, port, exp_call):
+        db_info = {
+            'NAME': 'wstore_db',
+            'HOST': host,
+            'PORT': port,
+            'USER': 'user',
+            'PASSWORD': 'passwd'
+        }
+        with override_settings(DATABASES={'default': db_info}, DATABASE_CLIENT_OPTIONS={'maxPoolSize': 10}):
+            db = database.get_database_connection()
+            database.get_database_connection()
+
+        client = database.MongoClient()
+        self.assertEquals(client['wstore_db'], db)
+        self.assertEquals([exp_call], database.MongoClient.call_args_list[:1])
+        client['wstore_db'].authenticate.assert_called_once_with('user', 'passwd', mechanism='MONGODB-CR')
+
+        self.assertEquals({
+            'checkouts': 2,
+            'clients_created': 1
+        }, database.get_connection_stats())
+
+    def test_client_per_process(self):
+        db_info = {
+            'NAME': 'wstore_db',
+            'HOST': '',
+            'PORT': '',
+            'USER': '',
+            'PASSWORD': ''
+        }
+        with override_settings(DATABASES={'default': db_info}):
+            database.get_database_connection()
+
+            # Simulate a fork
+            database.os.getpid.return_value = 2
+            database.get_database_connection()
+
+        self.assertEquals(2, database.MongoClient.call_count)
+        database.MongoClient()['wstore_db'].authenticate.assert_not_called()
+
+
+class HTTPClientTestCase(TestCase):
+    tags = ('http-client',)
+
+    def setUp(self):
+        reload(http_client)
+        http_client.Session = MagicMock()
+        http_client.time = MagicMock()
+        http_client.time.time.return_value = 0
+
+        self._session = http_client.Session.return_value
+        self._session.request.return_value.status_code = 200
+
+    def tearDown(self):
+        reload(http_client)
+
+    @override_settings(HTTP_CONNECT_TIMEOUT=3, HTTP_READ_TIMEOUT=10)
+    def test_pooled_session_per_host(self):
+        http_client.get('http://inventory.com/api/product/1')
+        http_client.patch('http://inventory.com/api/product/2', json={'status': 'Active'})
+        http_client.post('http://billing.com/api/charge', json={}, timeout=1)
+
+        self.assertEquals(2, http_client.Session.call_count)
+        self.assertEquals([
+            call('GET', 'http://inventory.com/api/product/1', timeout=(3, 10)),
+            call('PATCH', 'http://inventory.com/api/product/2', data=None, json={'status': 'Active'}, timeout=(3, 10)),
+            call('POST', 'http://billing.com/api/charge', data=None, json={}, timeout=1)
+        ], self._session.request.call_args_list)
+
+    def test_latency_histogram(self):
+        http_client.time.time.side_effect = [0, 0.02, 0, 3]
+
+        http_client.get('http://inventory.com/api/product/1')
+        http_client.get('http://inventory.com/api/product/2')
+
+        stats = http_client.get_latency_stats()
+        self.assertEquals(['GET inventory.com/api/product/:id'], stats.keys())
+        self.assertEquals(2, stats['GET inventory.com/api/product/:id']['count'])
+        self.assertEquals(1, stats['GET inventory.com/api/product/:id']['buckets']['25'])
+        self.assertEquals(1, stats['GET inventory.com/api/product/:id']['buckets']['5000'])
+
+    @override_settings(HTTP_CIRCUIT_THRESHOLD=2, HTTP_CIRCUIT_RESET=30)
+    def test_circuit_breaker(self):
+        self._session.request.side_effect = http_client.requests.exceptions.ConnectionError()
+
+        for i in range(2):
+            with self.assertRaises(http_client.requests.exceptions.ConnectionError):
+                http_client.get('http://rss.com/reports')
+
+        self.assertEquals({'http://rss.com': True}, http_client.get_circuit_states())
+
+        # Requests are rejected without reaching the host while the circuit is open
+        with self.assertRaises(http_client.CircuitOpenError):
+            http_client.get('http://rss.com/reports')
+
+        self.assertEquals(2, self._session.request.call_count)
+
+        # After the reset timeout a request is tried, closing the circuit if it succeeds
+        http_client.time.time.return_value = 31
+        self._session.request.side_effect = None
+
+        http_client.get('http://rss.com/reports')
+        self.assertEquals({'http://rss.com': False}, http_client.get_circuit_states())
+
+
+class DownloadCacheTestCase(TestCase):
+    tags = ('download-cache',)
+
+    def setUp(self):
+        reload(download_cache)
+        download_cache.get_database_connection = MagicMock()
+        self._db = download_cache.get_database_connection.return_value
+        self._db.wstore_download_cache.find_one.return_value = {'value': 1}
+
+        download_cache.time = MagicMock()
+        download_cache.time.time.return_value = 0
+
+        self._cache = download_cache.DownloadCache('CATALOG_CACHE_TTL', 'CATALOG_CACHE_SIZE')
+
+    def tearDown(self):
+        reload(download_cache)
+
+    def _response(self, status, document=None, etag=None):
+        response = MagicMock(status_code=status, headers={})
+        response.json.return_value = document
+
+        if etag is not None:
+            response.headers['ETag'] = etag
+
+        return response
+
+    @override_settings(CATALOG_CACHE_TTL=60, CATALOG_CACHE_SIZE=10, DOWNLOAD_CACHE_GENERATION_TTL=5)
+    def test_fresh_document(self):
+        download = MagicMock(return_value=self._response(200, {'id': '1'}))
+
+        self.assertEquals({'id': '1'}, self._cache.get(('http://catalog.com/offering/1', None), download))
+        self.assertEquals({'id': '1'}, self._cache.get(('http://catalog.com/offering/1', None), download))
+
+        download.assert_called_once_with({})
+        self.assertEquals(1, self._cache.hits)
+        self.assertEquals(1, self._cache.misses)
+
+    @override_settings(CATALOG_CACHE_TTL=60, CATALOG_CACHE_SIZE=10, DOWNLOAD_CACHE_GENERATION_TTL=5)
+    def test_etag_revalidation(self):
+        download = MagicMock(side_effect=[
+            self._response(200, {'id': '1'}, etag='"v1"'),
+            self._response(304)
+        ])
+
+        self._cache.get(('http://catalog.com/offering/1', None), download)
+
+        download_cache.time.time.return_value = 61
+        document = self._cache.get(('http://catalog.com/offering/1', None), download)
+
+        self.assertEquals({'id': '1'}, document)
+        self.assertEquals([call({}), call({'If-None-Match': '"v1"'})], download.call_args_list)
+        self.assertEquals(1, self._cache.revalidations)
+
+    @override_settings(CATALOG_CACHE_TTL=60, CATALOG_CACHE_SIZE=1, DOWNLOAD_CACHE_GENERATION_TTL=5)
+    def test_lru_eviction(self):
+        download = MagicMock(side_effect=[
+            self._response(200, {'id': '1'}),
+            self._response(200, {'id': '2'}),
+            self._response(200, {'id': '1'})
+        ])
+
+        self._cache.get(('http://catalog.com/offering/1', None), download)
+        self._cache.get(('http://catalog.com/offering/2', None), download)
+        self._cache.get(('http://catalog.com/offering/1', None), download)
+
+        self.assertEquals(3, download.call_count)
+
+    @override_settings(CATALOG_CACHE_TTL=60, CATALOG_CACHE_SIZE=10, DOWNLOAD_CACHE_GENERATION_TTL=5)
+    def test_error_not_cached(self):
+        download = MagicMock(side_effect=[self._response(404), self._response(200, {'id': '1'})])
+
+        self.assertEquals(None, self._cache.get(('http://catalog.com/offering/1', None), download))
+        self.assertEquals({'id': '1'}, self._cache.get(('http://catalog.com/offering/1', None), download))
+
+    @override_settings(CATALOG_CACHE_TTL=60, CATALOG_CACHE_SIZE=10, DOWNLOAD_CACHE_GENERATION_TTL=5)
+    def test_generation_ttl(self):
+        download = MagicMock(return_value=self._response(200, {'id': '1'}))
+
+        self._cache.get(('http://catalog.com/offering/1', None), download)
+        self._cache.get(('http://catalog.com/offering/2', None), download)
+        self.assertEquals(1, self._db.wstore_download_cache.find_one.call_count)
+
+        download_cache.time.time.return_value = 5
+        self._cache.get(('http://catalog.com/offering/1', None), download)
+        self.assertEquals(2, self._db.wstore_download_cache.find_one.call_count)
+
+    @override_settings(CATALOG_CACHE_TTL=60, CATALOG_CACHE_SIZE=10, DOWNLOAD_CACHE_GENERATION_TTL=5)
+    def test_invalidation(self):
+        download = MagicMock(return_value=self._response(200, {'id': '1'}))
+        self._cache.get(('http://catalog.com/offering/1', None), download)
+
+        # Invalidation made by other process, it is seen when the generation stamp expires
+        self._db.wstore_download_cache.find_one.return_value = {'value': 2, 'hold_until': 0}
+        self._cache.get(('http://catalog.com/offering/1', None), download)
+        self.assertEquals(1, download.call_count)
+
+        download_cache.time.time.return_value = 5
+        self._cache.get(('http://catalog.com/offering/1', None), download)
+        self.assertEquals(2, download.call_count)
+
+    @override_settings(CATALOG_CACHE_TTL=60, CATALOG_CACHE_SIZE=10, DOWNLOAD_CACHE_GENERATION_TTL=5,
+                       DOWNLOAD_CACHE_INVALIDATION_HOLD=30)
+    def test_invalidation_hold(self):
+        download = MagicMock(return_value=self._response(200, {'id': '1'}))
+        self._cache.get(('http://catalog.com/offering/1', None), download)
+
+        # Invalidation made by this process
+        stamp = {'value': 2, 'hold_until': 30}
+        self._db.wstore_download_cache.find_one_and_update.return_value = stamp
+        self._db.wstore_download_cache.find_one.return_value = stamp
+        download_cache.invalidate_downloads()
+
+        self._db.wstore_download_cache.find_one_and_update.assert_called_once_with(
+            {'_id': 'generation'},
+            {'$inc': {'value': 1}, '$set': {'hold_until': 30}},
+            upsert=True,
+            return_document=download_cache.ReturnDocument.AFTER
+        )
+
+        # Documents are not cached until the catalog change has been committed
+        self._cache.get(('http://catalog.com/offering/1', None), download)
+        self._cache.get(('http://catalog.com/offering/1', None), download)
+        self.assertEquals(3, download.call_count)
+
+        download_cache.time.time.return_value = 30
+        self._cache.get(('http://catalog.com/offering/1', None), download)
+        self._cache.get(('http://catalog.com/offering/1', None), download)
+        self.assertEquals(4, download.call_count)
+
+
 class DocumentLockTestCase(TestCase):
     tags = ('lock',)
 
@@ -316,6 +714,104 @@ class DocumentLockTestCase(TestCase):
         self._connection[self._collection].find_one_and_update.assert_called_once_with({'_id': ObjectId(self._id)}, {'$set': {self._lock_id: False}})
 
 
+@override_settings(MEDIA_CHUNK_SIZE=4)
+class StreamFileTestCase(TestCase):
+
+    tags = ('media', )
+
+    _content = b'0123456789abcdefghij'
+
+    def setUp(self):
+        fd, self._path = tempfile.mkstemp(suffix='.txt')
+        os.write(fd, self._content)
+        os.close(fd)
+
+        os.utime(self._path, (1500000000, 1500000000))
+        self._etag = streaming.get_file_etag(os.stat(self._path))
+
+    def tearDown(self):
+        os.remove(self._path)
+
+    def _stream(self, **headers):
+        request = RequestFactory().get('/charging/media/assets/test_user/file.txt', **headers)
+        return streaming.stream_file(request, self._path)
+
+    def test_stream_file(self):
+        response = self._stream()
+
+        self.assertEquals(200, response.status_code)
+        self.assertTrue(response.streaming)
+
+        # The file is read in chunks of the configured size
+        chunks = list(response.streaming_content)
+        self.assertEquals([b'0123', b'4567', b'89ab', b'cdef', b'ghij'], chunks)
+
+        self.assertEquals('text/plain', response['Content-Type'])
+        self.assertEquals('20', response['Content-Length'])
+        self.assertEquals('bytes', response['Accept-Ranges'])
+        self.assertEquals('"59682f00-14"', response['ETag'])
+        self.assertEquals(http_date(1500000000), response['Last-Modified'])
+
+    @parameterized.expand([
+        ('range', 'bytes=2-9', b'23456789', 'bytes 2-9/20'),
+        ('open_range', 'bytes=15-', b'fghij', 'bytes 15-19/20'),
+        ('suffix_range', 'bytes=-3', b'hij', 'bytes 17-19/20'),
+        ('end_out_of_file', 'bytes=18-100', b'ij', 'bytes 18-19/20')
+    ])
+    def test_stream_range(self, name, byte_range, content, content_range):
+        response = self._stream(HTTP_RANGE=byte_range)
+
+        self.assertEquals(206, response.status_code)
+        self.assertEquals(content, b''.join(response.streaming_content))
+        self.assertEquals(content_range, response['Content-Range'])
+        self.assertEquals(unicode(len(content)), response['Content-Length'])
+
+    @parameterized.expand([
+        ('multiple_ranges', {'HTTP_RANGE': 'bytes=0-1,4-5'}),
+        ('invalid_unit', {'HTTP_RANGE': 'items=0-1'}),
+        ('changed_file', {'HTTP_RANGE': 'bytes=0-1', 'HTTP_IF_RANGE': '"other"'})
+    ])
+    def test_stream_range_ignored(self, name, headers):
+        response = self._stream(**headers)
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(self._content, b''.join(response.streaming_content))
+
+    def test_stream_range_if_range(self):
+        response = self._stream(HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE=self._etag)
+
+        self.assertEquals(206, response.status_code)
+        self.assertEquals(b'01', b''.join(response.streaming_content))
+
+    def test_stream_range_not_satisfiable(self):
+        response = self._stream(HTTP_RANGE='bytes=20-')
+
+        self.assertEquals(416, response.status_code)
+        self.assertEquals('bytes */20', response['Content-Range'])
+
+    @parameterized.expand([
+        ('etag', {'HTTP_IF_NONE_MATCH': '"59682f00-14"'}, 304),
+        ('etag_list', {'HTTP_IF_NONE_MATCH': '"other", "59682f00-14"'}, 304),
+        ('etag_changed', {'HTTP_IF_NONE_MATCH': '"other"', 'HTTP_IF_MODIFIED_SINCE': http_date(1500000000)}, 200),
+        ('not_modified', {'HTTP_IF_MODIFIED_SINCE': http_date(1500000000)}, 304),
+        ('modified', {'HTTP_IF_MODIFIED_SINCE': http_date(1400000000)}, 200)
+    ])
+    def test_stream_conditional(self, name, headers, status):
+        response = self._stream(**headers)
+        self.assertEquals(status, response.status_code)
+
+    def test_stream_file_closed(self):
+        response = self._stream()
+
+        content = iter(response.streaming_content)
+        next(content)
+
+        # The file is closed when the response is closed, even if it has not been completely sent
+        response.close()
+        with self.assertRaises(StopIteration):
+            next(content)
+
+
 class URLUtilsTestCase(TestCase):
 
     tags = ('utils', 'url-utils')
@@ -361,3 +857,125 @@ class URLUtilsTestCase(TestCase):
 
     def test_valid_absolute_url_https_ckan(self):
         self.assertTrue(is_valid_url("https://data.opplafy.eu/dataset/4d3d9728-39bb-4749-8c8f-d9cea51abe4b"))
+
+
+@override_settings(TEST_WORKERS=2)
+class ThreadPoolTestCase(TestCase):
+
+    tags = ('worker', )
+
+    def setUp(self):
+        worker.ThreadPool = MagicMock()
+        worker.os = MagicMock()
+        worker.os.getpid.return_value = 1
+
+    def tearDown(self):
+        reload(worker)
+
+    def test_get_thread_pool(self):
+        pool = worker.get_thread_pool('test', 'TEST_WORKERS')
+
+        # The pool is created once and shared by the callers of the process
+        self.assertEquals(pool, worker.get_thread_pool('test', 'TEST_WORKERS'))
+        worker.ThreadPool.assert_called_once_with(2)
+
+        worker.get_thread_pool('other', 'TEST_WORKERS')
+        self.assertEquals(2, worker.ThreadPool.call_count)
+
+    def test_get_thread_pool_forked(self):
+        worker.ThreadPool.side_effect = ['pool1', 'pool2']
+        self.assertEquals('pool1', worker.get_thread_pool('test', 'TEST_WORKERS'))
+
+        # Forked processes do not inherit the pool threads
+        worker.os.getpid.return_value = 2
+        self.assertEquals('pool2', worker.get_thread_pool('test', 'TEST_WORKERS'))
+
+
+@override_settings(TEST_CLAIM_TIMEOUT=300, TEST_MAX_ATTEMPTS=3, TEST_RETRY_DELAY=30, TEST_RETRY_MAX_DELAY=3600)
+class SpoolTestCase(TestCase):
+
+    tags = ('spool', )
+
+    def setUp(self):
+        self._db = MagicMock()
+        self._spool = spool.Spool('wstore_test_spool', 'TEST')
+
+        self._now = datetime(2016, 1, 20, 13, 12, 39)
+        spool.datetime = MagicMock()
+        spool.datetime.utcnow.return_value = self._now
+
+    def tearDown(self):
+        reload(spool)
+
+    def test_build_entry(self):
+        self.assertEquals({
+            'message': 'message',
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt': self._now,
+            'claim': None,
+            'claimed_at': None
+        }, self._spool.build_entry({'message': 'message'}))
+
+    def test_claim_batch(self):
+        ready = MagicMock()
+        ready.sort.return_value.limit.return_value = [{'_id': 0}, {'_id': 1}]
+        claimed = MagicMock()
+        claimed.sort.return_value = [{'_id': 0}]
+        self._db.wstore_test_spool.find.side_effect = [ready, claimed]
+
+        docs = self._spool.claim_batch(self._db, self._now, 2)
+
+        self.assertEquals([{'_id': 0}], docs)
+        ready.sort.return_value.limit.assert_called_once_with(2)
+
+        lease_filter = [{'claim': None}, {'claimed_at': {'$lt': self._now - timedelta(seconds=300)}}]
+        claim = self._db.wstore_test_spool.update_many.call_args[0][1]['$set']['claim']
+        self._db.wstore_test_spool.update_many.assert_called_once_with({
+            '_id': {'$in': [0, 1]},
+            '$or': lease_filter
+        }, {
+            '$set': {'claim': claim, 'claimed_at': self._now}
+        })
+
+        self.assertEquals([
+            call({'state': 'pending', 'next_attempt': {'$lte': self._now}, '$or': lease_filter}, {'_id': True}),
+            call({'claim': claim})
+        ], self._db.wstore_test_spool.find.call_args_list)
+
+    def test_claim_empty_batch(self):
+        self._db.wstore_test_spool.find.return_value.sort.return_value.limit.return_value = []
+
+        self.assertEquals([], self._spool.claim_batch(self._db, self._now, 2))
+        self._db.wstore_test_spool.update_many.assert_not_called()
+
+    @parameterized.expand([
+        ('retry', 0, 'pending', 30),
+        ('backoff', 1, 'pending', 60),
+        ('max_attempts', 2, 'failed', 120)
+    ])
+    def test_schedule_retry(self, name, attempts, state, delay):
+        self._spool.schedule_retry(self._db, {'_id': 0, 'attempts': attempts}, error='error')
+
+        self._db.wstore_test_spool.update_one.assert_called_once_with({'_id': 0}, {
+            '$set': {
+                'state': state,
+                'attempts': attempts + 1,
+                'next_attempt': self._now + timedelta(seconds=delay),
+                'claim': None,
+                'claimed_at': None,
+                'error': 'error'
+            }
+        })
+
+    def test_retry_failed(self):
+        self._db.wstore_test_spool.update_many.return_value.modified_count = 2
+
+        self.assertEquals(2, self._spool.retry_failed(self._db))
+        self._db.wstore_test_spool.update_many.assert_called_once_with({'state': 'failed'}, {
+            '$set': {
+                'state': 'pending',
+                'attempts': 0,
+                'next_attempt': self._now
+            }
+        })
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def get_file_etag(file_stat):
+    """
+    Builds the ETag of a file from its modification time and size, so
+    the file content does not need to be read
+    """
+    return '"{:x}-{:x}"'.format(int(file_stat.st_mtime), file_stat.st_size)
+
+
+def _not_modified(request, etag, mtime):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return if_none_match == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since is not None:
+        # IE adds a length attribute to the If-Modified-Since header
+        modified_since = parse_http_date_safe(if_modified_since.split(';')[0])
+        return modified_since is not None and int(mtime) <= modified_since
+
+    return False
+
+
+def _parse_range(request, etag, mtime, size):
+    """
+    Returns the first and last bytes of the requested range, None if the whole
+    file must be served, or False if the range cannot be satisfied
+    """
+    range_header = request.META.get('HTTP_RANGE')
+    if range_header is None:
+        return None
+
+    # The range is only applied if the file has not changed
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is not None and if_range != etag and parse_http_date_safe(if_range) != int(mtime):
+        return None
+
+    # Multiple ranges are not supported, so the whole file is served
+    match = _RANGE.match(range_header.strip())
+    if match is None:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+
+    if not start:
+        # Suffix range with the last bytes of the file
+        length = int(end)
+        if not length:
+            return False
+
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+
+    if start >= size or start > end:
+        return False
+
+    return start, end
+
+
+def _read_chunks(file_, length):
+    try:
+        while length > 0:
+            chunk = file_.read(min(settings.MEDIA_CHUNK_SIZE, length))
+            if not chunk:
+                break
+
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file_.close()
+
+
+def stream_file(request, path):
+    """
+    Serves a file reading it from disk in chunks, supporting conditional and range requests
+    :param request: Request downloading the file
+    :param path: Absolute path of the file
+    :return: The response including the requested file content
+    """
+    file_stat = os.stat(path)
+    size = file_stat.st_size
+    mtime = file_stat.st_mtime
+    etag = get_file_etag(file_stat)
+
+    if _not_modified(request, etag, mtime):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    byte_range = _parse_range(request, etag, mtime, size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(size)
+        return response
+
+    start, end = byte_range if byte_range is not None else (0, size - 1)
+    length = end - start + 1 if size else 0
+
+    file_ = open(path, 'rb')
+    if start:
+        file_.seek(start)
+
+    content_type, encoding = mimetypes.guess_type(path)
+    response = StreamingHttpResponse(
+        _read_chunks(file_, length), content_type=content_type or 'application/octet-stream')
+
+    if byte_range is not None:
+        response.status_code = 206
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+
+    response['Content-Length'] = str(length)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(mtime)
+
+    if encoding:
+        response['Content-Encoding'] = encoding
+
+    return response
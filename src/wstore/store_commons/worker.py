@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import os
+import threading
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_thread_pool(name, size_setting):
+    """
+    Returns the thread pool identified by name, which is lazily created once per process
+    :param size_setting: Name of the setting with the number of threads of the pool
+    """
+    with _pools_lock:
+        pool, pid = _pools.get(name, (None, None))
+
+        # Threads are not inherited by forked processes
+        if pool is None or pid != os.getpid():
+            pool = ThreadPool(getattr(settings, size_setting))
+            _pools[name] = (pool, os.getpid())
+
+    return pool
+
+
+class BackgroundWorker(threading.Thread):
+    """
+    Daemon thread that executes a task, sleeping until the date returned by
+    the task or until it is woken up
+    """
+
+    def __init__(self, task, poll_interval, setup=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._task = task
+        self._poll_interval = poll_interval
+        self._setup = setup
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def run(self):
+        if self._setup is not None:
+            try:
+                self._setup()
+            except:
+                pass
+
+        while True:
+            next_date = None
+            try:
+                next_date = self._task()
+            except:
+                pass
+
+            wait = self._poll_interval
+            if next_date is not None:
+                wait = max(0, min(wait, (next_date - datetime.utcnow()).total_seconds()))
+
+            self._wake.wait(wait)
+            self._wake.clear()
+
+
+class ProcessWorker(object):
+    """
+    Handler of a BackgroundWorker which is lazily started once per process
+    :param poll_setting: Name of the setting with the max seconds between task executions
+    """
+
+    def __init__(self, task, poll_setting, setup=None):
+        self._task = task
+        self._poll_setting = poll_setting
+        self._setup = setup
+
+        self._worker = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def notify(self):
+        """
+        Wakes up the worker, starting it if it is not running in the current process
+        """
+        with self._lock:
+            # Threads are not inherited by forked processes
+            if self._worker is None or self._pid != os.getpid() or not self._worker.is_alive():
+                self._worker = BackgroundWorker(
+                    self._task, getattr(settings, self._poll_setting), setup=self._setup)
+                self._pid = os.getpid()
+                self._worker.start()
+            else:
+                self._worker.wake()
@@ -69,46 +69,22 @@ class ServeMediaTestCase(TestCase):
         order_inst.owner_organization = self._org
         views.Order.objects.get.return_value = order_inst
 
-        # Mock offering
-        views.Offering = MagicMock()
-        self._offering_inst = MagicMock()
-        self._offering_inst.asset = self._asset_inst
-        views.Offering.objects.get.side_effect = [MagicMock(), self._offering_inst]
+        # Mock entitlement index
+        views.has_entitlement = MagicMock(return_value=False)
 
-    def _validate_res_call(self):
-        views.Resource.objects.filter.assert_called_once_with(resource_path=self._resource_path)
-        self.assertEquals(0, views.Order.objects.get.call_count)
+        views.stream_file = MagicMock()
 
-    def _validate_off_call(self):
-        self._validate_res_call()
-        self.assertEquals([
-            call(pk='offpk1'),
-            call(pk='offpk2')
-        ], views.Offering.objects.get.call_args_list)
+    def tearDown(self):
+        reload(views)
 
-    def _validate_bundle_call(self):
-        self._validate_res_call()
-        self.assertEquals([
-            call(pk='offpk1'),
-            call(pk='offpk2'),
-            call(pk='offpk3'),
-            call(pk='offpk3'),
-            call(pk='offpk4'),
-            call(pk='offpk4')
-        ], views.Offering.objects.get.call_args_list)
-
-    def _validate_product_bundle_call(self):
+    def _validate_res_call(self):
         views.Resource.objects.filter.assert_called_once_with(resource_path=self._resource_path)
-        self.assertEquals([
-            call(pk='prodpk1'),
-            call(pk='prodpk2')
-        ], views.Resource.objects.get.call_args_list)
         self.assertEquals(0, views.Order.objects.get.call_count)
 
-        self.assertEquals([
-            call(pk='offpk1'),
-            call(pk='offpk2')
-        ], views.Offering.objects.get.call_args_list)
+    def _validate_entitlement_call(self):
+        self._validate_res_call()
+        views.has_entitlement.assert_called_once_with(
+            self._user.userprofile.current_organization, self._asset_inst)
 
     def _validate_upgrading_call(self):
         self.assertEquals([
@@ -140,6 +116,37 @@ class ServeMediaTestCase(TestCase):
         views.smart_str.assert_called_once_with(expected)
         self.assertEquals('smart string', response['X-Sendfile'])
 
+    def _validate_stream(self, response, expected):
+        views.stream_file.assert_called_once_with(self.request, '/home/test/media/' + expected)
+        self.assertEquals(views.stream_file.return_value, response)
+        self.assertEquals(0, views.serve.call_count)
+
+    def _validate_not_served(self):
+        self.assertEquals(0, views.serve.call_count)
+        self.assertEquals(0, views.stream_file.call_count)
+        self.assertEquals(0, views.smart_str.call_count)
+
+    def _validate_xaccel(self, response, expected):
+        views.smart_str.assert_called_once_with('/protected/' + expected)
+        self.assertEquals('smart string', response['X-Accel-Redirect'])
+        self.assertFalse(response.has_header('Content-Type'))
+        self.assertEquals(0, views.serve.call_count)
+
+    def _use_delivery(self, delivery):
+        views.settings = MagicMock()
+        views.settings.USE_XSENDFILE = False
+        views.settings.MEDIA_DELIVERY = delivery
+        views.settings.MEDIA_ROOT = '/home/test/media/'
+        views.settings.BILL_ROOT = '/home/test/media/bills'
+        views.settings.MEDIA_DIR = 'media/'
+        views.settings.MEDIA_ACCEL_REDIRECT_PREFIX = '/protected/'
+
+    def _use_stream(self):
+        self._use_delivery('stream')
+
+    def _use_xaccel(self):
+        self._use_delivery('xaccel')
+
     def _public_asset(self):
         self._asset_inst.is_public = True
         self._asset_inst.provider = MagicMock()
@@ -148,6 +155,7 @@ class ServeMediaTestCase(TestCase):
         views.settings = MagicMock()
         views.settings.USE_XSENDFILE = True
         views.settings.MEDIA_ROOT = '/home/test/media/'
+        views.settings.BILL_ROOT = '/home/test/media/bills'
         views.settings.MEDIA_URL = '/media/'
         views.settings.MEDIA_DIR = 'media/'
 
@@ -158,9 +166,7 @@ class ServeMediaTestCase(TestCase):
         views.Order.objects.get.side_effect = Exception('Not found')
 
     def _unauthorized(self):
-        self._acquired()
-        views.Offering.objects.get.side_effect = [MagicMock(is_digital=False),
-                                                  MagicMock(is_digital=True, asset=MagicMock())]
+        self._user.userprofile.current_organization = MagicMock()
 
     def _not_loged(self):
         self._user.is_anonymous.return_value = True
@@ -170,23 +176,7 @@ class ServeMediaTestCase(TestCase):
 
     def _acquired(self):
         self._user.userprofile.current_organization = MagicMock()
-        self._user.userprofile.current_organization.acquired_offerings = ['offpk1', 'offpk2']
-
-    def _bundle_acquired(self):
-        self._acquired()
-        self._offering_inst = MagicMock(asset=None, bundled_offerings=['offpk3', 'offpk4'])
-
-        views.Offering.objects.get.side_effect = [MagicMock(), self._offering_inst,
-                                                  MagicMock(is_digital=True, asset=MagicMock()),
-                                                  MagicMock(is_digital=True, asset=MagicMock()),
-                                                  MagicMock(is_digital=True, asset=self._asset_inst),
-                                                  MagicMock(is_digital=True, asset=self._asset_inst)]
-
-    def _product_bundle_acquired(self):
-        self._acquired()
-        self._offering_inst.asset = MagicMock(bundled_assets=['prodpk1', 'prodpk2'])
-
-        views.Resource.objects.get.side_effect = [self._asset_inst, MagicMock(), self._asset_inst]
+        views.has_entitlement.return_value = True
 
     def _upgrading(self):
         self._asset_inst.old_versions = [MagicMock(resource_path=self._resource_path)]
@@ -194,12 +184,12 @@ class ServeMediaTestCase(TestCase):
 
     @parameterized.expand([
         ('asset', 'assets/test_user', 'widget.wgt', _validate_res_call, _validate_serve, _expected_file),
-        ('asset_acquired', 'assets/test_user', 'widget.wgt', _validate_off_call, _validate_serve, _expected_file, _acquired),
-        ('asset_in_bundle', 'assets/test_user', 'widget.wgt', _validate_bundle_call, _validate_serve, _expected_file, _bundle_acquired),
-        ('asset_in_product_bundle', 'assets/test_user', 'widget.wgt', _validate_product_bundle_call, _validate_serve, _expected_file, _product_bundle_acquired),
+        ('asset_acquired', 'assets/test_user', 'widget.wgt', _validate_entitlement_call, _validate_serve, _expected_file, _acquired),
         ('public_asset', 'assets/test_user', 'widget.wgt', _validate_res_call, _validate_serve, _expected_file, _public_asset),
         ('upgrading_asset', 'assets/test_user', 'widget.wgt', _validate_upgrading_call, _validate_serve, _expected_file, _upgrading),
         ('invoice', 'bills', '111111111111111111111111_userbill.pdf', _validate_order_call, _validate_xfile, 'bills/111111111111111111111111_userbill.pdf', _usexfiles),
+        ('asset_stream', 'assets/test_user', 'widget.wgt', _validate_res_call, _validate_stream, _expected_file, _use_stream),
+        ('asset_xaccel', 'assets/test_user', 'widget.wgt', _validate_res_call, _validate_xaccel, _expected_file, _use_xaccel),
         ('asset_not_found', 'assets/test_user', 'widget.wgt', _validate_upgrading_call, _validate_error, (404, {
             'result': 'error',
             'error': 'The specified asset does not exists'
@@ -208,7 +198,7 @@ class ServeMediaTestCase(TestCase):
             'result': 'error',
             'error': 'You must be authenticated to download the specified asset'
         }), _not_loged),
-        ('asset_unauthorized', 'assets/test_user', 'widget.wgt', _validate_res_call, _validate_error, (403, {
+        ('asset_unauthorized', 'assets/test_user', 'widget.wgt', _validate_entitlement_call, _validate_error, (403, {
             'result': 'error',
             'error': 'You are not authorized to download the specified asset'
         }), _unauthorized),
@@ -231,9 +221,18 @@ class ServeMediaTestCase(TestCase):
         ('invalid_type', 'invalid/user', 'widget.wgt', _validate_empty_call, _validate_error, (404, {
             'result': 'error',
             'error': 'Resource not found'
-        }))
+        })),
+        ('asset_traversal', 'assets/test_user/../..', 'settings.py', _validate_not_served, _validate_error, (404, {
+            'result': 'error',
+            'error': 'Resource not found'
+        }), _use_stream),
+        ('invoice_traversal', 'bills/../assets/test_user', '111111111111111111111111_widget.wgt', _validate_not_served, _validate_error, (404, {
+            'result': 'error',
+            'error': 'Resource not found'
+        }), _use_xaccel)
     ])
-    @override_settings(MEDIA_ROOT='/home/test/media/', MEDIA_URL='/media/', MEDIA_DIR='media/')
+    @override_settings(MEDIA_ROOT='/home/test/media/', BILL_ROOT='/home/test/media/bills', MEDIA_URL='/media/',
+                       MEDIA_DIR='media/', MEDIA_DELIVERY='serve')
     def test_serve_media(self, name, path, file_name, call_validator, res_validator, expected, side_effect=None):
 
         if side_effect is not None:
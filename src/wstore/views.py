@@ -29,9 +29,11 @@ from django.http import HttpResponse
 
 from store_commons.utils.http import build_response
 from wstore.store_commons.resource import Resource as API_Resource
+from wstore.store_commons.utils.streaming import stream_file
 
+from wstore.asset_manager.entitlement_index import has_entitlement
 from wstore.models import Resource, Organization
-from wstore.ordering.models import Order, Offering
+from wstore.ordering.models import Order
 
 
 class ServeMedia(API_Resource):
@@ -76,32 +78,10 @@ class ServeMedia(API_Resource):
             if user.is_anonymous():
                 err_code, err_msg = 401, 'You must be authenticated to download the specified asset'
 
-            if err_code is None and user.userprofile.current_organization != asset.provider:
-                # Check if the user has acquired the asset
-                acquired_offerings = user.userprofile.current_organization.acquired_offerings
-
-                for offering in [Offering.objects.get(pk=off) for off in acquired_offerings]:
-                    # Process the offering in order to extract all the offering assets
-                    offering_assets = []
-                    if len(offering.bundled_offerings) > 0:
-                        offering_assets = [Offering.objects.get(pk=off).asset
-                                           for off in offering.bundled_offerings if Offering.objects.get(pk=off).is_digital]
-                    elif offering.is_digital:
-                        offering_assets = [offering.asset]
-
-                    # Process offering assets in order to expand product bundles
-                    assets = []
-                    for off_asset in offering_assets:
-                        if len(off_asset.bundled_assets) > 0:
-                            assets.extend([Resource.objects.get(pk=bundled_pk)
-                                           for bundled_pk in off_asset.bundled_assets])
-                        else:
-                            assets.append(off_asset)
-
-                    if asset in assets:
-                        break
-                else:
-                    err_code, err_msg = 403, 'You are not authorized to download the specified asset'
+            # Check if the user has acquired the asset
+            if err_code is None and user.userprofile.current_organization != asset.provider and \
+                    not has_entitlement(user.userprofile.current_organization, asset):
+                err_code, err_msg = 403, 'You are not authorized to download the specified asset'
 
         return err_code, err_msg
 
@@ -121,6 +101,14 @@ class ServeMedia(API_Resource):
 
         return err_code, err_msg
 
+    def _is_contained(self, file_path, path):
+        if path.startswith('bills'):
+            root = settings.BILL_ROOT
+        else:
+            root = os.path.join(settings.MEDIA_ROOT, 'assets')
+
+        return os.path.abspath(file_path).startswith(os.path.join(os.path.abspath(root), ''))
+
     def read(self, request, path, name):
         # Protect the resources from not authorized downloads
         if path.startswith('assets'):
@@ -130,16 +118,35 @@ class ServeMedia(API_Resource):
         else:
             err_code, err_msg = 404, 'Resource not found'
 
-        local_path = os.path.join(path, name)
-        if err_code is None and not os.path.isfile(os.path.join(settings.MEDIA_ROOT, local_path)):
+        local_path = os.path.normpath(os.path.join(path, name))
+        file_path = os.path.join(settings.MEDIA_ROOT, local_path)
+
+        # Parent references of the path must not escape from the directory of the validated resource
+        if err_code is None and not self._is_contained(file_path, path):
+            err_code, err_msg = 404, 'Resource not found'
+
+        if err_code is None and not os.path.isfile(file_path):
             err_code, err_msg = 404, 'Resource not found'
 
         if err_code is not None:
-            response = build_response(request, err_code, err_msg)
-        elif not getattr(settings, 'USE_XSENDFILE', False):
-            response = serve(request, local_path, document_root=settings.MEDIA_ROOT)
-        else:
+            return build_response(request, err_code, err_msg)
+
+        delivery = settings.MEDIA_DELIVERY
+        if getattr(settings, 'USE_XSENDFILE', False):
+            delivery = 'xsendfile'
+
+        if delivery == 'stream':
+            response = stream_file(request, file_path)
+        elif delivery == 'xsendfile':
             response = HttpResponse()
             response['X-Sendfile'] = smart_str(local_path)
+        elif delivery == 'xaccel':
+            # nginx serves the file from an internal location, handling ranges and conditional requests.
+            # The content type is removed so it is set by nginx from the file extension
+            response = HttpResponse()
+            del response['Content-Type']
+            response['X-Accel-Redirect'] = smart_str(settings.MEDIA_ACCEL_REDIRECT_PREFIX + local_path)
+        else:
+            response = serve(request, local_path, document_root=settings.MEDIA_ROOT)
 
         return response